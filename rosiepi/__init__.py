@@ -1,8 +1,12 @@
 
-import logging.config
-
-from .logger import LOGGING_CONF
-
 __version__ = '0.0.0-auto.0'
 
-logging.config.dictConfig(LOGGING_CONF)
+def configure_logging():
+    """ Sends the ``rosiepi`` loggers to syslog. Called by each entry
+        point, rather than on import, so that importing ``rosiepi`` stays
+        cheap.
+    """
+    import logging.config # pylint: disable=import-outside-toplevel
+    from .logger import LOGGING_CONF # pylint: disable=import-outside-toplevel
+
+    logging.config.dictConfig(LOGGING_CONF)
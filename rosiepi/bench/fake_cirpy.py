@@ -0,0 +1,230 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+import os
+import pathlib
+
+from sh.contrib import git
+
+# the circuitpython layout ``cirpy_actions`` expects, in miniature. Each
+# port's Makefile stands in for the toolchain: it waits, then writes a
+# UF2 and the size line that ``build_fw`` reports.
+_MAKEFILE = """\
+BUILD ?= build-$(BOARD)
+FIRMWARE_SIZE ?= {firmware_size}
+
+all:
+\t@$(MAKE) --no-print-directory -C ../../mpy-cross
+\t@echo "Building $(BOARD) in $(BUILD)"
+\t@sleep {build_seconds}
+\t@mkdir -p $(BUILD)
+\t@head -c $(FIRMWARE_SIZE) /dev/zero > $(BUILD)/firmware.uf2
+\t@git rev-parse HEAD >> $(BUILD)/firmware.uf2
+\t@echo "$(FIRMWARE_SIZE) bytes used, 4096 bytes free in flash firmware space"
+"""
+
+# like circuitpython's, every port's build makes mpy-cross first. Two
+# makes running it at once fail, as the real one can.
+_MPY_CROSS_MAKEFILE = """\
+build/mpy-cross: main.c
+\t@mkdir build.lock 2>/dev/null || (echo "mpy-cross build raced" && false)
+\t@mkdir -p build
+\t@sleep 0.2
+\t@cp main.c build/mpy-cross
+\t@rmdir build.lock
+"""
+
+_TEST_MODULE = '''\
+def test_{index}(board):
+    assert board.exec("import os\\nprint(os.uname().machine)")
+'''
+
+# submodules of the fake repo, as (path, files)
+_SUBMODULES = (
+    ("lib/tinyusb", {"src/tusb.c": "int tusb;\n"}),
+    ("frozen/Adafruit_CircuitPython_Sim", {"sim.py": "SIM = True\n"}),
+)
+
+_PORTS = ("atmel-samd", "nrf")
+
+def _commit(repo_git, message):
+    """ Commits everything in the repo as the bench user. """
+    repo_git.add("-A")
+    repo_git(
+        "-c", "user.name=rosiepi bench",
+        "-c", "user.email=bench@rosiepi.invalid",
+        "commit", "--quiet", "-m", message
+    )
+
+def git_env():
+    """ Environment for the bench's git commands, allowing the ``file://``
+        submodule URLs that git refuses by default.
+    """
+    env = dict(os.environ)
+    env.update({
+        "GIT_CONFIG_COUNT": "1",
+        "GIT_CONFIG_KEY_0": "protocol.file.allow",
+        "GIT_CONFIG_VALUE_0": "always",
+    })
+    return env
+
+class FakeCircuitPython():
+    """ A local, bare circuitpython-shaped repository with submodules and
+        a fake toolchain, for driving ``run_rosie`` without GitHub or a
+        compiler. Pair it with ``sim_board.SimBoardFarm`` for the boards.
+
+    :param: root: Directory to create everything in.
+    :param: boards: Names of the boards to add to the ports.
+    :param: tests: Test modules in ``rosie_tests``, one test each.
+    :param: build_seconds: How long each firmware build takes.
+    :param: firmware_size: Bytes in each built UF2.
+    """
+
+    def __init__(self, root, boards, tests=10, build_seconds=0.5, # pylint: disable=too-many-arguments
+                 firmware_size=256 * 1024):
+        self.root = pathlib.Path(root)
+        self.boards = list(boards)
+        self.tests = tests
+        self.build_seconds = build_seconds
+        self.firmware_size = firmware_size
+
+        self.remote = self.root / "circuitpython.git"
+        self.work_dir = self.root / "circuitpython"
+
+    @property
+    def url(self):
+        """ The ``file://`` URL of the bare repository. """
+        return self.remote.resolve().as_uri()
+
+    def _board_port(self, index):
+        return _PORTS[index % len(_PORTS)]
+
+    def create(self):
+        """ Creates the submodule and circuitpython repositories.
+
+        :returns: The commit at the tip of the repository.
+        """
+        env = git_env()
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        submodule_urls = {}
+        for path, files in _SUBMODULES:
+            name = pathlib.PurePosixPath(path).name
+            sub_dir = self.root / "submodules" / name
+            sub_dir.mkdir(parents=True)
+            sub_git = git.bake("-C", str(sub_dir), _env=env)
+            sub_git.init("--quiet")
+            for file_name, content in files.items():
+                file_path = sub_dir / file_name
+                file_path.parent.mkdir(parents=True, exist_ok=True)
+                file_path.write_text(content)
+            _commit(sub_git, "init")
+            bare = self.root / "submodules" / f"{name}.git"
+            git.clone("--quiet", "--bare", str(sub_dir), str(bare), _env=env)
+            submodule_urls[path] = bare.resolve().as_uri()
+
+        self.work_dir.mkdir(parents=True)
+        work_git = git.bake("-C", str(self.work_dir), _env=env)
+        work_git.init("--quiet")
+
+        (self.work_dir / "py").mkdir()
+        (self.work_dir / "py" / "version.c").write_text("int version = 0;\n")
+        (self.work_dir / "shared-bindings" / "board").mkdir(parents=True)
+        (self.work_dir / "shared-bindings" / "board" / "__init__.c").write_text(
+            "int board;\n"
+        )
+
+        mpy_cross_dir = self.work_dir / "mpy-cross"
+        mpy_cross_dir.mkdir()
+        (mpy_cross_dir / "Makefile").write_text(_MPY_CROSS_MAKEFILE)
+        (mpy_cross_dir / "main.c").write_text("int main;\n")
+
+        makefile = _MAKEFILE.format(
+            firmware_size=self.firmware_size,
+            build_seconds=self.build_seconds
+        )
+        for port in _PORTS:
+            port_dir = self.work_dir / "ports" / port
+            (port_dir / "boards").mkdir(parents=True)
+            (port_dir / "Makefile").write_text(makefile)
+        for index, board in enumerate(self.boards):
+            board_dir = (
+                self.work_dir / "ports" / self._board_port(index) / "boards"
+                / board
+            )
+            board_dir.mkdir()
+            (board_dir / "mpconfigboard.mk").write_text(
+                "FROZEN_MPY_DIRS += "
+                "$(TOP)/frozen/Adafruit_CircuitPython_Sim\n"
+            )
+
+        tests_dir = self.work_dir / "tests"
+        rosie_tests = tests_dir / "circuitpython" / "rosie_tests"
+        rosie_tests.mkdir(parents=True)
+        for index in range(self.tests):
+            (rosie_tests / f"test_sim_{index}.py").write_text(
+                _TEST_MODULE.format(index=index)
+            )
+
+        for path, url in submodule_urls.items():
+            work_git.submodule("--quiet", "add", url, path)
+        _commit(work_git, "Simulated circuitpython")
+
+        git.clone(
+            "--quiet", "--bare", str(self.work_dir), str(self.remote),
+            _env=env
+        )
+
+        return self.head()
+
+    def new_commit(self, number):
+        """ Pushes a new commit, changing core code, so that every board
+            needs a fresh build.
+
+        :returns: The new commit.
+        """
+        env = git_env()
+        work_git = git.bake("-C", str(self.work_dir), _env=env)
+        (self.work_dir / "py" / "version.c").write_text(
+            f"int version = {number};\n"
+        )
+        _commit(work_git, f"Change {number}")
+        work_git.push("--quiet", str(self.remote), "HEAD")
+        return self.head()
+
+    def head(self):
+        """ The commit at the tip of the working repository. """
+        return str(
+            git("-C", str(self.work_dir), "rev-parse", "HEAD")
+        ).strip()
+
+    def activate(self):
+        """ Lets git use the ``file://`` submodules, for this process and
+            anything it starts.
+        """
+        os.environ.update(
+            (key, value) for key, value in git_env().items()
+            if key.startswith("GIT_CONFIG_")
+        )
+
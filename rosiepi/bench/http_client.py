@@ -0,0 +1,173 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import argparse
+import json
+import random
+import statistics
+import string
+import time
+
+import requests
+
+from ..physaci_stub import PhysaCIStub
+from ..reporting import PhysaCIClient
+
+cli_parser = argparse.ArgumentParser(
+    description="Benchmark sending results to a local physaCI stand-in"
+)
+cli_parser.add_argument(
+    "--requests",
+    type=int,
+    default=200,
+    help="Payloads to send with each client."
+)
+cli_parser.add_argument(
+    "--log-size",
+    type=int,
+    default=64 * 1024,
+    help="Characters of board log in each payload."
+)
+cli_parser.add_argument(
+    "--latency",
+    type=float,
+    default=0.0,
+    help="Seconds the stand-in server waits before answering."
+)
+cli_parser.add_argument(
+    "--fail-every",
+    type=int,
+    default=0,
+    help="Make every Nth request fail once with a 503."
+)
+
+def _fake_log(size):
+    """ Log-like text: repetitive lines, like a real test log. """
+    words = ["PASSED", "FAILED", "test_", "board", "REPL", "0x20001000"]
+    lines = []
+    length = 0
+    rand = random.Random(0)
+    while length < size:
+        line = " ".join(rand.choice(words) for _ in range(8)) + " " + "".join(
+            rand.choice(string.hexdigits) for _ in range(8)
+        )
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)[:size]
+
+def _payload(log_text):
+    """ A full results payload for one board. """
+    return {
+        "github_data": {"conclusion": "success", "output": {}},
+        "node_test_data": {
+            "board_tests": [{
+                "board_name": "bench_board",
+                "outcome": "Passed",
+                "tests_passed": "10",
+                "tests_failed": "0",
+                "rosie_log": log_text,
+            }],
+        },
+        "node_name": "bench",
+        "check_run_id": "0",
+    }
+
+def _summary(name, latencies, elapsed, stub_bytes):
+    """ Summarizes one client's run. """
+    latencies = sorted(latencies)
+    return {
+        "client": name,
+        "requests": len(latencies),
+        "seconds": round(elapsed, 3),
+        "requests_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+        "bytes_sent": stub_bytes,
+    }
+
+def run_naive(stub, payload, count, fail_every):
+    """ Sends like the original ``send_results``: a new connection per
+        request, no compression and no retries.
+    """
+    latencies = []
+    failed = 0
+    start = time.monotonic()
+    for index in range(count):
+        if fail_every and index % fail_every == 0:
+            stub.fail_next(1)
+        sent = time.monotonic()
+        response = requests.post(stub.url + "/testresult/update",
+                                 json=payload)
+        latencies.append(time.monotonic() - sent)
+        failed += not response.ok
+    summary = _summary("naive", latencies, time.monotonic() - start,
+                       stub.bytes_received)
+    summary["failed"] = failed
+    return summary
+
+def run_client(stub, payload, count, fail_every, compress=True):
+    """ Sends with a ``PhysaCIClient``. """
+    latencies = []
+    failed = 0
+    start = time.monotonic()
+    with PhysaCIClient(stub.url, "", backoff=0.01,
+                       compress=compress) as client:
+        for index in range(count):
+            if fail_every and index % fail_every == 0:
+                stub.fail_next(1)
+            sent = time.monotonic()
+            try:
+                client.post("/testresult/update", payload)
+            except RuntimeError:
+                failed += 1
+            latencies.append(time.monotonic() - sent)
+    name = "pooled_gzip" if compress else "pooled"
+    summary = _summary(name, latencies, time.monotonic() - start,
+                       stub.bytes_received)
+    summary["failed"] = failed
+    return summary
+
+def main():
+    """ Runs both clients against a fresh stand-in server each, and
+        prints the results as JSON.
+    """
+    cli_arg = cli_parser.parse_args()
+    payload = _payload(_fake_log(cli_arg.log_size))
+
+    runners = (
+        (run_naive, {}),
+        (run_client, {"compress": False}),
+        (run_client, {"compress": True}),
+    )
+    results = []
+    for runner, kwargs in runners:
+        with PhysaCIStub(latency=cli_arg.latency) as stub:
+            results.append(
+                runner(stub, payload, cli_arg.requests, cli_arg.fail_every,
+                       **kwargs)
+            )
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
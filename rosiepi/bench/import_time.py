@@ -0,0 +1,173 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import argparse
+import json
+import subprocess
+import sys
+
+cli_parser = argparse.ArgumentParser(
+    description="Check rosiepi entry point import times against a budget"
+)
+cli_parser.add_argument(
+    "--runs",
+    type=int,
+    default=5,
+    help="Imports to time per module; the fastest run is used."
+)
+cli_parser.add_argument(
+    "--scale",
+    type=float,
+    default=1.0,
+    help="Multiply every budget by this, for slower or faster machines."
+)
+cli_parser.add_argument(
+    "--json",
+    action="store_true",
+    help="Print the results as JSON."
+)
+
+# milliseconds each entry point module may add on top of the interpreter
+# starting up. These leave room for a Raspberry Pi; use ``--scale`` to
+# tighten them on faster machines.
+IMPORT_BUDGETS_MS = {
+    "rosiepi": 5,
+    "rosiepi.run_rosiepi": 150,
+    "rosiepi.daemon": 80,
+    "rosiepi.reporting": 40,
+    "rosiepi.rosie.test_controller": 200,
+}
+
+# modules that must stay out of each entry point's import, since they're
+# only needed once a job actually runs.
+DEFERRED_MODULES = {
+    "rosiepi": ("logging.config", "requests", "pytest", "sh"),
+    "rosiepi.run_rosiepi": ("requests", "pytest", "sh", "multiprocessing"),
+    "rosiepi.daemon": ("requests", "pytest", "sh", "multiprocessing"),
+    "rosiepi.reporting": ("requests",),
+    "rosiepi.rosie.test_controller": ("pytest", "requests", "sh"),
+}
+
+def _import_times(statement):
+    """ Runs ``statement`` in a fresh interpreter with ``-X importtime``.
+
+    :returns: A tuple of the total import time in microseconds (the sum
+              of the top-level imports), and the set of imported module
+              names.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+        text=True
+    )
+
+    total = 0
+    modules = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.add(name.strip())
+        # nested imports are indented under their parent
+        if not name[1:].startswith(" "):
+            total += int(cumulative)
+
+    return total, modules
+
+def imported_modules(module):
+    """ The modules loaded, in a fresh interpreter, by importing
+        ``module``. Unlike the timings, this doesn't vary between runs.
+    """
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import sys, {module}; print(' '.join(sys.modules))"
+        ],
+        stdout=subprocess.PIPE,
+        check=True,
+        text=True
+    )
+    return set(result.stdout.split())
+
+def check_module(module, runs=5, scale=1.0):
+    """ Times importing ``module``, less the cost of starting the
+        interpreter, and checks it against its budget and deferred
+        modules.
+
+    :returns: A dict with the module's results.
+    """
+    baseline = min(_import_times("pass")[0] for _ in range(runs))
+
+    best = None
+    modules = set()
+    for _ in range(runs):
+        total, modules = _import_times(f"import {module}")
+        best = total if best is None else min(best, total)
+
+    import_ms = max(0, best - baseline) / 1000
+    budget_ms = IMPORT_BUDGETS_MS[module] * scale
+    deferred = sorted(
+        name for name in DEFERRED_MODULES.get(module, ())
+        if name in modules
+    )
+
+    return {
+        "module": module,
+        "import_ms": round(import_ms, 1),
+        "budget_ms": round(budget_ms, 1),
+        "eagerly_imported": deferred,
+        "ok": import_ms <= budget_ms and not deferred,
+    }
+
+def main():
+    """ Checks every entry point module, and exits non-zero if any is
+        over its budget or imports a deferred module.
+    """
+    cli_arg = cli_parser.parse_args()
+
+    results = [
+        check_module(module, runs=cli_arg.runs, scale=cli_arg.scale)
+        for module in IMPORT_BUDGETS_MS
+    ]
+
+    if cli_arg.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            status = "ok" if result["ok"] else "OVER"
+            line = (
+                f"{status:4} {result['module']:32} "
+                f"{result['import_ms']:7.1f} ms "
+                f"(budget {result['budget_ms']:.1f} ms)"
+            )
+            if result["eagerly_imported"]:
+                line += f" imports: {', '.join(result['eagerly_imported'])}"
+            print(line)
+
+    sys.exit(0 if all(result["ok"] for result in results) else 1)
+
+if __name__ == "__main__":
+    main()
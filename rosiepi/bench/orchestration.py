@@ -0,0 +1,378 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+import argparse
+import collections
+import contextlib
+import json
+import os
+import pathlib
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from .. import __version__
+from ..physaci_stub import PhysaCIStub
+from ..reporting import PhysaCIClient
+from ..run_rosiepi import TestResultPayload, run_rosie, send_results
+from ..rosie import board_runner, cirpy_actions
+from ..rosie.flash_record import FlashRecord
+from ..rosie.git_mirror import GitMirror
+from ..rosie.phase_timer import PhaseTimer
+from ..rosie.sim_board import SimBoardFarm
+from .fake_cirpy import FakeCircuitPython
+
+cli_parser = argparse.ArgumentParser(
+    description="Benchmark RosiePi's job orchestration end to end, against "
+                "a fake circuitpython remote and toolchain, and simulated "
+                "boards"
+)
+cli_parser.add_argument(
+    "--jobs",
+    type=int,
+    default=3,
+    help="Jobs to run, each on a new commit."
+)
+cli_parser.add_argument(
+    "--boards",
+    type=int,
+    default=2,
+    help="Simulated boards on the node."
+)
+cli_parser.add_argument(
+    "--tests",
+    type=int,
+    default=10,
+    help="Tests run on each board."
+)
+cli_parser.add_argument(
+    "--build-seconds",
+    type=float,
+    default=0.5,
+    help="How long each fake firmware build takes."
+)
+cli_parser.add_argument(
+    "--exec-error-rate",
+    type=float,
+    default=0.0,
+    help="Chance of each simulated REPL command failing."
+)
+cli_parser.add_argument(
+    "--execution",
+    choices=board_runner.EXECUTION_MODES,
+    default="sequential",
+    help="How the per-board stages are run."
+)
+cli_parser.add_argument(
+    "--sparse",
+    action="store_true",
+    help="Use sparse checkouts."
+)
+cli_parser.add_argument(
+    "--mirror",
+    action="store_true",
+    help="Check out through a node-local git mirror."
+)
+cli_parser.add_argument(
+    "--json",
+    action="store_true",
+    help="Print the results as JSON."
+)
+cli_parser.add_argument(
+    "--output",
+    default=None,
+    help="Also write the JSON results to this file."
+)
+cli_parser.add_argument(
+    "--compare",
+    default=None,
+    help="JSON results of an earlier run to compare against. Exits "
+         "non-zero on a regression."
+)
+cli_parser.add_argument(
+    "--tolerance",
+    type=float,
+    default=0.15,
+    help="Fraction a phase or the throughput may regress by, with "
+         "--compare."
+)
+
+# phases shorter than this are too noisy to call a regression on
+_MIN_COMPARE_SECONDS = 0.02
+
+def _percentile(values, fraction):
+    """ The ``fraction`` percentile of ``values``, by nearest rank. """
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, round(fraction * len(values)) - 1))
+    return values[index]
+
+def _latency(values):
+    """ Summarizes a list of seconds. """
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 4),
+        "p50": round(_percentile(values, 0.5), 4),
+        "p95": round(_percentile(values, 0.95), 4),
+        "max": round(max(values), 4),
+    }
+
+def _source_commit():
+    """ The commit of the rosiepi source being benchmarked, if it's a git
+        checkout.
+    """
+    source_dir = pathlib.Path(__file__).resolve().parents[2]
+    result = subprocess.run(
+        ["git", "-C", str(source_dir), "rev-parse", "HEAD"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+        check=False
+    )
+    return result.stdout.strip() or None
+
+def _job_spans(payload):
+    """ Every span recorded in a job's payload. """
+    spans = list(payload.node_test_data.phase_timing)
+    for board in payload.node_test_data.board_tests:
+        spans.extend(board["phase_timing"])
+    return spans
+
+def run_bench(root, jobs=3, boards=2, tests=10, build_seconds=0.5, # pylint: disable=too-many-arguments,too-many-locals
+              execution="sequential", sparse=False, mirror=False,
+              exec_error_rate=0.0):
+    """ Runs ``jobs`` jobs through ``run_rosie`` against a fake
+        circuitpython in ``root`` and simulated boards, sending each job's
+        results to a local physaCI stand-in.
+
+    :returns: A dict with the results.
+    """
+    root = pathlib.Path(root)
+    board_names = [f"sim_board_{index}" for index in range(boards)]
+    fake = FakeCircuitPython(
+        root / "fake",
+        board_names,
+        tests=tests,
+        build_seconds=build_seconds
+    )
+    fake.create()
+    fake.activate()
+    cirpy_actions.CIRPY_GIT_URL = fake.url
+
+    git_mirror = None
+    if mirror:
+        git_mirror = GitMirror(fake.url, mirror_dir=root / "mirror")
+
+    farm = SimBoardFarm(
+        root / "sim",
+        board_names,
+        failures={"exec_error": exec_error_rate}
+    )
+    fw_record = FlashRecord(root / "flash_record.json")
+
+    phases = collections.defaultdict(list)
+    job_seconds = []
+    failed_boards = 0
+
+    bench_start = time.monotonic()
+    with farm, PhysaCIStub() as stub, \
+            PhysaCIClient(stub.url, "") as client:
+        for job in range(jobs):
+            commit = fake.new_commit(job + 1)
+            check_run_id = str(job + 1)
+            log_dir = root / "logs" / check_run_id
+            log_dir.mkdir(parents=True)
+            payload = TestResultPayload()
+
+            job_start = time.monotonic()
+            # pytest reports to stdout, which is kept for the results
+            with open(os.devnull, "w") as devnull, \
+                    contextlib.redirect_stdout(devnull):
+                run_rosie(
+                    commit,
+                    check_run_id,
+                    board_names,
+                    payload,
+                    mirror=git_mirror,
+                    execution=execution,
+                    fw_record=fw_record,
+                    log_dir=log_dir,
+                    sparse_checkout=sparse,
+                    device_watcher=farm.device_watcher(),
+                    cpboard=farm.cpboard_class()
+                )
+
+            send_timer = PhaseTimer()
+            with send_timer.span("send_results"):
+                send_results(check_run_id, client, payload.payload_json)
+            job_seconds.append(time.monotonic() - job_start)
+
+            for span in _job_spans(payload) + send_timer.spans:
+                phases[span["phase"]].append(span["seconds"])
+            failed_boards += sum(
+                board["outcome"] != "Passed"
+                for board in payload.node_test_data.board_tests
+            )
+
+    elapsed = time.monotonic() - bench_start
+
+    return {
+        "bench": "orchestration",
+        "rosiepi_version": __version__,
+        "source_commit": _source_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "params": {
+            "jobs": jobs,
+            "boards": boards,
+            "tests": tests,
+            "build_seconds": build_seconds,
+            "execution": execution,
+            "sparse": sparse,
+            "mirror": mirror,
+            "exec_error_rate": exec_error_rate,
+        },
+        "seconds": round(elapsed, 2),
+        "failed_boards": failed_boards,
+        "board_stats": farm.stats(),
+        "jobs_per_hour": round(jobs * 3600 / elapsed, 1),
+        "boards_per_hour": round(jobs * boards * 3600 / elapsed, 1),
+        "job_seconds": _latency(job_seconds),
+        "phases": {
+            phase: _latency(seconds) for phase, seconds in sorted(phases.items())
+        },
+        "peak_rss_mb": {
+            "self": round(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+            ),
+            "children": round(
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1
+            ),
+        },
+    }
+
+def compare(result, baseline, tolerance=0.15):
+    """ Compares ``result`` with an earlier run's ``baseline``.
+
+    :returns: A tuple of the comparison lines, and whether anything
+              regressed by more than ``tolerance``.
+    """
+    lines = []
+    regressed = False
+
+    if result["params"] != baseline.get("params"):
+        lines.append(
+            "warning: the runs used different parameters: "
+            f"{baseline.get('params')}"
+        )
+
+    before = baseline["jobs_per_hour"]
+    after = result["jobs_per_hour"]
+    change = (after - before) / before if before else 0.0
+    worse = change < -tolerance
+    regressed |= worse
+    lines.append(
+        f"{'REGRESSED' if worse else 'ok':9} jobs/hour "
+        f"{before:10.1f} -> {after:10.1f} ({change:+.1%})"
+    )
+
+    for phase, latency in result["phases"].items():
+        if phase not in baseline["phases"]:
+            lines.append(f"{'new':9} {phase}")
+            continue
+        before = baseline["phases"][phase]["mean"]
+        after = latency["mean"]
+        change = (after - before) / before if before else 0.0
+        worse = (
+            change > tolerance and after - before > _MIN_COMPARE_SECONDS
+        )
+        regressed |= worse
+        lines.append(
+            f"{'REGRESSED' if worse else 'ok':9} {phase:20} "
+            f"{before:8.3f}s -> {after:8.3f}s ({change:+.1%})"
+        )
+
+    return lines, regressed
+
+def _print_text(result):
+    """ Prints the results as a table. """
+    params = result["params"]
+    print(
+        f"{params['jobs']} job(s) x {params['boards']} board(s), "
+        f"{params['execution']}: {result['seconds']:.2f} secs, "
+        f"{result['jobs_per_hour']:.1f} jobs/hour, "
+        f"{result['boards_per_hour']:.1f} boards/hour"
+    )
+    print(
+        f"peak RSS: {result['peak_rss_mb']['self']:.1f} MB (self), "
+        f"{result['peak_rss_mb']['children']:.1f} MB (children)"
+    )
+    print(f"{'phase':20} {'count':>5} {'mean':>8} {'p50':>8} {'p95':>8} "
+          f"{'max':>8}")
+    for phase, latency in result["phases"].items():
+        print(
+            f"{phase:20} {latency['count']:5} {latency['mean']:8.3f} "
+            f"{latency['p50']:8.3f} {latency['p95']:8.3f} "
+            f"{latency['max']:8.3f}"
+        )
+
+def main():
+    """ Runs the benchmark in a temporary directory, and exits non-zero
+        if a board failed, or on a regression against ``--compare``.
+    """
+    cli_arg = cli_parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="rosiepi_bench_") as root:
+        result = run_bench(
+            root,
+            jobs=cli_arg.jobs,
+            boards=cli_arg.boards,
+            tests=cli_arg.tests,
+            build_seconds=cli_arg.build_seconds,
+            execution=cli_arg.execution,
+            sparse=cli_arg.sparse,
+            mirror=cli_arg.mirror,
+            exec_error_rate=cli_arg.exec_error_rate
+        )
+
+    if cli_arg.json:
+        print(json.dumps(result, indent=2))
+    else:
+        _print_text(result)
+
+    if cli_arg.output:
+        pathlib.Path(cli_arg.output).write_text(json.dumps(result, indent=2))
+
+    regressed = False
+    if cli_arg.compare:
+        baseline = json.loads(pathlib.Path(cli_arg.compare).read_text())
+        lines, regressed = compare(result, baseline, cli_arg.tolerance)
+        print("\n".join(lines), file=sys.stderr if cli_arg.json else sys.stdout)
+
+    sys.exit(1 if regressed or result["failed_boards"] else 0)
+
+if __name__ == "__main__":
+    main()
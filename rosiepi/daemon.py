@@ -0,0 +1,580 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import argparse
+import importlib
+import itertools
+import json
+import logging
+import os
+import pathlib
+import queue
+import signal
+import socket
+import socketserver
+import threading
+import time
+import traceback
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_SOCKET = pathlib.Path.home() / "rosie_pi" / "rosied.sock"
+
+# imported by the daemon before it serves, so forked jobs start with them
+# loaded; ``run_rosie`` would otherwise import them again in every job.
+_WARM_MODULES = (
+    "pytest",
+    "sh",
+    "rosiepi.rosie.test_controller",
+    "rosiepi.rosie.pytest_rosie",
+    "rosiepi.rosie.test_impact",
+)
+
+cli_parser = argparse.ArgumentParser(description="RosiePi job daemon")
+cli_parser.add_argument(
+    "--socket",
+    default=None,
+    help="Unix socket to listen on. Defaults to the configured socket."
+)
+cli_parser.add_argument(
+    "--concurrency",
+    type=int,
+    default=None,
+    help="The most jobs to run at once. Defaults to the configured value."
+)
+cli_parser.add_argument(
+    "--cancel",
+    metavar="CHECK_RUN_ID",
+    default=None,
+    help="Cancel the running daemon's job for a check run, and exit."
+)
+
+class Job():
+    """ A job submitted to the daemon.
+
+    :param: job_id: The daemon's ID for the job.
+    :param: commit: The commit of circuitpython to test.
+    :param: check_run_id: The ID of the GitHub Check Run
+    :param: force_flash: Flash the firmware even if a board is already
+                         running it.
+    :param: profile: Sample the job with the profiler.
+    :param: force_run: Test every board, even if its results are cached.
+    """
+
+    def __init__(self, job_id, commit, check_run_id, force_flash=False, # pylint: disable=too-many-arguments
+                 profile=False, force_run=False):
+        self.job_id = job_id
+        self.commit = commit
+        self.check_run_id = check_run_id
+        self.force_flash = force_flash
+        self.profile = profile
+        self.force_run = force_run
+
+        self.state = "queued"
+        self.conclusion = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.done = threading.Event()
+
+        self.process = None
+        self.cancel_requested = False
+
+    def as_dict(self):
+        """ The job's status, for sending to clients. """
+        return {
+            "job_id": self.job_id,
+            "commit": self.commit,
+            "check_run_id": self.check_run_id,
+            "state": self.state,
+            "conclusion": self.conclusion,
+            "error": self.error,
+        }
+
+def _job_process(run_job, job, resources, result_conn):
+    """ Runs one job inside a forked process, and sends its conclusion (or
+        the error) back to the daemon.
+    """
+    try:
+        # the daemon's SIGTERM handler would stop the daemon; here, SIGTERM
+        # is how a job is cancelled, which ``run_job`` handles.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # don't share the daemon's pooled connections with other jobs
+        resources.client.close()
+        conclusion = run_job(
+            job.commit,
+            job.check_run_id,
+            resources,
+            force_flash=job.force_flash,
+            profile=job.profile,
+            force_run=job.force_run
+        )
+        result_conn.send(("finished", conclusion))
+    except BaseException as job_err: # pylint: disable=broad-except
+        rosiepi_logger.error("Job %s failed:\n%s", job.job_id,
+                             traceback.format_exc())
+        result_conn.send(("error", str(job_err)))
+    finally:
+        result_conn.close()
+
+class _JobRequestHandler(socketserver.StreamRequestHandler):
+    """ Handles one client connection: a single JSON request line, which
+        is answered with one or more JSON lines.
+    """
+
+    def _reply(self, message):
+        self.wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            self._reply({"error": "Invalid request."})
+            return
+
+        rosie_daemon = self.server.rosie_daemon
+        command = request.get("command")
+
+        if command == "submit":
+            job = rosie_daemon.submit(
+                request["commit"],
+                request["check_run_id"],
+                force_flash=request.get("force_flash", False),
+                profile=request.get("profile", False),
+                force_run=request.get("force_run", False),
+                supersedes=request.get("supersedes", ())
+            )
+            self._reply(job.as_dict())
+            if request.get("wait"):
+                job.done.wait()
+                self._reply(job.as_dict())
+
+        elif command == "cancel":
+            jobs = rosie_daemon.cancel(request["check_run_id"])
+            self._reply({"cancelled": [job.as_dict() for job in jobs]})
+
+        elif command == "status":
+            self._reply({"jobs": rosie_daemon.status()})
+
+        else:
+            self._reply({"error": f"Unknown command: {command}"})
+
+class _JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ Unix socket server that handles each client in its own thread. """
+    daemon_threads = True
+
+class RosieDaemon():
+    """ Runs RosiePi jobs for local clients, from a queue. The config,
+        imports, git mirror, caches and physaCI client are set up once and
+        kept between jobs. Jobs are submitted over a Unix socket (see
+        ``submit_job``), and up to ``concurrency`` run at once; per-board
+        locks keep concurrent jobs from using the same board at the same
+        time.
+
+        Each job runs in a process forked from the daemon, so it starts
+        with everything already imported (pytest and the test controller
+        included) and set up, while the checkout's modules, pytest's state
+        and any crash stay with the job. Board connections are made fresh
+        for each job, since flashing re-enumerates the board anyway.
+
+    :param: config: A ``PhysaCIConfig()`` instance
+    :param: socket_path: The Unix socket to listen on.
+    :param: concurrency: The most jobs to run at once.
+    """
+
+    def __init__(self, config, socket_path, concurrency=1):
+        from . import run_rosiepi # pylint: disable=import-outside-toplevel
+        from .rosie import build_scheduler # pylint: disable=import-outside-toplevel
+
+        for module in _WARM_MODULES:
+            importlib.import_module(module)
+
+        self._run_rosiepi = run_rosiepi
+        self.socket_path = pathlib.Path(socket_path)
+        self.concurrency = max(1, concurrency)
+
+        # each job's builds get their share of the node's make parallelism.
+        # Jobs (and their board workers) are forked, so the builds are
+        # counted through the slot files, not the scheduler's own state.
+        concurrent_builds = self.concurrency
+        if config.execution_mode == "process":
+            concurrent_builds *= config.board_workers or len(config.supported_boards)
+        if not config.build_slot_dir:
+            rosiepi_logger.warning(
+                "No build_slot_dir; concurrent jobs won't share the node's "
+                "make parallelism."
+            )
+        self.resources = run_rosiepi.NodeResources(
+            config,
+            fw_scheduler=build_scheduler.BuildScheduler(
+                max_concurrent=concurrent_builds,
+                slot_dir=config.build_slot_dir or None
+            )
+        )
+
+        self.jobs = {}
+        self._job_ids = itertools.count(1)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = []
+        self._server = None
+
+    def submit(self, commit, check_run_id, force_flash=False, profile=False, # pylint: disable=too-many-arguments
+               force_run=False, supersedes=()):
+        """ Queues a job. A check run that is already queued or running
+            isn't queued again; its existing job is returned instead.
+
+        :param: supersedes: Check run IDs whose jobs this one replaces,
+                            e.g. for earlier pushes to the same PR. They
+                            are cancelled first.
+        """
+        for old_check_run_id in supersedes:
+            if old_check_run_id != check_run_id:
+                self.cancel(
+                    old_check_run_id,
+                    reason=f"superseded by check run {check_run_id}"
+                )
+
+        with self._lock:
+            for job in self.jobs.values():
+                if (job.check_run_id == check_run_id and
+                        job.commit == commit and not job.done.is_set()):
+                    return job
+
+            job = Job(next(self._job_ids), commit, check_run_id,
+                      force_flash=force_flash, profile=profile,
+                      force_run=force_run)
+            self.jobs[job.job_id] = job
+
+        rosiepi_logger.info(
+            "Queued job %s: commit %s, check run %s",
+            job.job_id,
+            commit,
+            check_run_id
+        )
+        self._queue.put(job)
+        return job
+
+    def cancel(self, check_run_id, reason="cancelled"):
+        """ Cancels the unfinished jobs for ``check_run_id``. Queued jobs
+            won't run, and are reported to physaCI with a ``cancelled``
+            conclusion here. Running jobs are sent SIGTERM, which stops
+            their builds and tests within a few seconds; they still report
+            their results, with a ``cancelled`` conclusion.
+
+        :param: reason: Why the jobs are cancelled, for the check run
+                        summary.
+
+        :returns: The jobs that were cancelled.
+        """
+        cancelled = []
+        with self._lock:
+            for job in self.jobs.values():
+                if job.check_run_id != check_run_id or job.done.is_set():
+                    continue
+                job.cancel_requested = True
+                cancelled.append(job)
+                if job.state == "queued":
+                    job.state = "cancelled"
+                    job.done.set()
+                elif job.process is not None:
+                    job.process.terminate()
+
+        for job in cancelled:
+            rosiepi_logger.info(
+                "Cancelled job %s: commit %s, check run %s",
+                job.job_id,
+                job.commit,
+                job.check_run_id
+            )
+            if job.state == "cancelled":
+                self._report_cancelled(job, reason)
+        return cancelled
+
+    def _report_cancelled(self, job, reason):
+        """ Reports a job that was cancelled before it could report its
+            own results. A failure to send is logged; the payload is left
+            in the outbox, if there is one.
+        """
+        try:
+            self._run_rosiepi.report_cancelled(
+                job.check_run_id,
+                self.resources.client,
+                reason=reason
+            )
+        except RuntimeError as report_err:
+            rosiepi_logger.warning(
+                "Failed to report cancelled job %s: %s",
+                job.job_id,
+                report_err
+            )
+
+    def status(self):
+        """ The status of every job the daemon knows about. """
+        with self._lock:
+            return [job.as_dict() for job in self.jobs.values()]
+
+    def _worker(self):
+        """ Runs queued jobs until a ``None`` is queued. """
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+
+            with self._lock:
+                if job.cancel_requested:
+                    continue
+                job.state = "running"
+            try:
+                job.state, outcome = self._run_job_process(job)
+                if job.state == "finished":
+                    job.conclusion = outcome
+                elif job.cancel_requested:
+                    # killed before it could report
+                    job.state = "cancelled"
+                    self._report_cancelled(job, "cancelled")
+                else:
+                    job.error = outcome
+            finally:
+                job.done.set()
+                self._forget_old_jobs()
+
+            rosiepi_logger.info(
+                "Job %s %s: %s",
+                job.job_id,
+                job.state,
+                job.conclusion or job.error
+            )
+
+    def _run_job_process(self, job):
+        """ Runs ``job`` in a forked process.
+
+        :returns: ``("finished", conclusion)`` or ``("error", message)``.
+        """
+        import multiprocessing # pylint: disable=import-outside-toplevel
+
+        context = multiprocessing.get_context("fork")
+        parent_conn, child_conn = context.Pipe(duplex=False)
+        process = context.Process(
+            target=_job_process,
+            args=(self._run_rosiepi.run_job, job, self.resources, child_conn),
+            name=f"rosiepi-job-{job.job_id}"
+        )
+        process.start()
+        child_conn.close()
+
+        with self._lock:
+            job.process = process
+            if job.cancel_requested:
+                process.terminate()
+
+        try:
+            return parent_conn.recv()
+        except EOFError:
+            process.join(5)
+            return (
+                "error",
+                f"Job process exited unexpectedly (exit code: {process.exitcode})"
+            )
+        finally:
+            parent_conn.close()
+            process.join()
+            job.process = None
+
+    def _forget_old_jobs(self, keep=100):
+        """ Drops the oldest finished jobs past ``keep``. """
+        with self._lock:
+            finished = [job for job in self.jobs.values() if job.done.is_set()]
+            for job in finished[:max(0, len(finished) - keep)]:
+                del self.jobs[job.job_id]
+
+    def serve(self):
+        """ Serves clients and runs jobs until ``shutdown`` is called. Jobs
+            that are running when the daemon is shut down are finished
+            first; queued jobs are dropped.
+        """
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+
+        self._server = _JobServer(str(self.socket_path), _JobRequestHandler)
+        self._server.rosie_daemon = self
+        os.chmod(self.socket_path, 0o660)
+
+        # results a previous run couldn't deliver go first
+        self.resources.client.replay_outbox()
+
+        for index in range(self.concurrency):
+            worker = threading.Thread(
+                target=self._worker,
+                name=f"rosiepi-job-{index}",
+                daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+        rosiepi_logger.info(
+            "RosiePi daemon listening on %s, running up to %s job(s) at once",
+            self.socket_path,
+            self.concurrency
+        )
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            self.socket_path.unlink(missing_ok=True)
+
+            while True:
+                try:
+                    dropped = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if dropped is not None:
+                    dropped.state = "dropped"
+                    dropped.done.set()
+
+            for _ in self._workers:
+                self._queue.put(None)
+            for worker in self._workers:
+                worker.join()
+
+            self.resources.close()
+            rosiepi_logger.info("RosiePi daemon stopped.")
+
+    def shutdown(self):
+        """ Stops ``serve``. Safe to call from a signal handler. """
+        if self._server is not None:
+            threading.Thread(target=self._server.shutdown, daemon=True).start()
+
+def submit_job(socket_path, commit, check_run_id, force_flash=False, # pylint: disable=too-many-arguments
+               profile=False, force_run=False, supersedes=()):
+    """ Hands a job to the RosiePi daemon, and waits for it to finish.
+
+        :param: supersedes: Check run IDs whose jobs are cancelled in favour
+                            of this one.
+
+        :returns: The job's conclusion, or ``None`` if the daemon isn't
+                  running.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            client.connect(str(socket_path))
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+
+        request = {
+            "command": "submit",
+            "commit": commit,
+            "check_run_id": check_run_id,
+            "force_flash": force_flash,
+            "profile": profile,
+            "force_run": force_run,
+            "supersedes": list(supersedes),
+            "wait": True,
+        }
+        client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+
+        job = None
+        with client.makefile("rb") as replies:
+            for line in replies:
+                job = json.loads(line)
+                rosiepi_logger.info(
+                    "Daemon job %s: %s",
+                    job.get("job_id"),
+                    job.get("state")
+                )
+    finally:
+        client.close()
+
+    if job is not None and job.get("state") == "cancelled":
+        return "cancelled"
+
+    if job is None or job.get("state") != "finished":
+        error = job.get("error") if job else "no reply"
+        raise RuntimeError(f"RosiePi daemon job failed: {error}")
+
+    return job["conclusion"]
+
+def cancel_job(socket_path, check_run_id):
+    """ Asks the RosiePi daemon to cancel its jobs for ``check_run_id``.
+
+        :returns: The cancelled jobs, or ``None`` if the daemon isn't
+                  running.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            client.connect(str(socket_path))
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+
+        request = {"command": "cancel", "check_run_id": check_run_id}
+        client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with client.makefile("rb") as replies:
+            reply = json.loads(replies.readline())
+    finally:
+        client.close()
+
+    return reply["cancelled"]
+
+def main():
+    """ Runs the RosiePi daemon until it is stopped with SIGTERM or
+        SIGINT.
+    """
+    cli_arg = cli_parser.parse_args()
+
+    from . import configure_logging # pylint: disable=import-outside-toplevel
+    from .run_rosiepi import PhysaCIConfig, activate_venv # pylint: disable=import-outside-toplevel
+
+    activate_venv()
+    configure_logging()
+
+    config = PhysaCIConfig()
+    socket_path = cli_arg.socket or config.daemon_socket or DEFAULT_SOCKET
+
+    if cli_arg.cancel is not None:
+        cancelled = cancel_job(socket_path, cli_arg.cancel)
+        if cancelled is None:
+            raise SystemExit("The RosiePi daemon isn't running.")
+        for job in cancelled:
+            print(f"Cancelled job {job['job_id']} ({job['state']}): "
+                  f"commit {job['commit']}, check run {job['check_run_id']}")
+        if not cancelled:
+            print(f"No unfinished jobs for check run {cli_arg.cancel}.")
+        return
+
+    rosie_daemon = RosieDaemon(
+        config,
+        socket_path,
+        concurrency=cli_arg.concurrency or config.daemon_concurrency
+    )
+
+    def stop(signum, _):
+        rosiepi_logger.info("Received signal %s; stopping.", signum)
+        rosie_daemon.shutdown()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    rosie_daemon.serve()
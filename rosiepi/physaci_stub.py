@@ -0,0 +1,237 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import argparse
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import threading
+import time
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+cli_parser = argparse.ArgumentParser(
+    description="Local stand-in for the physaCI test result API"
+)
+cli_parser.add_argument(
+    "--host",
+    default="127.0.0.1",
+    help="Address to listen on."
+)
+cli_parser.add_argument(
+    "--port",
+    type=int,
+    default=8080,
+    help="Port to listen on."
+)
+cli_parser.add_argument(
+    "--api-key",
+    default=None,
+    help="Require this value in the x-functions-key header."
+)
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """ Accepts the physaCI test result endpoints, and hands each request
+        to the server's ``PhysaCIStub``.
+    """
+    # keep-alive, so pooled clients can reuse connections
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self): # pylint: disable=invalid-name
+        """ Handles a POSTed JSON payload. """
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        status = stub.handle(self.path, self.headers, body)
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        rosiepi_logger.debug(format, *args)
+
+class PhysaCIStub():
+    """ A local HTTP server that stands in for physaCI's test result API,
+        and keeps what it receives for inspection. Accepts both the full
+        payload (``/testresult/update``) and the incremental endpoints
+        (``/testresult/board``, ``/testresult/log`` and
+        ``/testresult/finalize``).
+
+    :param: host: Address to listen on.
+    :param: port: Port to listen on. ``0`` picks a free port.
+    :param: api_key: If set, requests without this ``x-functions-key``
+                     header are rejected with a 401.
+    :param: latency: Seconds to wait before answering each request.
+    :param: accept_gzip: Whether gzip request bodies are accepted. If not,
+                         they are answered with a 415.
+    """
+
+    ENDPOINTS = (
+        "/testresult/update",
+        "/testresult/board",
+        "/testresult/log",
+        "/testresult/finalize",
+    )
+
+    def __init__(self, host="127.0.0.1", port=0, api_key=None, latency=0, # pylint: disable=too-many-arguments
+                 accept_gzip=True):
+        self.api_key = api_key
+        self.latency = latency
+        self.accept_gzip = accept_gzip
+
+        self.bytes_received = 0
+        self._failures = []
+
+        self.requests = []
+        self.results = []
+        self.board_results = {}
+        self.board_logs = {}
+        self.finalized = []
+
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _StubHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """ The base URL to use as ``physaci_url``. """
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def handle(self, path, headers, body):
+        """ Records one request, and returns the HTTP status to answer
+            with.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self.bytes_received += len(body)
+            if self._failures:
+                return self._failures.pop(0)
+
+        if path not in self.ENDPOINTS:
+            return 404
+
+        if self.api_key is not None:
+            if headers.get("x-functions-key") != self.api_key:
+                return 401
+
+        if headers.get("Content-Encoding") == "gzip":
+            if not self.accept_gzip:
+                return 415
+            try:
+                body = gzip.decompress(body)
+            except OSError:
+                return 400
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return 400
+
+        with self._lock:
+            self.requests.append((path, payload))
+            run_key = (payload.get("check_run_id"), payload.get("node_name"))
+
+            if path == "/testresult/update":
+                self.results.append(payload)
+
+            elif path == "/testresult/board":
+                self.board_results.setdefault(run_key, {})[
+                    payload["board_name"]
+                ] = payload
+
+            elif path == "/testresult/log":
+                chunks = self.board_logs.setdefault(run_key, {}).setdefault(
+                    payload["board_name"],
+                    {}
+                )
+                chunks[payload["index"]] = payload["text"]
+
+            elif path == "/testresult/finalize":
+                self.finalized.append(payload)
+
+        return 200
+
+    def fail_next(self, count, status=503):
+        """ Answers the next ``count`` requests with ``status``, without
+            recording them.
+        """
+        with self._lock:
+            self._failures.extend([status] * count)
+
+    def board_log(self, check_run_id, node_name, board_name):
+        """ A board's log, reassembled from its chunks. """
+        with self._lock:
+            chunks = self.board_logs[(check_run_id, node_name)][board_name]
+            return "".join(chunks[index] for index in sorted(chunks))
+
+    def start(self):
+        """ Starts serving in a background thread. """
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            name="physaci-stub",
+            daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stops serving, and closes the server's socket. """
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+def main():
+    """ Runs the stand-in server until interrupted. """
+    cli_arg = cli_parser.parse_args()
+
+    stub = PhysaCIStub(
+        host=cli_arg.host,
+        port=cli_arg.port,
+        api_key=cli_arg.api_key
+    )
+    print(f"physaCI stand-in listening on {stub.url}")
+    try:
+        stub._server.serve_forever() # pylint: disable=protected-access
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub._server.server_close() # pylint: disable=protected-access
+
+    for path, payload in stub.requests:
+        print(path, payload.get("board_name", ""))
+
+if __name__ == "__main__":
+    main()
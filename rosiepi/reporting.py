@@ -0,0 +1,376 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import contextlib
+import fcntl
+import gzip
+import json
+import logging
+import os
+import pathlib
+import random
+from socket import gethostname
+import time
+import uuid
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_OUTBOX_DIR = pathlib.Path.home() / "rosie_pi" / "outbox"
+
+# compressed log bytes read per posted chunk; see
+# ``TestResultStream.iter_text``.
+_LOG_CHUNK_SIZE = 16 * 1024
+
+# bodies smaller than this aren't worth compressing
+_MIN_COMPRESS_SIZE = 1024
+
+# responses worth retrying; anything else from physaCI is final
+_RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+# responses to a compressed body that may mean physaCI can't decode it,
+# besides any 5xx
+_UNCOMPRESSED_RETRY_STATUSES = (400, 415)
+
+class PhysaCIClient():
+    """ HTTP client for the physaCI API. Keeps one pooled session for the
+        life of the client, optionally gzips request bodies, and retries
+        transient failures with capped exponential backoff. Payloads that
+        still can't be delivered can be left in an on-disk outbox, and
+        are replayed by ``replay_outbox``.
+
+        If physaCI answers a compressed body with a ``400``, ``415`` or
+        ``5xx``, the request is resent uncompressed straight away, and
+        compression is turned off for the rest of the client's life.
+
+    :param: physaci_url: The physaCI base URL.
+    :param: api_key: The physaCI API key.
+    :param: timeout: ``(connect, read)`` timeouts, in seconds.
+    :param: retries: Attempts after the first, for transient failures.
+    :param: backoff: Seconds before the first retry; doubled for each
+                     retry after, up to ``max_backoff``.
+    :param: max_backoff: The longest wait between retries, in seconds.
+    :param: outbox_dir: Directory for undelivered payloads. ``None``
+                        disables the outbox.
+    :param: compress: Whether to gzip request bodies. Only for physaCI
+                      servers that accept ``Content-Encoding: gzip``.
+    """
+
+    def __init__(self, physaci_url, api_key, timeout=(5, 30), retries=4, # pylint: disable=too-many-arguments
+                 backoff=0.5, max_backoff=30, outbox_dir=None, compress=False):
+        self.physaci_url = physaci_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.outbox_dir = pathlib.Path(outbox_dir) if outbox_dir else None
+        self.compress = compress
+
+        # requests is slow to import, and the daemon client never needs it
+        import requests # pylint: disable=import-outside-toplevel
+        from requests.adapters import HTTPAdapter # pylint: disable=import-outside-toplevel
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            "x-functions-key": api_key,
+            "Content-Type": "application/json",
+        })
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        """ Closes the session's pooled connections. """
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def _send_once(self, url, body):
+        """ Sends one POST, compressing the body if enabled. """
+        if self.compress and len(body) >= _MIN_COMPRESS_SIZE:
+            response = self.session.post(
+                url,
+                data=gzip.compress(body, compresslevel=6),
+                headers={"Content-Encoding": "gzip"},
+                timeout=self.timeout
+            )
+            status = response.status_code
+            if status not in _UNCOMPRESSED_RETRY_STATUSES and status < 500:
+                return response
+
+            rosiepi_logger.info(
+                "physaCI answered a compressed body with %s; sending "
+                "uncompressed from now on.",
+                status
+            )
+            self.compress = False
+
+        return self.session.post(url, data=body, timeout=self.timeout)
+
+    def post(self, endpoint, payload):
+        """ POSTs ``payload`` as JSON to a physaCI ``endpoint``, retrying
+            transient failures. Raises ``RuntimeError`` if it can't be
+            delivered.
+        """
+        import requests # pylint: disable=import-outside-toplevel
+
+        url = self.physaci_url + endpoint
+        body = json.dumps(payload).encode("utf-8")
+
+        attempt = 0
+        while True:
+            try:
+                response = self._send_once(url, body)
+                if response.ok:
+                    return response
+                failure = (
+                    f"Response code: {response.status_code}. "
+                    f"Response: {response.text}"
+                )
+                retry = response.status_code in _RETRY_STATUSES
+            except (requests.ConnectionError, requests.Timeout) as post_err:
+                failure = str(post_err)
+                retry = True
+            except requests.RequestException as post_err:
+                failure = str(post_err)
+                retry = False
+
+            if not retry or attempt >= self.retries:
+                raise RuntimeError(
+                    f"physaCI rejected {endpoint} after {attempt + 1} "
+                    f"attempt(s). {failure}"
+                )
+
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+            # jitter, so nodes that failed together don't retry together
+            delay *= random.uniform(0.5, 1.0)
+            rosiepi_logger.info(
+                "Retrying %s in %.1f secs (%s)",
+                endpoint,
+                delay,
+                failure
+            )
+            time.sleep(delay)
+            attempt += 1
+
+    def send(self, endpoint, payload):
+        """ Like ``post``, but an undeliverable payload is written to the
+            outbox before ``RuntimeError`` is raised.
+        """
+        try:
+            self.post(endpoint, payload)
+        except RuntimeError:
+            if self.outbox_dir is not None:
+                queued = self._queue(endpoint, payload)
+                rosiepi_logger.warning(
+                    "Queued undelivered %s payload: %s",
+                    endpoint,
+                    queued
+                )
+            raise
+
+    def _queue(self, endpoint, payload):
+        """ Writes a payload to the outbox, named so that the outbox
+            sorts oldest first.
+        """
+        self.outbox_dir.mkdir(parents=True, exist_ok=True)
+        name = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}.json"
+        tmp_path = self.outbox_dir / f".{name}.tmp"
+        tmp_path.write_text(
+            json.dumps({"endpoint": endpoint, "payload": payload})
+        )
+        queued = self.outbox_dir / name
+        os.replace(tmp_path, queued)
+        return queued
+
+    @contextlib.contextmanager
+    def _outbox_lock(self):
+        """ Context manager that yields whether the outbox lock was
+            taken. Only one process replays the outbox at a time.
+        """
+        self.outbox_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.outbox_dir / ".lock", "a") as lock_fd:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+    def replay_outbox(self):
+        """ Sends the payloads left in the outbox, oldest first, stopping
+            at the first one that still can't be delivered.
+
+        :returns: The number of payloads delivered.
+        """
+        if self.outbox_dir is None or not self.outbox_dir.exists():
+            return 0
+
+        delivered = 0
+        with self._outbox_lock() as locked:
+            if not locked:
+                return 0
+
+            for queued in sorted(self.outbox_dir.glob("[0-9]*.json")):
+                try:
+                    entry = json.loads(queued.read_text())
+                except ValueError:
+                    rosiepi_logger.warning(
+                        "Discarding unreadable outbox entry: %s",
+                        queued
+                    )
+                    queued.unlink()
+                    continue
+
+                try:
+                    self.post(entry["endpoint"], entry["payload"])
+                except RuntimeError as replay_err:
+                    rosiepi_logger.warning(
+                        "Outbox replay stopped at %s: %s",
+                        queued.name,
+                        replay_err
+                    )
+                    break
+
+                queued.unlink()
+                delivered += 1
+
+        if delivered:
+            rosiepi_logger.info("Delivered %s queued payload(s).", delivered)
+        return delivered
+
+class IncrementalReporter():
+    """ Reports a job's results to physaCI as each board finishes, instead
+        of in one payload at the end of the job:
+
+        1. ``/testresult/board``: the board's outcome and counts, as soon
+           as the board finishes.
+        2. ``/testresult/log``: the board's log, in numbered chunks. The
+           last chunk is marked ``final``.
+        3. ``/testresult/finalize``: the GitHub check run data, once every
+           board has been reported.
+
+        A board that fails to report is logged and remembered in
+        ``failed_boards``, and the rest of the job carries on.
+
+    :param: client: The ``PhysaCIClient`` to send with.
+    :param: check_run_id: The check run ID of the job.
+    """
+
+    def __init__(self, client, check_run_id):
+        self.client = client
+        self.check_run_id = check_run_id
+        self.node_name = gethostname()
+
+        self.reported_boards = []
+        self.failed_boards = []
+
+    def _post(self, endpoint, payload):
+        """ POSTs ``payload`` to a physaCI ``endpoint``, raising
+            ``RuntimeError`` if physaCI doesn't accept it.
+        """
+        payload["node_name"] = self.node_name
+        payload["check_run_id"] = self.check_run_id
+        self.client.post(endpoint, payload)
+
+    def report_board(self, board_results):
+        """ Sends a finished board's results and log.
+
+        :param: board_results: The board's entry in
+                               ``NodeTestData.board_tests``.
+        """
+        board_name = board_results["board_name"]
+        summary = {
+            key: value for key, value in board_results.items()
+            if key != "rosie_log"
+        }
+
+        try:
+            self._post("/testresult/board", summary)
+
+            rosie_log = board_results["rosie_log"]
+            if isinstance(rosie_log, str):
+                log_text = [rosie_log]
+            else:
+                log_text = rosie_log.iter_text(_LOG_CHUNK_SIZE)
+
+            chunk_index = 0
+            previous = None
+            # hold back one chunk, so the last one can be marked final
+            for text in log_text:
+                if previous is not None:
+                    self._post_log_chunk(board_name, chunk_index, previous)
+                    chunk_index += 1
+                previous = text
+            self._post_log_chunk(board_name, chunk_index, previous or "",
+                                 final=True)
+
+        # anything going wrong leaves the board to the full payload, sent
+        # at the end of the job, rather than ending the job unreported.
+        except Exception as report_err: # pylint: disable=broad-except
+            rosiepi_logger.warning(
+                "Failed to report results for %s: %s",
+                board_name,
+                report_err
+            )
+            self.failed_boards.append(board_name)
+            return
+
+        self.reported_boards.append(board_name)
+        rosiepi_logger.info(
+            "Reported results for %s (%s log chunk(s))",
+            board_name,
+            chunk_index + 1
+        )
+
+    def _post_log_chunk(self, board_name, index, text, final=False):
+        """ Sends one chunk of a board's log. """
+        self._post(
+            "/testresult/log",
+            {
+                "board_name": board_name,
+                "index": index,
+                "text": text,
+                "final": final,
+            }
+        )
+
+    def finalize(self, github_data):
+        """ Sends the check run data, closing out the job.
+
+        :param: github_data: The job's ``GitHubData``, as a dict.
+        """
+        payload = {
+            "github_data": github_data,
+            "board_names": self.reported_boards,
+            "node_name": self.node_name,
+            "check_run_id": self.check_run_id,
+        }
+        self.client.send("/testresult/finalize", payload)
+        rosiepi_logger.info("Test results finalized.")
@@ -0,0 +1,82 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import fcntl
+import logging
+import pathlib
+import time
+
+from .job_cancel import wait_for_lock
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_LOCK_DIR = pathlib.Path.home() / "rosie_pi" / "board_locks"
+
+class BoardLocks():
+    """ One lock file per board, so that jobs running at the same time
+        (in threads or processes) never drive the same board at once.
+        ``flock`` locks belong to the open file, so threads in one process
+        exclude each other too, and a crashed holder releases its lock.
+
+    :param: lock_dir: Directory to keep the lock files in.
+    """
+
+    def __init__(self, lock_dir=DEFAULT_LOCK_DIR):
+        self.lock_dir = pathlib.Path(lock_dir)
+
+    def acquire(self, board, cancel=None):
+        """ Waits for ``board`` to be free, and takes it.
+
+        :param: cancel: An optional ``job_cancel.CancelToken`` that stops
+                        the wait.
+
+        :returns: The held lock, to pass to ``release``.
+        :raises: ``job_cancel.JobCancelled`` if the job is cancelled while
+                 waiting.
+        """
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+        lock_fd = open(self.lock_dir / f"{board}.lock", "a")
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            rosiepi_logger.info("Waiting for %s to be free...", board)
+            wait_start = time.monotonic()
+            try:
+                wait_for_lock(lock_fd, cancel)
+            except BaseException:
+                lock_fd.close()
+                raise
+            rosiepi_logger.info(
+                "Waited %.1f secs for %s",
+                time.monotonic() - wait_start,
+                board
+            )
+        return lock_fd
+
+    @staticmethod
+    def release(lock_fd):
+        """ Frees a board taken with ``acquire``. """
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        finally:
+            lock_fd.close()
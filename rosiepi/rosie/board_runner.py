@@ -0,0 +1,373 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import logging
+import queue
+import signal
+import threading
+import time
+import traceback
+
+from .job_cancel import JobCancelled, cancel_on_signals
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+EXECUTION_MODES = ("sequential", "pipeline", "process")
+
+# seconds a cancelled worker process gets to stop its board, before it is
+# killed
+_CANCEL_GRACE = 15
+
+def _cancelled(cancel):
+    return cancel is not None and cancel.cancelled
+
+def run_sequential(boards, new_controller, cancel=None):
+    """ Runs every stage for one board before moving to the next.
+
+        Each executor takes the job's boards and a ``new_controller(board)``
+        callable that returns a ``TestController``, and yields the finished
+        controllers in board order. If a stage raises unexpectedly, the
+        traceback is written to that board's log, the board is yielded,
+        and the remaining boards are skipped. Once the optional
+        ``job_cancel.CancelToken`` ``cancel`` is cancelled, boards that
+        haven't started are skipped too.
+    """
+    for board in boards:
+        if _cancelled(cancel):
+            break
+
+        rosie_test = new_controller(board)
+
+        try:
+            # check if connection to board was successful
+            if rosie_test.state != "error":
+                rosie_test.start_test()
+
+        except Exception: # pylint: disable=broad-except
+            rosie_test.log.write(traceback.format_exc())
+            yield rosie_test
+            break
+
+        yield rosie_test
+
+def run_pipelined(boards, new_controller, depth=1, cancel=None):
+    """ Builds the firmware for the next board(s) while the current board
+        is being flashed and tested. Builds run in a background thread and
+        hand off to flashing/testing through a queue holding at most
+        ``depth`` built boards.
+    """
+    built = queue.Queue(maxsize=max(1, depth))
+    stop_building = threading.Event()
+    builder_error = []
+
+    def builder():
+        try:
+            for board in boards:
+                if stop_building.is_set() or _cancelled(cancel):
+                    break
+
+                rosie_test = new_controller(board)
+                # boards that failed to connect skip every stage
+                if rosie_test.state == "error":
+                    built.put((rosie_test, "skipped"))
+                    continue
+
+                try:
+                    rosie_test.build_firmware()
+                except Exception: # pylint: disable=broad-except
+                    rosie_test.log.write(traceback.format_exc())
+                    built.put((rosie_test, "raised"))
+                    break
+
+                built.put((rosie_test, "built"))
+
+        except BaseException as build_err: # pylint: disable=broad-except
+            builder_error.append(build_err)
+
+        finally:
+            built.put(None)
+
+    build_thread = threading.Thread(
+        target=builder,
+        name="rosiepi-builder",
+        daemon=True
+    )
+    build_thread.start()
+
+    try:
+        while True:
+            item = built.get()
+            if item is None:
+                break
+
+            rosie_test, build_status = item
+            if build_status == "raised":
+                yield rosie_test
+                break
+
+            if build_status == "skipped":
+                yield rosie_test
+                continue
+
+            try:
+                rosie_test.complete_test()
+            except Exception: # pylint: disable=broad-except
+                rosie_test.log.write(traceback.format_exc())
+                yield rosie_test
+                break
+
+            yield rosie_test
+
+    finally:
+        # let the builder finish its current board, and discard anything
+        # built after the pipeline stopped early.
+        stop_building.set()
+        while build_thread.is_alive() or not built.empty():
+            try:
+                if built.get(timeout=0.1) is None:
+                    break
+            except queue.Empty:
+                pass
+        build_thread.join()
+
+    if builder_error:
+        raise builder_error[0]
+
+class BoardRun():
+    """ The results of a board that was run in a worker process, with the
+        same attributes ``run_rosie`` reads from a ``TestController``.
+    """
+
+    def __init__(self, board_name, state, result, tests_passed, # pylint: disable=too-many-arguments
+                 tests_failed, build_stats, log_text=None, log_path=None,
+                 phase_timing=None):
+        from .test_controller import TestResultStream # pylint: disable=import-outside-toplevel
+
+        self.board_name = board_name
+        self.state = state
+        self.result = result
+        self.tests_passed = tests_passed
+        self.tests_failed = tests_failed
+        self.build_stats = build_stats
+        self.log_path = log_path
+        self.phase_timing = phase_timing or []
+
+        if log_path is not None:
+            self.log = TestResultStream.load(log_path)
+        else:
+            self.log = TestResultStream()
+            self.log.write(log_text)
+
+    def close(self):
+        """ Nothing to release; the worker process has already exited. """
+
+    @classmethod
+    def crashed(cls, board, message):
+        """ Results for a board whose worker failed without reporting. """
+        from pytest import ExitCode # pylint: disable=import-outside-toplevel
+
+        return cls(board, "error", int(ExitCode.INTERNAL_ERROR), 0, 0, {},
+                   log_text=message)
+
+    @classmethod
+    def cancelled(cls, board, message):
+        """ Results for a board whose worker was killed after the job was
+            cancelled.
+        """
+        from pytest import ExitCode # pylint: disable=import-outside-toplevel
+
+        return cls(board, "cancelled", int(ExitCode.INTERRUPTED), 0, 0, {},
+                   log_text=message)
+
+def _snapshot(rosie_test):
+    """ The picklable results of a finished ``TestController``, as the
+        keyword arguments for a ``BoardRun``. When the job keeps logs,
+        the board's log is saved there and only its path is sent back.
+    """
+    snapshot = {
+        "board_name": rosie_test.board_name,
+        "state": rosie_test.state,
+        "result": int(rosie_test.result),
+        "tests_passed": rosie_test.tests_passed,
+        "tests_failed": rosie_test.tests_failed,
+        "build_stats": rosie_test.build_stats,
+        "phase_timing": rosie_test.phase_timing,
+    }
+
+    if rosie_test.log_dir is not None:
+        snapshot["log_path"] = rosie_test.save_log()
+    else:
+        snapshot["log_text"] = rosie_test.log.getvalue()
+
+    return snapshot
+
+def _board_worker(board, new_controller, result_conn, cancel):
+    """ Runs every stage for ``board`` inside a worker process, and sends
+        the results back to the parent. Anything that goes wrong outside
+        of the stages is sent as the traceback text instead. SIGTERM
+        cancels the worker's copy of ``cancel``, so the board stops
+        cleanly.
+    """
+    try:
+        with cancel_on_signals(cancel, signals=(signal.SIGTERM,)):
+            rosie_test = new_controller(board)
+            try:
+                if rosie_test.state != "error":
+                    rosie_test.start_test()
+            except Exception: # pylint: disable=broad-except
+                rosie_test.log.write(traceback.format_exc())
+
+            snapshot = _snapshot(rosie_test)
+            # atexit doesn't run in worker processes, so reset the board
+            # here
+            rosie_test.close()
+        result_conn.send(snapshot)
+
+    except JobCancelled as cancel_err:
+        from pytest import ExitCode # pylint: disable=import-outside-toplevel
+
+        # cancelled while waiting for the board; it was never touched
+        result_conn.send({
+            "board_name": board,
+            "state": "cancelled",
+            "result": int(ExitCode.INTERRUPTED),
+            "tests_passed": 0,
+            "tests_failed": 0,
+            "build_stats": {},
+            "log_text": f"{cancel_err} before {board} was tested.",
+        })
+
+    except BaseException: # pylint: disable=broad-except
+        result_conn.send(traceback.format_exc())
+
+    finally:
+        result_conn.close()
+
+def run_processes(boards, new_controller, workers=None, timeout=None, # pylint: disable=too-many-branches,too-many-locals
+                  cancel=None):
+    """ Runs each board's stages in its own worker process, with up to
+        ``workers`` boards at once. Each worker has its own
+        ``TestController`` and pytest session (and so its own
+        ``RosieTestController`` plugin). A board whose worker raises,
+        crashes or exceeds ``timeout`` seconds is reported as an error
+        without affecting the other boards. Results are yielded as
+        ``BoardRun`` instances, in board order.
+
+        Once ``cancel`` is cancelled, no more workers are started, and the
+        running ones are sent SIGTERM to stop their boards. Workers still
+        running ``_CANCEL_GRACE`` seconds later are killed.
+    """
+    import multiprocessing # pylint: disable=import-outside-toplevel
+    from multiprocessing.connection import wait # pylint: disable=import-outside-toplevel
+
+    boards = list(boards)
+    workers = max(1, workers or len(boards) or 1)
+    # fork, so that workers inherit the job's checkout and caches
+    context = multiprocessing.get_context("fork")
+
+    pending = list(enumerate(boards))
+    running = {}
+    finished = {}
+    next_index = 0
+    cancel_deadline = None
+
+    try:
+        while pending or running:
+            if _cancelled(cancel) and cancel_deadline is None:
+                pending.clear()
+                for _, board, worker, _ in running.values():
+                    rosiepi_logger.info("Stopping worker for %s", board)
+                    worker.terminate()
+                cancel_deadline = time.monotonic() + _CANCEL_GRACE
+
+            while pending and len(running) < workers:
+                index, board = pending.pop(0)
+                parent_conn, child_conn = context.Pipe(duplex=False)
+                worker = context.Process(
+                    target=_board_worker,
+                    args=(board, new_controller, child_conn, cancel),
+                    name=f"rosiepi-{board}",
+                    daemon=True
+                )
+                worker.start()
+                child_conn.close()
+                running[parent_conn] = (index, board, worker, time.monotonic())
+                rosiepi_logger.info("Started worker %s for %s", worker.pid, board)
+
+            for conn in wait(list(running), timeout=1):
+                index, board, worker, _ = running.pop(conn)
+                try:
+                    worker_result = conn.recv()
+                    if isinstance(worker_result, dict):
+                        finished[index] = BoardRun(**worker_result)
+                    else:
+                        finished[index] = BoardRun.crashed(board, worker_result)
+                except EOFError:
+                    worker.join(5)
+                    finished[index] = BoardRun.crashed(
+                        board,
+                        f"RosiePi worker for {board} exited unexpectedly "
+                        f"(exit code: {worker.exitcode})"
+                    )
+                conn.close()
+                worker.join(5)
+
+            if cancel_deadline is not None and time.monotonic() > cancel_deadline:
+                for conn, (index, board, worker, _) in list(running.items()):
+                    worker.kill()
+                    worker.join(5)
+                    del running[conn]
+                    conn.close()
+                    finished[index] = BoardRun.cancelled(
+                        board,
+                        f"RosiePi worker for {board} didn't stop within "
+                        f"{_CANCEL_GRACE} secs of the job being cancelled"
+                    )
+
+            if timeout is not None:
+                now = time.monotonic()
+                for conn, (index, board, worker, started) in list(running.items()):
+                    if now - started > timeout:
+                        # give the worker a chance to stop its board
+                        worker.terminate()
+                        worker.join(5)
+                        if worker.is_alive():
+                            worker.kill()
+                            worker.join(5)
+                        del running[conn]
+                        conn.close()
+                        finished[index] = BoardRun.crashed(
+                            board,
+                            f"RosiePi worker for {board} timed out after "
+                            f"{timeout} secs"
+                        )
+
+            while next_index in finished:
+                yield finished.pop(next_index)
+                next_index += 1
+
+    finally:
+        # the caller stopped early; don't leave workers behind
+        for _, _, worker, _ in running.values():
+            worker.kill()
+            worker.join(5)
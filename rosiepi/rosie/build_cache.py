@@ -0,0 +1,218 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import subprocess
+import tempfile
+
+from sh.contrib import git
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_CACHE_DIR = pathlib.Path.home() / "rosie_pi" / "build_cache"
+
+# bump when the make recipe in ``cirpy_actions.build_fw`` changes in a way
+# that affects the output.
+_RECIPE_VERSION = "1"
+
+# top-level paths in the circuitpython tree that don't go into firmware
+_NON_BUILD_PATHS = {".github", "docs", "tests"}
+_NON_BUILD_SUFFIXES = (".md", ".rst")
+
+_TOOLCHAIN_VERSION_CMD = (
+    "arm-none-eabi-gcc --version; make --version; python3 --version"
+)
+
+_toolchain_fingerprint = None # pylint: disable=invalid-name
+
+def toolchain_fingerprint(run_env):
+    """ A digest of the compiler, make and python versions available to the
+        firmware build. Only computed once per process.
+
+    :param: run_env: The environment the build runs under.
+    """
+    global _toolchain_fingerprint # pylint: disable=global-statement,invalid-name
+
+    if _toolchain_fingerprint is None:
+        versions = subprocess.run(
+            _TOOLCHAIN_VERSION_CMD,
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            executable=shutil.which("bash"),
+            env=run_env,
+            encoding="utf-8",
+            errors="replace",
+            check=False,
+        ).stdout
+        _toolchain_fingerprint = hashlib.sha256(versions.encode()).hexdigest()
+
+    return _toolchain_fingerprint
+
+def build_key(cirpy_dir, port, board, run_env):
+    """ Computes the cache key for building ``board`` from the checkout in
+        ``cirpy_dir``. The key covers the tree hashes of the shared sources
+        and the board's port (which includes the board directory), the
+        submodule commits, and the toolchain fingerprint. Documentation and
+        test changes don't change the key.
+
+    :param: cirpy_dir: Path to the circuitpython checkout.
+    :param: port: Name of the port directory the board belongs to.
+    :param: board: Name of the board.
+    :param: run_env: The environment the build runs under.
+    """
+    cirpy_git = git.bake("-C", str(cirpy_dir))
+
+    key_parts = [f"recipe {_RECIPE_VERSION}", f"board {board}"]
+
+    for entry in str(cirpy_git("ls-tree", "HEAD")).splitlines():
+        path = entry.split("\t", 1)[1]
+        if (path in _NON_BUILD_PATHS or path == "ports" or
+                path.endswith(_NON_BUILD_SUFFIXES)):
+            continue
+        key_parts.append(entry)
+
+    key_parts.append(str(cirpy_git("ls-tree", "HEAD", f"ports/{port}")))
+    key_parts.append(
+        str(cirpy_git("ls-tree", "HEAD", f"ports/{port}/boards/{board}"))
+    )
+    key_parts.append(str(cirpy_git.submodule("status")))
+    key_parts.append(f"toolchain {toolchain_fingerprint(run_env)}")
+
+    return hashlib.sha256("\n".join(key_parts).encode()).hexdigest()
+
+def _dir_size(path):
+    """ Total size, in bytes, of the files under ``path``. """
+    return sum(
+        item.stat().st_size for item in path.rglob("*") if item.is_file()
+    )
+
+class BuildCache():
+    """ Content-addressed cache of firmware build artifacts. Entries are
+        evicted least recently used first once the cache grows past
+        ``max_size``.
+
+    :param: cache_dir: Directory to store the cached builds.
+    :param: max_size: Size cap, in bytes, for the cache directory.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=2 * 1024**3):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+    def fetch(self, key, build_dir):
+        """ Copies the cached artifacts for ``key`` into ``build_dir``.
+
+        :returns: The entry's metadata dict on a hit, otherwise ``None``.
+        """
+        entry_dir = self.cache_dir / key
+        meta_file = entry_dir / "meta.json"
+
+        try:
+            meta = json.loads(meta_file.read_text())
+            build_dir.mkdir(parents=True, exist_ok=True)
+            for artifact in meta["artifacts"]:
+                shutil.copy2(entry_dir / artifact, build_dir / artifact)
+            # mark as recently used for eviction
+            os.utime(meta_file)
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return meta
+
+    def store(self, key, build_dir, size_lines):
+        """ Stores the ``firmware.*`` artifacts in ``build_dir`` under
+            ``key``, then evicts old entries if needed.
+
+        :param: size_lines: The firmware size lines from the build output,
+                            replayed into the test log on a hit.
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry_dir = self.cache_dir / key
+        if entry_dir.exists():
+            return
+
+        artifacts = sorted(
+            artifact for artifact in build_dir.glob("firmware.*")
+            if artifact.is_file()
+        )
+        if not artifacts:
+            return
+
+        # stage the entry, then rename it into place so a concurrent
+        # ``fetch`` never sees a partial entry.
+        staging_dir = pathlib.Path(
+            tempfile.mkdtemp(prefix=".staging_", dir=self.cache_dir)
+        )
+        try:
+            for artifact in artifacts:
+                shutil.copy2(artifact, staging_dir / artifact.name)
+            meta = {
+                "artifacts": [artifact.name for artifact in artifacts],
+                "size_lines": size_lines,
+                "stored_at": datetime.datetime.utcnow().strftime(
+                    "%Y-%m-%dT%H:%M:%SZ"
+                ),
+            }
+            (staging_dir / "meta.json").write_text(json.dumps(meta))
+            os.rename(staging_dir, entry_dir)
+        except OSError as store_err:
+            rosiepi_logger.warning("Failed to cache build: %s", store_err)
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache fits
+            under ``max_size``.
+        """
+        entries = []
+        total_size = 0
+        for entry_dir in self.cache_dir.iterdir():
+            if entry_dir.name.startswith("."):
+                continue
+            meta_file = entry_dir / "meta.json"
+            if not meta_file.exists():
+                continue
+            size = _dir_size(entry_dir)
+            total_size += size
+            entries.append((meta_file.stat().st_mtime, size, entry_dir))
+
+        entries.sort()
+        while total_size > self.max_size and entries:
+            _, size, entry_dir = entries.pop(0)
+            rosiepi_logger.info("Evicting cached build: %s", entry_dir.name)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
@@ -0,0 +1,202 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import contextlib
+import fcntl
+import itertools
+import logging
+import os
+import pathlib
+import threading
+import time
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+# rough peak memory of a single arm-none-eabi-gcc compile job, used to keep
+# parallel builds from pushing a Pi into swap.
+DEFAULT_MEM_PER_JOB = 256 * 1024 * 1024
+
+DEFAULT_SLOT_DIR = pathlib.Path.home() / "rosie_pi" / "build_slots"
+
+# seconds between looks for a free slot file
+_SLOT_POLL_INTERVAL = 0.5
+
+def available_cores():
+    """ Number of CPU cores this process is allowed to run on. """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def available_memory():
+    """ Memory available for new work, in bytes, from ``/proc/meminfo``.
+        Returns ``None`` if it can't be determined.
+    """
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+class BuildScheduler():
+    """ Hands out ``make`` parallelism to firmware builds. The job budget
+        is the number of cores, capped by how many compile jobs fit in the
+        available memory. Up to ``max_concurrent`` builds may run at once,
+        and they share the budget rather than each taking all of it.
+
+        Without a ``slot_dir``, the builds are only counted within this
+        process. With one, each running build holds a ``flock`` on one of
+        ``max_concurrent`` slot files there, holding its make job count,
+        so schedulers in other processes (forked jobs and board workers)
+        share the same slots and budget. Schedulers sharing a
+        ``slot_dir`` should have the same ``max_concurrent``.
+
+    :param: max_concurrent: The most builds allowed to run at once.
+    :param: mem_per_job: Memory, in bytes, to allow for each compile job.
+    :param: slot_dir: Optional directory for the slot files.
+    """
+
+    def __init__(self, max_concurrent=1, mem_per_job=DEFAULT_MEM_PER_JOB,
+                 slot_dir=None):
+        self.max_concurrent = max(1, max_concurrent)
+        self.mem_per_job = mem_per_job
+        self.slot_dir = pathlib.Path(slot_dir) if slot_dir else None
+
+        self.records = []
+
+        self._active = {}
+        self._tokens = itertools.count()
+        self._condition = threading.Condition()
+
+    def job_budget(self):
+        """ The total number of make jobs the node can run right now. """
+        cores = available_cores()
+        memory = available_memory()
+        if memory is None:
+            return cores
+        return max(1, min(cores, memory // self.mem_per_job))
+
+    def _slot_paths(self):
+        return [
+            self.slot_dir / f"slot-{index}"
+            for index in range(self.max_concurrent)
+        ]
+
+    def _claim_slot_file(self):
+        """ Waits for a free slot file, and locks it.
+
+        :returns: The open, locked slot file.
+        """
+        self.slot_dir.mkdir(parents=True, exist_ok=True)
+        while True:
+            for slot_path in self._slot_paths():
+                slot_file = open(slot_path, "a+")
+                try:
+                    fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return slot_file
+                except BlockingIOError:
+                    slot_file.close()
+            time.sleep(_SLOT_POLL_INTERVAL)
+
+    def _other_slots(self, own_slot):
+        """ The builds running in the other slot files, and their make
+            jobs.
+
+        :returns: A tuple of the number of builds, and their jobs.
+        """
+        builds = 0
+        jobs = 0
+        for slot_path in self._slot_paths():
+            if slot_path.name == pathlib.Path(own_slot.name).name:
+                continue
+            try:
+                with open(slot_path) as slot_file:
+                    try:
+                        # a free slot; the lock goes with the file
+                        fcntl.flock(slot_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                        continue
+                    except BlockingIOError:
+                        pass
+                    builds += 1
+                    jobs += int(slot_file.read().strip() or 0)
+            except (OSError, ValueError):
+                continue
+        return builds, jobs
+
+    @contextlib.contextmanager
+    def slot(self, board):
+        """ Context manager that waits for a free build slot, and yields
+            the number of make jobs the build should use. The job count
+            and wall time are appended to ``records`` when the build
+            finishes.
+
+        :param: board: The board being built, for the records.
+        """
+        token = next(self._tokens)
+        slot_file = None
+        if self.slot_dir is not None:
+            slot_file = self._claim_slot_file()
+
+        with self._condition:
+            if slot_file is None:
+                while len(self._active) >= self.max_concurrent:
+                    self._condition.wait()
+                other_builds = len(self._active)
+                other_jobs = sum(self._active.values())
+            else:
+                other_builds, other_jobs = self._other_slots(slot_file)
+
+            budget = self.job_budget()
+            free_jobs = budget - other_jobs
+            fair_share = max(1, budget // self.max_concurrent)
+            jobs = max(1, min(fair_share, free_jobs))
+            self._active[token] = jobs
+
+            record = {
+                "board": board,
+                "make_jobs": jobs,
+                "job_budget": budget,
+                "concurrent_builds": other_builds + 1,
+            }
+
+        if slot_file is not None:
+            slot_file.truncate(0)
+            slot_file.write(str(jobs))
+            slot_file.flush()
+
+        rosiepi_logger.info("Building %s with %s make job(s)", board, jobs)
+        start_time = time.monotonic()
+        try:
+            yield jobs
+        finally:
+            record["build_seconds"] = round(time.monotonic() - start_time, 2)
+            if slot_file is not None:
+                slot_file.truncate(0)
+                slot_file.close()
+            with self._condition:
+                del self._active[token]
+                self.records.append(record)
+                self._condition.notify_all()
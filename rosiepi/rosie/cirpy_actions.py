@@ -21,44 +21,200 @@
 # THE SOFTWARE.
 #
 
+import collections
+import contextlib
+import gzip
 import logging
 import os
 import pathlib
+import re
+import shutil
+import signal
 import subprocess
+import sys
+import tempfile
+import threading
 import time
 
 import sh
 from sh.contrib import git
 
+from .build_cache import build_key as build_cache_key
+from .build_scheduler import BuildScheduler
+from .device_watch import DeviceWatcher
+from .flash_record import uf2_digest
+from .job_cancel import CancelToken, wait_for_lock
+from .phase_timer import PhaseTimer
+
 rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
 
 _AVAILABLE_PORTS = ["atmel-samd", "nrf"]
 
-def clone_commit(cirpy_dir, commit):
+CIRPY_GIT_URL = "https://github.com/sommersoft/circuitpython.git"
+
+# the most time a board gets to come back after a reset or firmware upload,
+# and the fixed wait used when the board's serial number isn't known.
+_REENUMERATION_TIMEOUT = 20
+_REENUMERATION_DELAY = 10
+
+# lines of build output kept for the error report of a failed build
+_BUILD_TAIL_LINES = 200
+
+# seconds a cancelled build gets to exit after SIGTERM, before SIGKILL
+_BUILD_KILL_GRACE = 3
+
+_BUILD_ENV = {
+    "BASH_ENV": "/etc/profile",
+    "LANG": "en_US.UTF-8",
+    "LC_ALL": "en_US.UTF-8"
+}
+
+# top-level directories that neither the firmware build nor the tests
+# read, left out of sparse checkouts.
+_SPARSE_SKIP_DIRS = ("docs", ".github")
+
+# ``git sparse-checkout`` was added in git 2.25
+_SPARSE_MIN_GIT = (2, 25)
+
+def _git_version():
+    """ The installed git's version, as a tuple of ints. """
+    version = str(git("--version")).split()[2]
+    return tuple(int(part) for part in version.split(".")[:3] if part.isdigit())
+
+def _board_ports(cirpy_git, commit, boards):
+    """ The ports in ``_AVAILABLE_PORTS`` that have at least one of
+        ``boards``, read from the commit's trees so nothing has to be
+        checked out first.
+    """
+    ports = []
+    for port in _AVAILABLE_PORTS:
+        board_dirs = [f"ports/{port}/boards/{board}" for board in boards]
+        if str(cirpy_git("ls-tree", "-d", "--name-only", commit, *board_dirs)):
+            ports.append(port)
+    return ports
+
+def _sparse_dirs(cirpy_git, commit, ports):
+    """ The directories a sparse checkout needs: every top-level directory
+        except ``ports`` and ``_SPARSE_SKIP_DIRS``, plus the needed ports.
+    """
+    top_dirs = str(cirpy_git("ls-tree", "-d", "--name-only", commit)).split()
+    dirs = [
+        name for name in top_dirs
+        if name != "ports" and name not in _SPARSE_SKIP_DIRS
+    ]
+    dirs.extend(f"ports/{port}" for port in ports)
+    return dirs
+
+def _frozen_libraries(cirpy_dir, ports, boards):
+    """ The ``frozen/`` submodules that ``boards`` freeze into their
+        firmware, from each board's ``mpconfigboard.mk``.
+    """
+    frozen = set()
+    for port in ports:
+        for board in boards:
+            board_mk = pathlib.Path(
+                cirpy_dir, "ports", port, "boards", board, "mpconfigboard.mk"
+            )
+            try:
+                board_config = board_mk.read_text()
+            except OSError:
+                continue
+            frozen.update(re.findall(r"\$\(TOP\)/(frozen/[^\s/]+)", board_config))
+    return frozen
+
+def _submodule_filter(ports, frozen):
+    """ A callable that returns whether a submodule path is needed to
+        build for ``ports``: anything under a needed port, the ``frozen``
+        libraries, and the shared submodules outside of ``ports/`` and
+        ``frozen/``.
+    """
+    def include(path):
+        if path.startswith("ports/"):
+            return any(path.startswith(f"ports/{port}/") for port in ports)
+        if path.startswith("frozen/"):
+            return path in frozen
+        return path.split("/")[0] not in _SPARSE_SKIP_DIRS
+
+    return include
+
+def _submodule_paths(cirpy_dir):
+    """ The paths of the submodules listed in ``.gitmodules``. """
+    gitmodules = pathlib.Path(cirpy_dir, ".gitmodules")
+    if not gitmodules.exists():
+        return []
+
+    paths = git.config(
+        "-f", str(gitmodules), "--get-regexp", r"^submodule\..*\.path$",
+        _ok_code=[0, 1]
+    )
+    return [line.split(" ", 1)[1] for line in str(paths).splitlines()]
+
+def clone_commit(cirpy_dir, commit, mirror=None, boards=None, timer=None):
     """ Clones the `circuitpython` repository, fetches the commit, then
         checks out the repo at that ref.
+
+        When ``boards`` is supplied, the checkout is sparse: only the ports
+        with those boards, the shared sources and ``tests/`` are checked
+        out, and only the submodules they use are initialized. Without a
+        mirror, the clone is also blobless, so file contents are only
+        fetched for what gets checked out.
+
+    :param: cirpy_dir: The directory to clone into.
+    :param: commit: The commit to check out.
+    :param: mirror: An optional ``git_mirror.GitMirror``. When supplied, the
+                    checkout borrows objects from the node-local mirror
+                    instead of cloning from GitHub.
+    :param: boards: Optional names of the boards the checkout is for.
+    :param: timer: An optional ``phase_timer.PhaseTimer`` to record the
+                   ``clone_commit`` and ``submodule_update`` spans in.
+
+    :returns: The ports checked out, or ``None`` for a full checkout.
     """
-    working_dir = pathlib.Path()
+    working_dir = pathlib.Path().resolve()
+    if timer is None:
+        timer = PhaseTimer()
+
+    if boards is not None and _git_version() < _SPARSE_MIN_GIT:
+        rosiepi_logger.warning(
+            "git %s is too old for sparse checkouts; checking out everything.",
+            ".".join(str(part) for part in _git_version())
+        )
+        boards = None
 
     rosiepi_logger.info("Cloning repository at reference: %s", commit)
 
     try:
-        git.clone(
-            "--depth",
-            "1",
-            "-n",
-            "https://github.com/sommersoft/circuitpython.git",
-            cirpy_dir
-        )
+        if boards is not None:
+            return _sparse_clone(cirpy_dir, commit, mirror, boards, timer)
+
+        if mirror is not None:
+            with timer.span("clone_commit"):
+                mirror.clone(cirpy_dir, commit)
+                git("-C", cirpy_dir, "checkout", "--quiet", commit)
+            with timer.span("submodule_update"):
+                mirror.checkout_submodules(cirpy_dir)
+            return None
+
+        with timer.span("clone_commit"):
+            git.clone(
+                "--depth",
+                "1",
+                "-n",
+                CIRPY_GIT_URL,
+                cirpy_dir
+            )
+
+            os.chdir(cirpy_dir)
+            git.fetch("origin", commit)
 
-        os.chdir(cirpy_dir)
-        git.fetch("origin", commit)
+            git.checkout(commit)
 
-        git.checkout(commit)
+        with timer.span("submodule_update"):
+            git.submodule("sync")
 
-        git.submodule("sync")
+            git.submodule("update", "--init")
 
-        git.submodule("update", "--init")
+        return None
 
     except sh.ErrorReturnCode as git_err:
         git_stderr = str(git_err.stderr, encoding="utf-8").strip("\n")
@@ -72,79 +228,492 @@ def clone_commit(cirpy_dir, commit):
     finally:
         os.chdir(working_dir)
 
-def build_fw(board, test_log, cirpy_dir): # pylint: disable=too-many-locals,too-many-statements
+def _sparse_clone(cirpy_dir, commit, mirror, boards, timer): # pylint: disable=too-many-arguments
+    """ The sparse checkout for ``clone_commit``. """
+    cirpy_git = git.bake("-C", cirpy_dir)
+
+    with timer.span("clone_commit"):
+        if mirror is not None:
+            mirror.clone(cirpy_dir, commit)
+        else:
+            git.clone(
+                "--filter=blob:none",
+                "--depth",
+                "1",
+                "--no-checkout",
+                CIRPY_GIT_URL,
+                cirpy_dir
+            )
+            cirpy_git("fetch", "--depth", "1", "origin", commit)
+
+        ports = _board_ports(cirpy_git, commit, boards)
+        if not ports:
+            raise RuntimeError(
+                f"None of the boards ({', '.join(boards)}) are in the "
+                f"available ports: {', '.join(_AVAILABLE_PORTS)}"
+            )
+
+        cirpy_git("sparse-checkout", "init", "--cone")
+        cirpy_git(
+            "sparse-checkout", "set", *_sparse_dirs(cirpy_git, commit, ports)
+        )
+        cirpy_git.checkout("--quiet", commit)
+
+    with timer.span("submodule_update"):
+        include = _submodule_filter(
+            ports,
+            _frozen_libraries(cirpy_dir, ports, boards)
+        )
+        if mirror is not None:
+            mirror.checkout_submodules(cirpy_dir, include=include)
+        else:
+            paths = [
+                path for path in _submodule_paths(cirpy_dir) if include(path)
+            ]
+            if paths:
+                cirpy_git.submodule("update", "--init", "--", *paths)
+
+    rosiepi_logger.info("Sparse checkout of ports: %s", ", ".join(ports))
+    return ports
+
+def _checkout_size(checkout_dir):
+    """ Bytes held in the checkout's git directory (the objects fetched
+        for it, including its submodules'), and in its working tree.
+    """
+    git_bytes = 0
+    worktree_bytes = 0
+    git_dir = os.path.join(checkout_dir, ".git")
+    for root, _, files in os.walk(checkout_dir):
+        in_git_dir = root == git_dir or root.startswith(git_dir + os.sep)
+        for name in files:
+            try:
+                size = os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                continue
+            if in_git_dir or name == ".git":
+                git_bytes += size
+            else:
+                worktree_bytes += size
+
+    return git_bytes, worktree_bytes
+
+class CirpyCheckout():
+    """ A job-level checkout of the `circuitpython` repository. The commit
+        is cloned once, and the checkout is then shared by every board's
+        ``TestController`` in the job. Use as a context manager so the
+        checkout is removed after the last board finishes.
+
+    :param: commit: The commit of circuitpython to check out.
+    :param: mirror: An optional ``git_mirror.GitMirror`` to check out from.
+    :param: boards: Optional names of the boards the checkout is for, to
+                    make a sparse checkout of just what they need. See
+                    ``clone_commit``.
+    """
+
+    def __init__(self, commit, mirror=None, boards=None):
+        self.commit = commit
+        self.mirror = mirror
+        self.boards = list(boards) if boards is not None else None
+        self.error = None
+        self.stats = {}
+        self.timer = PhaseTimer()
+        self._prepared = False
+        self._mirror_use = contextlib.ExitStack()
+
+        tmp_prefix = str(f".rosiepi_{commit[:5]}_")
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix=tmp_prefix)
+        self.path = pathlib.Path(self._tmp_dir.name).resolve()
+
+    def __enter__(self):
+        self.prepare()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.cleanup()
+
+    @property
+    def ok(self):
+        """ Whether the checkout was prepared without error. """
+        return self._prepared and self.error is None
+
+    def prepare(self):
+        """ Clones the commit into the checkout directory. Only the first
+            call does any work; later calls return the original result.
+
+        :returns: ``True`` if the checkout is ready, otherwise ``False``
+                  with the failure message stored in ``error``.
+        """
+        if self._prepared:
+            return self.ok
+
+        self._prepared = True
+        rosiepi_logger.info("tmp dir: %s", self.path)
+        sys.path.append(str(self.path))
+
+        if self.mirror is not None:
+            self._mirror_use.enter_context(self.mirror.in_use())
+
+        start_time = time.monotonic()
+        try:
+            ports = clone_commit(
+                str(self.path),
+                self.commit,
+                mirror=self.mirror,
+                boards=self.boards,
+                timer=self.timer
+            )
+        except RuntimeError as clone_err:
+            self.error = clone_err.args[0]
+            return self.ok
+
+        git_bytes, worktree_bytes = _checkout_size(self.path)
+        self.stats = {
+            "mode": "full" if ports is None else "sparse",
+            "ports": ports,
+            "seconds": round(time.monotonic() - start_time, 2),
+            "git_bytes": git_bytes,
+            "worktree_bytes": worktree_bytes,
+        }
+        rosiepi_logger.info("Checkout stats: %s", self.stats)
+
+        return self.ok
+
+    def cleanup(self):
+        """ Removes the checkout directory, along with any modules that
+            were imported from it (e.g. ``tests.pyboard``).
+        """
+        checkout_path = str(self.path)
+        if checkout_path in sys.path:
+            sys.path.remove(checkout_path)
+
+        for name, module in list(sys.modules.items()):
+            module_file = getattr(module, "__file__", None) or ""
+            if module_file.startswith(checkout_path):
+                del sys.modules[name]
+
+        self._tmp_dir.cleanup()
+        self._mirror_use.close()
+        rosiepi_logger.info("Removed tmp dir: %s", self.path)
+
+def _kill_build(fw_build):
+    """ Stops a build started by ``_stream_build``, by signalling its whole
+        process group (make and the compilers it runs): SIGTERM first, then
+        SIGKILL if it is still there after ``_BUILD_KILL_GRACE`` seconds.
+
+    :returns: The ``threading.Timer`` that sends SIGKILL, to be cancelled
+              once the build has been waited on.
+    """
+    def signal_group(signum):
+        # once make has been reaped, its pid (and so the group ID) can be
+        # reused by an unrelated process.
+        if fw_build.poll() is not None:
+            return
+        try:
+            os.killpg(fw_build.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    signal_group(signal.SIGTERM)
+    killer = threading.Timer(
+        _BUILD_KILL_GRACE, signal_group, args=(signal.SIGKILL,)
+    )
+    killer.daemon = True
+    killer.start()
+    return killer
+
+def _stream_build(board_cmd, run_env, transcript_path=None, cancel=None):
+    """ Runs the firmware make recipe, reading its output a line at a time
+        instead of holding the whole transcript in memory. Only the size
+        lines and the last ``_BUILD_TAIL_LINES`` lines are kept.
+
+    :param: transcript_path: Optional path to spool the full output to,
+                             gzip compressed.
+    :param: cancel: An optional ``job_cancel.CancelToken``. Cancelling it
+                    kills the build's process group.
+
+    :returns: The firmware size lines from the build output.
+    :raises: ``subprocess.CalledProcessError`` with the tail of the output,
+             if the build fails, or ``RuntimeError`` if it was cancelled.
+    """
+    size_lines = []
+    output_tail = collections.deque(maxlen=_BUILD_TAIL_LINES)
+
+    if cancel is None:
+        cancel = CancelToken()
+
+    transcript = None
+    if transcript_path is not None:
+        transcript = gzip.open(transcript_path, "wt", encoding="utf-8")
+
+    killers = []
+    try:
+        with subprocess.Popen(
+                board_cmd,
+                shell=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                executable=shutil.which("bash"),
+                start_new_session=True,
+                env=run_env,
+                encoding="utf-8",
+                errors="replace"
+        ) as fw_build, cancel.on_cancel(
+            lambda: killers.append(_kill_build(fw_build))
+        ):
+            for line in fw_build.stdout:
+                if transcript is not None:
+                    transcript.write(line)
+
+                line = line.rstrip("\n")
+                output_tail.append(line)
+                if "bytes" in line:
+                    size_lines.append(line)
+
+            returncode = fw_build.wait()
+
+    finally:
+        for killer in killers:
+            killer.cancel()
+        if transcript is not None:
+            transcript.close()
+
+    if cancel.cancelled:
+        raise RuntimeError("Firmware build cancelled.")
+
+    if returncode:
+        raise subprocess.CalledProcessError(
+            returncode,
+            board_cmd,
+            output="\n".join(output_tail)
+        )
+
+    return size_lines
+
+def _build_mpy_cross(cirpy_dir, run_env, make_jobs, cancel=None):
+    """ Builds the checkout's ``mpy-cross`` ahead of a board's firmware.
+        Every port's make runs ``$(MAKE) -C $(TOP)/mpy-cross`` first, so
+        boards built at the same time from one checkout (in threads or
+        worker processes) would race on ``mpy-cross/build``. The first
+        build holds a lock while it builds ``mpy-cross``; the rest wait,
+        and then find it up to date.
+    """
+    mpy_cross_dir = pathlib.Path(cirpy_dir, "mpy-cross")
+    if not (mpy_cross_dir / "Makefile").exists():
+        return
+
+    with open(mpy_cross_dir / ".rosiepi_build.lock", "a") as lock_file:
+        wait_for_lock(lock_file, cancel)
+        _stream_build(
+            f"make -C {mpy_cross_dir.resolve()} -j{make_jobs}",
+            run_env,
+            cancel=cancel
+        )
+
+def board_port(cirpy_dir, board):
+    """ The port in ``_AVAILABLE_PORTS`` that ``board`` belongs to, or
+        ``None`` if it isn't in any of them.
+    """
+    for port in _AVAILABLE_PORTS:
+        if pathlib.Path(cirpy_dir, "ports", port, "boards", board).exists():
+            return port
+    return None
+
+def firmware_key(cirpy_dir, board):
+    """ The ``build_cache`` key of ``board``'s firmware in the checkout,
+        which identifies the firmware before it is built.
+
+    :returns: The key, or ``None`` if the board isn't in any port.
+    """
+    port = board_port(cirpy_dir, board)
+    if port is None:
+        return None
+    return build_cache_key(cirpy_dir, port, board, _BUILD_ENV)
+
+def build_fw(board, test_log, cirpy_dir, build_cache=None, compiler_cache=None, # pylint: disable=too-many-locals,too-many-statements,too-many-arguments,too-many-branches
+             build_scheduler=None, build_stats=None, log_dir=None, cancel=None):
     """ Builds the firware at `build_ref` for `board`. Firmware will be
         output to `.fw_builds/<build_ref>/<board>/`.
 
     :param: str board: Name of the board to build firmware for.
     :param: str build_ref: The tag/commit to build firmware for.
     :param: test_log: The TestController.log used for output.
+    :param: build_cache: An optional ``build_cache.BuildCache``. On a hit,
+                         the cached artifacts are used and ``make`` is
+                         skipped.
+    :param: compiler_cache: An optional ``compiler_cache.CompilerCache``
+                            to compile through.
+    :param: build_scheduler: The ``build_scheduler.BuildScheduler`` that
+                             sets the build's make parallelism. A
+                             scheduler for a single build is used if not
+                             supplied.
+    :param: build_stats: An optional dict to record build statistics in.
+    :param: log_dir: Optional directory to save the full, compressed build
+                     output in, as ``<board>_build.log.gz``.
+    :param: cancel: An optional ``job_cancel.CancelToken`` that stops the
+                    build.
     """
-    working_dir = os.getcwd()
+    if build_stats is None:
+        build_stats = {}
 
-    cirpy_ports_dir = cirpy_dir / "ports"
+    transcript_path = None
+    if log_dir is not None:
+        transcript_path = pathlib.Path(log_dir, f"{board}_build.log.gz")
 
-    board_port_dir = None
-    for port in _AVAILABLE_PORTS:
-        port_dir = cirpy_ports_dir / port / "boards" / board
-        if port_dir.exists():
-            board_port_dir = (cirpy_ports_dir / port).resolve()
-            rosiepi_logger.info("Board source found: %s", board_port_dir)
-            break
+    working_dir = os.getcwd()
 
-    if board_port_dir is None:
+    port = board_port(cirpy_dir, board)
+    if port is None:
         raise RuntimeError(
             f"'{board}' board not available to test. Can't build firmware."
         )
 
+    board_port_dir = (cirpy_dir / "ports" / port).resolve()
+    rosiepi_logger.info("Board source found: %s", board_port_dir)
+
     build_dir = pathlib.Path(board_port_dir, ".fw_build", board)
 
+    cache_key = None
+    if build_cache is not None:
+        try:
+            cache_key = build_cache_key(
+                cirpy_dir,
+                board_port_dir.name,
+                board,
+                _BUILD_ENV
+            )
+        except sh.ErrorReturnCode as git_err:
+            rosiepi_logger.warning(
+                "Failed to compute build cache key: %s", git_err.stderr
+            )
+
+    if cache_key is not None:
+        cached = build_cache.fetch(cache_key, build_dir)
+        build_stats["build_cache"] = "miss" if cached is None else "hit"
+        if cached is not None:
+            rosiepi_logger.info("Firmware build cache hit: %s", cache_key)
+            test_log.write("Using cached firmware build...")
+            test_log.write(" - " + "\n - ".join(cached["size_lines"]))
+            return build_dir
+
+        rosiepi_logger.info("Firmware build cache miss: %s", cache_key)
+        test_log.write("No cached firmware build for this source.")
+
     board_cmd = (
         f"make -C {board_port_dir.resolve()} BOARD={board} BUILD={build_dir} V=2"
     )
+    run_env = dict(_BUILD_ENV)
+
+    ccache_log = None
+    if compiler_cache is not None and compiler_cache.available:
+        fd, ccache_log = tempfile.mkstemp(prefix=".rosiepi_ccache_")
+        os.close(fd)
+        run_env.update(compiler_cache.build_env(cirpy_dir, ccache_log))
+        board_cmd = f"{board_cmd} {compiler_cache.make_args()}"
+
+    if build_scheduler is None:
+        build_scheduler = BuildScheduler()
 
     test_log.write("Building firmware...")
     try:
-        rosiepi_logger.info("Running make recipe: %s", board_cmd)
-        run_envs = {
-            "BASH_ENV": "/etc/profile",
-            "LANG": "en_US.UTF-8",
-            "LC_ALL": "en_US.UTF-8"
-        }
+        with build_scheduler.slot(board) as make_jobs:
+            board_cmd = f"{board_cmd} -j{make_jobs}"
+            build_stats["make_jobs"] = make_jobs
+            test_log.write(f" - Make jobs: {make_jobs}")
+
+            rosiepi_logger.info("Running make recipe: %s", board_cmd)
+
+            rosiepi_logger.info("Running firmware build...")
+            build_start = time.monotonic()
+            _build_mpy_cross(cirpy_dir, run_env, make_jobs, cancel=cancel)
+            success_msg = _stream_build(
+                board_cmd, run_env, transcript_path, cancel=cancel
+            )
 
-        rosiepi_logger.info("Running firmware build...")
-        fw_build = subprocess.run(
-            board_cmd,
-            check=True,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            executable=sh.which("bash"),
-            start_new_session=True,
-            env=run_envs,
-            encoding="utf-8",
-            errors="replace"
-        )
+        build_seconds = round(time.monotonic() - build_start, 2)
+        build_stats["build_seconds"] = build_seconds
 
-        result = fw_build.stdout.split("\n")
-        success_msg = [line for line in result if "bytes" in line]
         test_log.write(" - " + "\n - ".join(success_msg))
+        test_log.write(f" - Build time: {build_seconds} secs")
         rosiepi_logger.info("Firmware built...")
 
+        if cache_key is not None:
+            build_cache.store(cache_key, build_dir, success_msg)
+
     except subprocess.CalledProcessError as cmd_err:
         err_msg = [
             "Building firmware failed:",
             " - {}".format(cmd_err.stdout.strip("\n")),
         ]
+        if transcript_path is not None:
+            err_msg.append(f" - Full build output: {transcript_path}")
         rosiepi_logger.warning("Firmware build failed...")
         raise RuntimeError("\n".join(err_msg)) from None
 
     finally:
         os.chdir(working_dir)
 
+        if ccache_log is not None:
+            ccache_stats = compiler_cache.read_stats(ccache_log)
+            os.remove(ccache_log)
+            if ccache_stats is not None:
+                build_stats["ccache"] = ccache_stats
+                test_log.write(
+                    f" - Compiler cache: {ccache_stats['hits']} hit(s), "
+                    f"{ccache_stats['misses']} miss(es)"
+                )
+                rosiepi_logger.info("ccache stats: %s", ccache_stats)
+
     return build_dir
 
-def update_fw(board, board_name, fw_path, test_log):
+def _wait_for_board(device_watcher, serial_number, previous, mode, test_log): # pylint: disable=too-many-arguments
+    """ Waits for the board to re-enumerate in ``mode`` after a reset. If
+        the board's serial number isn't known, waits a fixed time instead.
+        A timeout isn't an error here; the next connection attempt will
+        report a board that didn't come back.
+    """
+    if serial_number is None:
+        time.sleep(_REENUMERATION_DELAY)
+        return
+
+    latency = device_watcher.wait_for_reenumeration(
+        serial_number,
+        previous,
+        mode,
+        timeout=_REENUMERATION_TIMEOUT
+    )
+    if latency is None:
+        test_log.write(
+            f" - Timed out waiting for the board to return in {mode} mode."
+        )
+        rosiepi_logger.warning(
+            "Board %s didn't re-enumerate in %s mode", serial_number, mode
+        )
+    else:
+        test_log.write(f" - Board re-enumerated in {latency:.2f} secs")
+        rosiepi_logger.info(
+            "Board %s re-enumerated in %s mode in %.2f secs",
+            serial_number,
+            mode,
+            latency
+        )
+
+def _board_version(board):
+    """ The firmware version string reported by ``board``'s REPL, or
+        ``None`` if it couldn't be read.
+    """
+    try:
+        with board:
+            version = board.exec("import os;print(os.uname().version)")
+    except Exception as version_err: # pylint: disable=broad-except
+        rosiepi_logger.info("Couldn't read board version: %s", version_err)
+        return None
+
+    if isinstance(version, bytes):
+        version = str(version, encoding="utf-8", errors="replace")
+    return version.strip() or None
+
+def update_fw(board, board_name, fw_path, test_log, device_watcher=None, # pylint: disable=too-many-arguments,too-many-branches
+              flash_record=None, force_flash=False, timer=None, cpboard=None):
     """ Resets `board` into bootloader mode, and copies over
         new firmware located at `fw_path`.
 
@@ -152,35 +721,105 @@ def update_fw(board, board_name, fw_path, test_log):
     :param: board_name: The name of the board
     :param: fw_path: File path to the firmware UF2 to copy.
     :param: test_log: The TestController.log used for output.
+    :param: device_watcher: The ``device_watch.DeviceWatcher`` used to wait
+                            for the board to re-enumerate. A watcher on the
+                            system's sysfs is used if not supplied.
+    :param: flash_record: An optional ``flash_record.FlashRecord``. If the
+                          board is recorded as running this exact firmware,
+                          and still reports the same version, the upload is
+                          skipped.
+    :param: force_flash: Upload the firmware even if ``flash_record`` says
+                         the board is already running it.
+    :param: timer: An optional ``phase_timer.PhaseTimer`` to record the
+                   ``bootloader_reset`` and ``uf2_upload`` spans in.
+    :param: cpboard: The ``CPboard`` class to connect to the bootloader
+                     with. Defaults to ``tests.pyboard.CPboard`` from the
+                     checkout.
+
+    :returns: ``True`` if the firmware was uploaded, ``False`` if the
+              upload was skipped.
     """
+    if device_watcher is None:
+        device_watcher = DeviceWatcher()
+    if timer is None:
+        timer = PhaseTimer()
+
+    serial_number = getattr(board, "serial_number", None)
+
+    fw_digest = None
+    if flash_record is not None and serial_number is not None:
+        fw_digest = uf2_digest(fw_path)
+        record = flash_record.get(serial_number)
+        if (not force_flash and record is not None and
+                record["digest"] == fw_digest):
+            version = _board_version(board)
+            if version is not None and version == record["version"]:
+                test_log.write(
+                    " - Board is already running this firmware "
+                    f"({version}). Skipping upload."
+                )
+                rosiepi_logger.info(
+                    "Skipping firmware upload on %s; already flashed with %s",
+                    serial_number,
+                    fw_digest
+                )
+                return False
+
+        # the board's contents are unknown until the upload completes
+        flash_record.forget(serial_number)
+
     try:
-        from tests import pyboard # pylint: disable=import-outside-toplevel
+        if cpboard is None:
+            from tests import pyboard # pylint: disable=import-outside-toplevel
+            cpboard = pyboard.CPboard
 
-        with board:
+        with timer.span("bootloader_reset"), board:
             if not board.bootloader:
                 test_log.write(" - Resetting into bootloader mode...")
+                previous = device_watcher.find(serial_number)
                 board.reset_to_bootloader(repl=True)
-                time.sleep(10)
-
-        boot_board = pyboard.CPboard.from_build_name_bootloader(board_name)
-        with boot_board:
-            test_log.write(
-                " - In bootloader mode. Current bootloader: "
-                f"{boot_board.firmware.info['header']}"
-            )
-            test_log.write(" - Uploading firmware...")
-
-            boot_board.firmware.upload(fw_path)
-
-            time.sleep(10)
-
-        with board:
-            pass
+                _wait_for_board(
+                    device_watcher,
+                    serial_number,
+                    previous,
+                    "bootloader",
+                    test_log
+                )
+
+        with timer.span("uf2_upload"):
+            boot_board = cpboard.from_build_name_bootloader(board_name)
+            with boot_board:
+                test_log.write(
+                    " - In bootloader mode. Current bootloader: "
+                    f"{boot_board.firmware.info['header']}"
+                )
+                test_log.write(" - Uploading firmware...")
+
+                previous = device_watcher.find(serial_number)
+                boot_board.firmware.upload(fw_path)
+
+                _wait_for_board(
+                    device_watcher,
+                    serial_number,
+                    previous,
+                    "circuitpython",
+                    test_log
+                )
+
+            with board:
+                pass
         test_log.write("Firmware upload successful!")
 
+        if fw_digest is not None:
+            version = _board_version(board)
+            if version is not None:
+                flash_record.record(serial_number, fw_digest, version)
+
     except BaseException as brd_err:
         err_msg = [
             "Updating firmware failed:",
             f" - {brd_err.args}",
         ]
         raise RuntimeError("\n".join(err_msg)) from None
+
+    return True
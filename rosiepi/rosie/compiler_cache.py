@@ -0,0 +1,109 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import logging
+import pathlib
+import shutil
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_CCACHE_DIR = pathlib.Path.home() / "rosie_pi" / "ccache"
+
+class CompilerCache():
+    """ A ``ccache`` compiler cache for firmware builds. Paths are
+        normalized relative to the checkout, so builds from different
+        temporary checkout directories share cache entries.
+
+    :param: cache_dir: Directory to hold the ccache store.
+    :param: max_size: Size cap, in bytes, enforced by ccache.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CCACHE_DIR, max_size=5 * 1024**3):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_size = max_size
+
+    @property
+    def available(self):
+        """ Whether ``ccache`` is installed on the node. """
+        return shutil.which("ccache") is not None
+
+    @staticmethod
+    def make_args():
+        """ Arguments to add to the ``make`` command line. ``CROSS_COMPILE``
+            is left for make to expand, so the same override works for any
+            port (and for host builds like mpy-cross).
+        """
+        return "CC='ccache $(CROSS_COMPILE)gcc'"
+
+    def build_env(self, base_dir, stats_log):
+        """ Environment variables that configure ccache for one build.
+
+        :param: base_dir: The root of the circuitpython checkout. Absolute
+                          paths under it are rewritten to relative ones
+                          before hashing.
+        :param: stats_log: File that ccache appends the build's per-compile
+                           results to.
+        """
+        return {
+            "CCACHE_DIR": str(self.cache_dir),
+            "CCACHE_BASEDIR": str(base_dir),
+            "CCACHE_NOHASHDIR": "true",
+            "CCACHE_COMPILERCHECK": "content",
+            "CCACHE_MAXSIZE": f"{self.max_size // (1024 * 1024)}M",
+            "CCACHE_STATSLOG": str(stats_log),
+        }
+
+    @staticmethod
+    def read_stats(stats_log):
+        """ Summarizes a ccache stats log into hit and miss counts.
+
+        :returns: A dict with ``hits``, ``misses`` and ``hit_rate``, or
+                  ``None`` if ccache didn't write any stats. The log file
+                  is created before the build, so an empty one means a
+                  ccache too old to know ``CCACHE_STATSLOG``.
+        """
+        try:
+            lines = pathlib.Path(stats_log).read_text().splitlines()
+        except OSError:
+            return None
+
+        stats_lines = [
+            line for line in lines if line and not line.startswith("#")
+        ]
+        if not stats_lines:
+            return None
+
+        hits = 0
+        misses = 0
+        for line in stats_lines:
+            if line.endswith("cache_hit"):
+                hits += 1
+            elif line.endswith("cache_miss"):
+                misses += 1
+
+        compiled = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / compiled, 3) if compiled else 0.0,
+        }
@@ -0,0 +1,129 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import collections
+import logging
+import pathlib
+import time
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+UsbDevice = collections.namedtuple(
+    "UsbDevice",
+    ["sysfs_path", "serial_number", "busnum", "devnum", "product"]
+)
+
+# what has to be bound under the USB device before it is usable in each
+# mode: the mass storage drive for the bootloader, and both the drive and
+# the serial REPL for CircuitPython.
+_MODE_READY_GLOBS = {
+    "bootloader": ["*:*/host*/target*/*/block/*"],
+    "circuitpython": ["*:*/host*/target*/*/block/*", "*:*/tty/tty*"],
+}
+
+def _read_attr(device_dir, name):
+    """ Reads a sysfs attribute, returning ``None`` if it isn't there. """
+    try:
+        return (device_dir / name).read_text().strip()
+    except OSError:
+        return None
+
+class DeviceWatcher():
+    """ Watches the USB devices in sysfs for a board's serial number, so
+        that firmware updates can wait for the board to re-enumerate
+        instead of sleeping for a fixed time.
+
+    :param: sysfs_root: The root that ``sys/bus/usb/devices`` is found
+                        under. Can point at a fake sysfs tree for testing.
+    :param: poll_interval: Seconds between sysfs scans.
+    """
+
+    def __init__(self, sysfs_root="/", poll_interval=0.1):
+        self.devices_dir = pathlib.Path(sysfs_root, "sys", "bus", "usb", "devices")
+        self.poll_interval = poll_interval
+
+    def find(self, serial_number):
+        """ The currently enumerated USB device with ``serial_number``, or
+            ``None`` if it isn't attached.
+        """
+        try:
+            device_dirs = list(self.devices_dir.iterdir())
+        except OSError:
+            return None
+
+        for device_dir in device_dirs:
+            if _read_attr(device_dir, "serial") != serial_number:
+                continue
+            return UsbDevice(
+                device_dir.resolve(),
+                serial_number,
+                _read_attr(device_dir, "busnum"),
+                _read_attr(device_dir, "devnum"),
+                _read_attr(device_dir, "product"),
+            )
+
+        return None
+
+    @staticmethod
+    def is_ready(device, mode):
+        """ Whether the interfaces ``mode`` needs are bound on ``device``.
+
+        :param: mode: ``bootloader`` or ``circuitpython``.
+        """
+        try:
+            return all(
+                any(device.sysfs_path.glob(pattern))
+                for pattern in _MODE_READY_GLOBS[mode]
+            )
+        except OSError:
+            # the device went away while it was being scanned
+            return False
+
+    def wait_for_reenumeration(self, serial_number, previous, mode,
+                               timeout=20):
+        """ Waits for the board with ``serial_number`` to come back as a new
+            USB enumeration, with the interfaces for ``mode`` bound.
+
+        :param: previous: The ``UsbDevice`` from before the reset, if it
+                          was attached. A device with the same bus and
+                          device number hasn't re-enumerated yet.
+        :param: mode: ``bootloader`` or ``circuitpython``.
+        :param: timeout: Seconds to wait before giving up.
+
+        :returns: The seconds it took, or ``None`` on timeout.
+        """
+        start_time = time.monotonic()
+        while time.monotonic() - start_time < timeout:
+            device = self.find(serial_number)
+            if device is not None:
+                same_device = (
+                    previous is not None and
+                    (device.busnum, device.devnum) ==
+                    (previous.busnum, previous.devnum)
+                )
+                if not same_device and self.is_ready(device, mode):
+                    return time.monotonic() - start_time
+
+            time.sleep(self.poll_interval)
+
+        return None
@@ -0,0 +1,110 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import contextlib
+import datetime
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import pathlib
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_RECORD_FILE = pathlib.Path.home() / "rosie_pi" / "flash_record.json"
+
+def uf2_digest(fw_path):
+    """ SHA-256 digest of the firmware file at ``fw_path``. """
+    digest = hashlib.sha256()
+    with open(fw_path, "rb") as fw_file:
+        for chunk in iter(lambda: fw_file.read(64 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class FlashRecord():
+    """ Per-serial-number record of the last firmware flashed onto each
+        board, along with the version string the board reported after
+        the flash. Shared by every job (and worker process) on the node.
+
+    :param: record_file: The JSON file holding the records.
+    """
+
+    def __init__(self, record_file=DEFAULT_RECORD_FILE):
+        self.record_file = pathlib.Path(record_file)
+
+    @contextlib.contextmanager
+    def _records(self):
+        """ Context manager that yields the records dict while holding the
+            record file's lock, and saves any changes on exit.
+        """
+        self.record_file.parent.mkdir(parents=True, exist_ok=True)
+        lock_file = self.record_file.with_suffix(".lock")
+        with open(lock_file, "a") as lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            try:
+                try:
+                    records = json.loads(self.record_file.read_text())
+                except FileNotFoundError:
+                    records = {}
+                except ValueError:
+                    rosiepi_logger.warning(
+                        "Discarding unreadable flash record: %s",
+                        self.record_file
+                    )
+                    records = {}
+
+                original = dict(records)
+                yield records
+
+                if records != original:
+                    tmp_file = self.record_file.with_suffix(".tmp")
+                    tmp_file.write_text(json.dumps(records, indent=2))
+                    os.replace(tmp_file, self.record_file)
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+    def get(self, serial_number):
+        """ The record for ``serial_number``, or ``None``. """
+        with self._records() as records:
+            return records.get(serial_number)
+
+    def record(self, serial_number, digest, version):
+        """ Records that ``serial_number`` was flashed with the firmware
+            ``digest``, and reported ``version`` afterwards.
+        """
+        with self._records() as records:
+            records[serial_number] = {
+                "digest": digest,
+                "version": version,
+                "flashed_at": datetime.datetime.utcnow().strftime(
+                    "%Y-%m-%dT%H:%M:%SZ"
+                ),
+            }
+
+    def forget(self, serial_number):
+        """ Drops the record for ``serial_number``, so the next job
+            flashes the board regardless.
+        """
+        with self._records() as records:
+            records.pop(serial_number, None)
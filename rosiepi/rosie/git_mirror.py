@@ -0,0 +1,325 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import contextlib
+import fcntl
+import logging
+import os
+import pathlib
+import re
+import shutil
+import time
+import urllib.parse
+
+import sh
+from sh.contrib import git
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_MIRROR_DIR = pathlib.Path.home() / "rosie_pi" / "git_mirror"
+
+_FETCH_REFSPECS = [
+    "+refs/heads/*:refs/heads/*",
+    "+refs/tags/*:refs/tags/*",
+]
+
+# commits that aren't on a branch (e.g. PR heads from forks) are kept
+# reachable under this namespace until the next gc.
+_PIN_NAMESPACE = "refs/rosiepi"
+
+def _dir_size(path):
+    """ Total size, in bytes, of the files under ``path``. """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+@contextlib.contextmanager
+def _flock(lock_path, mode, blocking=True):
+    """ Context manager holding an ``fcntl.flock`` on ``lock_path``.
+        Yields ``False`` instead of blocking when ``blocking`` is ``False``
+        and the lock is already held elsewhere.
+    """
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a") as lock_file:
+        flags = mode if blocking else mode | fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class GitMirror():
+    """ A node-local, incrementally updated bare mirror of the
+        `circuitpython` repository and its submodules. Job checkouts
+        borrow objects from the mirror (``git clone --shared`` and
+        ``git submodule update --reference``), so a new commit only
+        costs a delta fetch.
+
+    :param: url: The upstream repository to mirror.
+    :param: mirror_dir: Directory to hold the mirror repositories.
+    :param: max_size: Size cap, in bytes, for the whole mirror directory.
+    :param: gc_interval: Seconds between ``git gc`` runs.
+    """
+
+    def __init__(self, url, mirror_dir=DEFAULT_MIRROR_DIR,
+                 max_size=4 * 1024**3, gc_interval=7 * 24 * 60 * 60):
+        self.url = url
+        self.mirror_dir = pathlib.Path(mirror_dir)
+        self.max_size = max_size
+        self.gc_interval = gc_interval
+
+        self.repo_path = self.mirror_dir / "circuitpython.git"
+        self.modules_dir = self.mirror_dir / "modules"
+
+        self._update_lock = self.mirror_dir / ".update.lock"
+        self._gc_lock = self.mirror_dir / ".gc.lock"
+        self._gc_stamp = self.mirror_dir / ".last_gc"
+
+    @staticmethod
+    def _has_commit(repo_path, commit):
+        """ Whether ``commit`` exists in the repository at ``repo_path``. """
+        try:
+            git("-C", str(repo_path), "cat-file", "-e", f"{commit}^{{commit}}")
+        except sh.ErrorReturnCode:
+            return False
+        return True
+
+    @staticmethod
+    def _is_repo(repo_path):
+        """ Whether ``repo_path`` holds a readable bare repository. """
+        try:
+            git(f"--git-dir={repo_path}", "rev-parse", "--is-bare-repository")
+        except sh.ErrorReturnCode:
+            return False
+        return True
+
+    @staticmethod
+    def _update_repo(repo_path, url, commit=None):
+        """ Creates or incrementally fetches the bare mirror at
+            ``repo_path``. If ``commit`` still isn't available afterwards,
+            it is fetched directly and pinned. A mirror that git can't read
+            (e.g. an interrupted ``git init``) is removed and created again.
+        """
+        repo_git = git.bake("-C", str(repo_path))
+
+        if repo_path.exists() and not GitMirror._is_repo(repo_path):
+            rosiepi_logger.warning(
+                "Git mirror is corrupt; recreating it: %s", repo_path
+            )
+            if repo_path.is_dir():
+                shutil.rmtree(repo_path)
+            else:
+                repo_path.unlink()
+
+        if not repo_path.exists():
+            rosiepi_logger.info("Creating git mirror: %s", repo_path)
+            git.init("--bare", str(repo_path))
+            repo_git.remote("add", "origin", url)
+            repo_git.config("--unset-all", "remote.origin.fetch")
+            for refspec in _FETCH_REFSPECS:
+                repo_git.config("--add", "remote.origin.fetch", refspec)
+        else:
+            repo_git.remote("set-url", "origin", url)
+
+        repo_git.fetch("--prune", "--quiet", "origin")
+
+        if commit and not GitMirror._has_commit(repo_path, commit):
+            repo_git.fetch(
+                "--quiet",
+                "origin",
+                f"+{commit}:{_PIN_NAMESPACE}/{commit}"
+            )
+
+        # last-use time for the LRU in ``maintain``
+        os.utime(repo_path)
+
+    def _submodule_mirror(self, name):
+        """ Path of the bare mirror for submodule ``name``. """
+        safe_name = re.sub(r"[^A-Za-z0-9._-]", "_", name)
+        return self.modules_dir / f"{safe_name}.git"
+
+    def update(self, commit=None):
+        """ Brings the superproject mirror up to date, making sure that
+            ``commit`` is available.
+        """
+        with _flock(self._update_lock, fcntl.LOCK_EX):
+            self._update_repo(self.repo_path, self.url, commit)
+
+    @contextlib.contextmanager
+    def in_use(self):
+        """ Context manager that holds off ``maintain`` while a checkout
+            is borrowing objects from the mirror.
+        """
+        with _flock(self._gc_lock, fcntl.LOCK_SH):
+            yield self
+
+    def checkout(self, cirpy_dir, commit):
+        """ Checks out ``commit`` into ``cirpy_dir``, borrowing objects from
+            the mirror, then initializes the submodules from their own
+            mirrors. Must be called inside ``in_use``.
+        """
+        self.clone(cirpy_dir, commit)
+
+        cirpy_git = git.bake("-C", cirpy_dir)
+        cirpy_git.checkout("--quiet", commit)
+
+        self.checkout_submodules(cirpy_dir)
+
+    def clone(self, cirpy_dir, commit):
+        """ Clones the mirror into ``cirpy_dir`` without checking anything
+            out, making sure ``commit`` is available. Objects are borrowed
+            from the mirror. Must be called inside ``in_use``.
+        """
+        self.update(commit)
+
+        git.clone("--quiet", "--no-checkout", "--shared",
+                  str(self.repo_path), cirpy_dir)
+
+        cirpy_git = git.bake("-C", cirpy_dir)
+        cirpy_git.remote("set-url", "origin", self.url)
+
+    def _submodules(self, cirpy_dir):
+        """ The (name, path, url) of each submodule in ``.gitmodules``. """
+        gitmodules = pathlib.Path(cirpy_dir, ".gitmodules")
+        if not gitmodules.exists():
+            return []
+
+        paths = git.config(
+            "-f", str(gitmodules), "--get-regexp", r"^submodule\..*\.path$",
+            _ok_code=[0, 1]
+        )
+        submodules = []
+        for line in str(paths).splitlines():
+            key, path = line.split(" ", 1)
+            name = key[len("submodule."):-len(".path")]
+            url = str(git.config(
+                "-f", str(gitmodules), f"submodule.{name}.url"
+            )).strip()
+            if url.startswith(("./", "../")):
+                url = urllib.parse.urljoin(self.url.rstrip("/") + "/", url)
+            submodules.append((name, path, url))
+
+        return submodules
+
+    def checkout_submodules(self, cirpy_dir, include=None):
+        """ Updates each submodule's mirror and initializes the submodule
+            from it.
+
+        :param: include: Optional callable that takes a submodule path and
+                         returns whether it should be initialized.
+        """
+        cirpy_git = git.bake("-C", cirpy_dir)
+        for name, path, url in self._submodules(cirpy_dir):
+            if include is not None and not include(path):
+                continue
+
+            gitlink = str(cirpy_git("ls-tree", "HEAD", path)).split()
+            if not gitlink:
+                continue
+            sub_commit = gitlink[2]
+
+            sub_mirror = self._submodule_mirror(name)
+            with _flock(self._update_lock, fcntl.LOCK_EX):
+                self._update_repo(sub_mirror, url, sub_commit)
+
+            cirpy_git.submodule("init", "--", path)
+            cirpy_git.config(f"submodule.{name}.url", str(sub_mirror))
+            cirpy_git(
+                "-c", "protocol.file.allow=always",
+                "submodule", "update", "--quiet",
+                "--reference", str(sub_mirror),
+                "--", path
+            )
+
+    def maintain(self):
+        """ Periodic upkeep, run between jobs. Runs ``git gc`` on every
+            mirror when the gc interval has elapsed or the size cap is
+            exceeded, then drops the least recently used submodule mirrors
+            until the mirror fits under the cap. Skipped if a checkout is
+            currently using the mirror.
+        """
+        if not self.repo_path.exists():
+            return
+
+        with _flock(self._gc_lock, fcntl.LOCK_EX, blocking=False) as locked:
+            if not locked:
+                rosiepi_logger.info("Git mirror in use; skipping maintenance.")
+                return
+
+            size = _dir_size(self.mirror_dir)
+            try:
+                last_gc = self._gc_stamp.stat().st_mtime
+            except FileNotFoundError:
+                last_gc = 0
+
+            if size <= self.max_size and time.time() - last_gc < self.gc_interval:
+                return
+
+            rosiepi_logger.info("Running git mirror gc (size: %s bytes)", size)
+            repos = [self.repo_path]
+            if self.modules_dir.exists():
+                repos.extend(self.modules_dir.iterdir())
+
+            for repo in repos:
+                repo_git = git.bake("-C", str(repo))
+                try:
+                    pins = str(repo_git(
+                        "for-each-ref", "--format=%(refname)", _PIN_NAMESPACE
+                    )).split()
+                    for pin in pins:
+                        repo_git("update-ref", "-d", pin)
+                    repo_git.gc("--quiet", "--prune=now")
+                except sh.ErrorReturnCode as git_err:
+                    rosiepi_logger.warning(
+                        "git gc failed in %s: %s", repo, git_err.stderr
+                    )
+            self._gc_stamp.touch()
+
+            size = _dir_size(self.mirror_dir)
+            sub_mirrors = []
+            if self.modules_dir.exists():
+                sub_mirrors = sorted(
+                    self.modules_dir.iterdir(),
+                    key=lambda path: path.stat().st_mtime
+                )
+            while size > self.max_size and sub_mirrors:
+                oldest = sub_mirrors.pop(0)
+                size -= _dir_size(oldest)
+                rosiepi_logger.info("Evicting submodule mirror: %s", oldest)
+                shutil.rmtree(oldest, ignore_errors=True)
+
+            if size > self.max_size:
+                rosiepi_logger.warning(
+                    "Git mirror exceeds size cap after gc: %s > %s bytes",
+                    size,
+                    self.max_size
+                )
@@ -0,0 +1,180 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+import contextlib
+import fcntl
+import logging
+import os
+import signal
+import threading
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+# the outcome and check run conclusion of a cancelled board or job
+CANCELLED_OUTCOME = "Cancelled"
+CANCELLED_CONCLUSION = "cancelled"
+
+# seconds between tries for a lock, while also watching for a cancel
+_LOCK_POLL_INTERVAL = 0.2
+
+class JobCancelled(RuntimeError):
+    """ Raised when a job is cancelled while it waits for something. """
+
+class CancelToken():
+    """ Tells a job's stages that the job was cancelled, e.g. because its
+        commit was superseded by a newer push. Long running stages (the
+        firmware build, the pytest session) register a callback with
+        ``on_cancel`` to stop promptly; the others check ``cancelled``
+        between steps.
+
+        ``cancel`` takes locks and runs the callbacks, so it must not be
+        called from a signal handler; ``cancel_on_signals`` calls it from
+        a thread instead.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks = []
+        self.reason = None
+
+    @property
+    def cancelled(self):
+        """ Whether the job has been cancelled. """
+        return self._event.is_set()
+
+    def cancel(self, reason="cancelled"):
+        """ Cancels the job, and runs the registered callbacks. """
+        if self._event.is_set():
+            return
+        self.reason = reason
+        self._event.set()
+        for callback in list(self._callbacks):
+            try:
+                callback()
+            except Exception as callback_err: # pylint: disable=broad-except
+                rosiepi_logger.warning("Cancel callback failed: %s", callback_err)
+
+    def wait(self, timeout=None):
+        """ Waits up to ``timeout`` seconds for the job to be cancelled.
+
+        :returns: Whether the job was cancelled.
+        """
+        return self._event.wait(timeout)
+
+    @contextlib.contextmanager
+    def on_cancel(self, callback):
+        """ Context manager that calls ``callback`` if the job is cancelled
+            while it is open, or straight away if it already has been.
+        """
+        self._callbacks.append(callback)
+        try:
+            if self.cancelled:
+                callback()
+            yield
+        finally:
+            self._callbacks.remove(callback)
+
+def wait_for_lock(lock_fd, cancel=None):
+    """ Waits for an exclusive ``flock`` on ``lock_fd``. A blocking
+        ``flock`` isn't interrupted by signals, so with a ``cancel`` token
+        the lock is polled for instead.
+
+    :raises: ``JobCancelled`` if ``cancel`` is cancelled first.
+    """
+    if cancel is None:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        return
+
+    while True:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            pass
+        if cancel.wait(_LOCK_POLL_INTERVAL):
+            raise JobCancelled(f"Job cancelled ({cancel.reason})")
+
+def _watch_signals(cancel, read_fd, signals):
+    """ Cancels ``cancel`` once one of ``signals`` arrives on ``read_fd``,
+        and returns when the pipe is closed. The wakeup pipe gets every
+        signal the process handles, so the others are ignored.
+    """
+    while True:
+        data = os.read(read_fd, 64)
+        if not data:
+            return
+        for signum in data:
+            if signum not in signals:
+                continue
+            try:
+                signal_name = signal.Signals(signum).name
+            except ValueError:
+                signal_name = str(signum)
+            rosiepi_logger.info(
+                "Received signal %s; cancelling the job.", signal_name
+            )
+            cancel.cancel(f"signal {signal_name}")
+
+@contextlib.contextmanager
+def cancel_on_signals(cancel, signals=(signal.SIGTERM, signal.SIGINT)):
+    """ Context manager that cancels ``cancel`` when the process receives
+        one of ``signals``, instead of exiting, so the job can stop cleanly
+        and still report. The previous handlers are put back on exit.
+        Only the main thread can set signal handlers; elsewhere, or
+        without a ``cancel`` token, this does nothing.
+
+        The signal handler itself does nothing: the interpreter writes the
+        signal number to a wakeup pipe, and a watcher thread does the
+        cancelling. ``cancel`` takes the token's ``Event`` lock, which a
+        handler running on the main thread could already be holding.
+    """
+    main_thread = threading.current_thread() is threading.main_thread()
+    if cancel is None or not main_thread:
+        yield
+        return
+
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(write_fd, False)
+    watcher = threading.Thread(
+        target=_watch_signals,
+        args=(cancel, read_fd, frozenset(signals)),
+        name="rosiepi-cancel-signals",
+        daemon=True
+    )
+    watcher.start()
+
+    previous_wakeup_fd = signal.set_wakeup_fd(write_fd)
+    previous = {
+        signum: signal.signal(signum, lambda signum, _: None)
+        for signum in signals
+    }
+    try:
+        yield
+    finally:
+        for signum, previous_handler in previous.items():
+            signal.signal(signum, previous_handler)
+        signal.set_wakeup_fd(previous_wakeup_fd)
+        os.close(write_fd)
+        watcher.join()
+        os.close(read_fd)
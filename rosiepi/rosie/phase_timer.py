@@ -0,0 +1,172 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+import contextlib
+import datetime
+import os
+import pathlib
+import tempfile
+import time
+
+DEFAULT_METRICS_FILE = (
+    pathlib.Path.home() / "rosie_pi" / "metrics" / "rosiepi.prom"
+)
+
+class PhaseTimer():
+    """ Records how long each phase of a job takes, as a list of spans.
+        Each span is a plain dict, so spans can be sent back from board
+        worker processes and serialized into the results payload.
+
+    :param: labels: Labels added to every span, e.g. ``board``.
+    """
+
+    def __init__(self, **labels):
+        self.labels = labels
+        self.spans = []
+
+    @contextlib.contextmanager
+    def span(self, phase, **labels):
+        """ Context manager that records a span for ``phase``. The span's
+            outcome is ``error`` if the block raises; the exception is
+            not caught.
+
+        :param: phase: The name of the phase, e.g. ``build_fw``.
+        :param: labels: Extra labels for this span.
+        """
+        started_at = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        start_time = time.monotonic()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        finally:
+            self.add(
+                phase,
+                time.monotonic() - start_time,
+                outcome=outcome,
+                started_at=started_at,
+                **labels
+            )
+
+    def add(self, phase, seconds, outcome="ok", started_at=None, **labels):
+        """ Records a span for ``phase`` that was timed elsewhere. """
+        span = {"phase": phase}
+        span.update(self.labels)
+        span.update(labels)
+        span.update({
+            "started_at": started_at,
+            "seconds": round(seconds, 3),
+            "outcome": outcome,
+        })
+        self.spans.append(span)
+
+# span keys that aren't exported as metric labels
+_SPAN_FIELDS = ("phase", "started_at", "seconds", "outcome")
+
+def _label_value(value):
+    """ Escapes a label value for the OpenMetrics text format. """
+    return (
+        str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+        .replace("\n", "\\n")
+    )
+
+def _labels(labels):
+    """ Formats a dict of labels for the OpenMetrics text format. """
+    if not labels:
+        return ""
+    pairs = ",".join(
+        f"{name}=\"{_label_value(value)}\""
+        for name, value in sorted(labels.items())
+    )
+    return f"{{{pairs}}}"
+
+def write_openmetrics(path, spans, **labels):
+    """ Writes a job's spans as an OpenMetrics textfile, e.g. for the
+        node_exporter textfile collector. The file is replaced
+        atomically, so a scrape never sees a partial file.
+
+        Spans with the same phase and labels (e.g. a phase repeated for
+        each board) are summed.
+
+    :param: path: The metrics file to write.
+    :param: spans: The spans, from ``PhaseTimer.spans``.
+    :param: labels: Labels added to every metric, e.g. ``node``.
+    """
+    phases = {}
+    for span in spans:
+        span_labels = dict(labels)
+        span_labels.update(
+            (name, value) for name, value in span.items()
+            if name not in _SPAN_FIELDS and value is not None
+        )
+        span_labels["phase"] = span["phase"]
+        key = tuple(sorted(span_labels.items()))
+        seconds, failed = phases.get(key, (0.0, 0))
+        phases[key] = (
+            seconds + span["seconds"],
+            failed or int(span["outcome"] != "ok")
+        )
+
+    lines = [
+        "# TYPE rosiepi_phase_seconds gauge",
+        "# UNIT rosiepi_phase_seconds seconds",
+        "# HELP rosiepi_phase_seconds Time spent in each phase of the "
+        "latest job.",
+    ]
+    lines.extend(
+        f"rosiepi_phase_seconds{_labels(dict(key))} {seconds:.3f}"
+        for key, (seconds, _) in phases.items()
+    )
+    lines.extend([
+        "# TYPE rosiepi_phase_failed gauge",
+        "# HELP rosiepi_phase_failed Whether a phase of the latest job "
+        "failed.",
+    ])
+    lines.extend(
+        f"rosiepi_phase_failed{_labels(dict(key))} {failed}"
+        for key, (_, failed) in phases.items()
+    )
+    lines.extend([
+        "# TYPE rosiepi_last_job_timestamp_seconds gauge",
+        "# UNIT rosiepi_last_job_timestamp_seconds seconds",
+        "# HELP rosiepi_last_job_timestamp_seconds When the latest job "
+        "finished.",
+        f"rosiepi_last_job_timestamp_seconds{_labels(labels)} "
+        f"{time.time():.3f}",
+        "# EOF",
+    ])
+
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_fd, tmp_path = tempfile.mkstemp(
+        dir=path.parent, prefix=f".{path.name}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(tmp_fd, "w") as tmp_file:
+            tmp_file.write("\n".join(lines) + "\n")
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
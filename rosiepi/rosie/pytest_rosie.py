@@ -21,10 +21,29 @@
 # THE SOFTWARE.
 #
 
+import contextlib
 import platform
+import time
 
 import pytest
 
+from . import test_history
+
+# scopes the ``board`` fixture can be given with ``--rosie-board-scope``
+BOARD_SCOPES = ("function", "module", "session")
+
+# when the board's REPL is soft reset before a test, with ``--rosie-reset``:
+#   always:  before every test.
+#   module:  before the first test of each module, and after a failure.
+#   failure: only after a test fails.
+#   none:    never, apart from the first test.
+# the first test, and tests marked ``rosie_reset``, always get a reset.
+RESET_POLICIES = ("always", "module", "failure", "none")
+
+def _board_scope(fixture_name, config): # pylint: disable=unused-argument
+    """ The ``board`` fixture's scope, from ``--rosie-board-scope``. """
+    return config.getoption("rosie_board_scope")
+
 class RosieTestController():
     """ pytest plugin for interacting with a target board with RosiePi.
     """
@@ -32,9 +51,58 @@ class RosieTestController():
     def __init__(self, test_controller):
         self._controller = test_controller
 
-    def pytest_sessionstart(self):
+        self._reset_policy = "always"
+        self._reset_done = False
+        self._last_module = None
+        self._last_failed = False
+        self._reset_count = 0
+        self._reset_skipped = 0
+        self._reset_secs = 0.0
+
+        self._fail_fast = False
+        self._outcomes = {}
+        self._cancel_hook = contextlib.ExitStack()
+
+    @staticmethod
+    def pytest_addoption(parser):
+        """ pytest hook to add the RosiePi board options. """
+        group = parser.getgroup("rosiepi")
+        group.addoption(
+            "--rosie-board-scope",
+            choices=BOARD_SCOPES,
+            default="function",
+            help="Scope of the board fixture."
+        )
+        group.addoption(
+            "--rosie-reset",
+            choices=RESET_POLICIES,
+            default="always",
+            help="When to soft reset the board's REPL between tests."
+        )
+        group.addoption(
+            "--rosie-fail-fast",
+            action="store_true",
+            help="Stop at the first failing test."
+        )
+
+    def pytest_configure(self, config):
+        """ pytest hook to register the ``rosie_reset`` marker, and read
+            the reset and fail-fast options.
+        """
+        config.addinivalue_line(
+            "markers",
+            "rosie_reset: soft reset the board before this test, whatever "
+            "the reset policy."
+        )
+        self._reset_policy = config.getoption("rosie_reset")
+        self._fail_fast = config.getoption("rosie_fail_fast")
+        if self._fail_fast:
+            config.option.maxfail = 1
+
+    def pytest_sessionstart(self, session):
         """ pytest fixture to inject pytest environment info into the RosiePi
-            log stream.
+            log stream, and to stop the session after the current test if
+            the job is cancelled.
         """
         info_msg = (
             f"pytest session starts -- Python {platform.python_version()} -- "
@@ -42,16 +110,67 @@ class RosieTestController():
         )
         self._controller.log.write(info_msg)
 
+        cancel = self._controller.cancel
+
+        def stop_session():
+            session.shouldstop = f"RosiePi job cancelled ({cancel.reason})"
+
+        self._cancel_hook.enter_context(cancel.on_cancel(stop_session))
+
     def pytest_sessionfinish(self, session, exitstatus):
         """ pytest fixture to update the final pass/fail numbers to the
             RosiePi test controller instance.
         """
+        self._cancel_hook.close()
+
         self._controller.tests_passed = (
             session.testscollected - session.testsfailed
         )
         self._controller.tests_failed = session.testsfailed
         self._controller._result = exitstatus
 
+        cancelled = bool(session.shouldstop) and self._controller.cancel.cancelled
+        if session.shouldfail or cancelled:
+            # tests that never ran didn't pass
+            self._controller.tests_passed = sum(
+                1 for outcome, _ in self._outcomes.values()
+                if outcome == "passed"
+            )
+            not_run = session.testscollected - len(self._outcomes)
+            if cancelled:
+                self._controller.log.write(
+                    f"{session.shouldstop}; {not_run} test(s) not run"
+                )
+                self._controller.state = "cancelled"
+            else:
+                self._controller.log.write(
+                    f"Stopped at the first failure; {not_run} test(s) not run"
+                )
+
+        history = self._controller.history
+        if history is not None:
+            history.record(
+                self._controller.board_name,
+                self._controller.build_ref,
+                self._outcomes
+            )
+
+        reset_stats = {
+            "policy": self._reset_policy,
+            "resets": self._reset_count,
+            "skipped": self._reset_skipped,
+            "reset_secs": round(self._reset_secs, 2),
+        }
+        self._controller.reset_stats = reset_stats
+        if self._reset_count or self._reset_skipped:
+            average = self._reset_secs / max(1, self._reset_count)
+            self._controller.log.write(
+                f"Board resets ({self._reset_policy}): "
+                f"{self._reset_count} reset(s) in "
+                f"{self._reset_secs:.2f} secs ({average:.2f} secs each), "
+                f"{self._reset_skipped} skipped"
+            )
+
     def pytest_collectreport(self, report):
         """ pytest fixture to update the number of tests collected to
             the RosiePi test controller instance.
@@ -68,6 +187,43 @@ class RosieTestController():
             f"Collected {self._controller.tests_collected} tests\n\n"
         )
 
+    def pytest_collection_modifyitems(self, items):
+        """ pytest hook to run recently failing tests first, using the
+            board's test history.
+        """
+        history = self._controller.history
+        if history is None or not items:
+            return
+
+        stats = history.stats(self._controller.board_name)
+        if not stats:
+            return
+
+        by_nodeid = {item.nodeid: item for item in items}
+        ordered = test_history.order_tests(list(by_nodeid), stats)
+        items[:] = [by_nodeid[nodeid] for nodeid in ordered]
+
+        failing = sum(
+            1 for nodeid in ordered
+            if nodeid in stats and stats[nodeid].last_failure is not None
+        )
+        if failing:
+            self._controller.log.write(
+                f"Running {failing} recently failing test(s) first"
+            )
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_collection(self):
+        """ pytest hook to time the test collection. """
+        with self._controller.timer.span("pytest_collection"):
+            yield
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtestloop(self):
+        """ pytest hook to time the test run. """
+        with self._controller.timer.span("pytest_run"):
+            yield
+
     #def pytest_report_collectionfinish(self, startdir):
     #    """ pytest fixutre to inject the root directory into the RosiePi log.
     #    """
@@ -77,6 +233,18 @@ class RosieTestController():
         """ pytest fixture to inject each test's location, outcome, and
             duration into the RosiePi log stream.
         """
+        if report.failed:
+            self._last_failed = True
+
+        # one outcome per test, the worst of its setup, call and teardown
+        if report.when == "call":
+            self._outcomes[report.nodeid] = (report.outcome, report.duration)
+        elif report.failed:
+            duration = self._outcomes.get(report.nodeid, (None, 0.0))[1]
+            self._outcomes[report.nodeid] = ("error", duration)
+        elif report.skipped:
+            self._outcomes[report.nodeid] = ("skipped", 0.0)
+
         if report.when == "call":
             call_line = (
                 f"{report.outcome.upper():<8} "
@@ -100,10 +268,49 @@ class RosieTestController():
         """
         return self._controller.board_name
 
-    @pytest.fixture()
+    def _needs_reset(self, item):
+        """ Whether the board should be reset before ``item`` runs. """
+        if not self._reset_done:
+            return True
+        if item.get_closest_marker("rosie_reset") is not None:
+            return True
+        if self._reset_policy == "always":
+            return True
+        if self._reset_policy == "none":
+            return False
+        if self._last_failed:
+            return True
+        return (
+            self._reset_policy == "module" and
+            item.module is not self._last_module
+        )
+
+    @pytest.fixture(autouse=True)
+    def _rosie_board_reset(self, request):
+        """ Fixture that soft resets the board's REPL before each test
+            that uses the ``board`` fixture, as the reset policy allows,
+            and times the resets.
+        """
+        if "board" in request.fixturenames:
+            if self._needs_reset(request.node):
+                reset_start = time.monotonic()
+                # reset through the ``board`` fixture's open connection
+                request.getfixturevalue("board").repl.reset()
+                self._reset_secs += time.monotonic() - reset_start
+                self._reset_count += 1
+                self._reset_done = True
+                self._last_failed = False
+            else:
+                self._reset_skipped += 1
+            self._last_module = request.node.module
+        yield
+
+    @pytest.fixture(scope=_board_scope)
     def board(self):
-        """ Fixture that provides the current board interface.
+        """ Fixture that provides the current board interface, with its
+            serial connection held open for the fixture's scope. The board
+            is reset by ``_rosie_board_reset``, according to the reset
+            policy.
         """
         with self._controller.board as board:
-            board.repl.reset()
-        return self._controller.board
+            yield board
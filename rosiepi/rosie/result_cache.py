@@ -0,0 +1,250 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+
+from sh.contrib import git
+
+from .. import __version__
+from .cirpy_actions import firmware_key as firmware_build_key
+from .job_cancel import wait_for_lock
+from .test_impact import ROSIE_TESTS_PATH
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_CACHE_DIR = pathlib.Path.home() / "rosie_pi" / "result_cache"
+
+# only a pass is reliably a property of the commit. A failure may be a
+# flaky test or the board, which re-running the check is meant to retry,
+# so failures are only cached when asked for; an ``Error`` never is.
+CACHEABLE_OUTCOMES = ("Passed",)
+CACHEABLE_FAILURE_OUTCOMES = ("Failed",)
+
+_LOCK_DIR_NAME = ".locks"
+
+def suite_digest(cirpy_dir):
+    """ The git tree hash of the ``rosie_tests`` in the checkout. """
+    return str(
+        git("-C", str(cirpy_dir), "rev-parse", f"HEAD:{ROSIE_TESTS_PATH}")
+    ).strip()
+
+def result_key(cirpy_dir, commit, board, test_files=None, fail_fast=False): # pylint: disable=too-many-arguments
+    """ Computes the cache key for testing ``board`` at ``commit``. The key
+        covers the commit, the board, the ``rosie_tests`` tree, the tests
+        selected to run, whether the run stops at the first failure, the
+        firmware build key (sources and toolchain) and the RosiePi version
+        running the tests.
+
+    :param: cirpy_dir: Path to the circuitpython checkout of ``commit``.
+    :param: commit: The commit being tested.
+    :param: board: Name of the board.
+    :param: test_files: The test files selected to run, e.g. from
+                        ``test_impact``, or ``None`` for every test.
+    :param: fail_fast: Whether the tests stop at the first failure.
+
+    :returns: The key, or ``None`` if the board isn't in the checkout.
+    """
+    firmware_key = firmware_build_key(cirpy_dir, board)
+    if firmware_key is None:
+        return None
+
+    key_parts = [
+        f"commit {commit}",
+        f"board {board}",
+        f"rosiepi {__version__}",
+        f"suite {suite_digest(cirpy_dir)}",
+        f"tests {' '.join(test_files) if test_files is not None else '*'}",
+        f"fail_fast {bool(fail_fast)}",
+        f"firmware {firmware_key}",
+    ]
+    return hashlib.sha256("\n".join(key_parts).encode()).hexdigest()
+
+class ResultCache():
+    """ Node-local cache of each board's results, so a commit that is sent
+        again (a re-requested check run, or the same commit on another PR)
+        is answered without building, flashing or testing. Identical jobs
+        running at the same time are coalesced: the first holds the key's
+        lock until its results are stored, and the rest wait for them.
+
+    :param: cache_dir: Directory to store the results in.
+    :param: ttl: Seconds a result is reused for.
+    :param: cache_failures: Also reuse failed results, instead of testing
+                            the board again.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl=24 * 60 * 60,
+                 cache_failures=False):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.ttl = ttl
+        self.cache_failures = cache_failures
+
+    @property
+    def outcomes(self):
+        """ The board outcomes that are stored. """
+        if self.cache_failures:
+            return CACHEABLE_OUTCOMES + CACHEABLE_FAILURE_OUTCOMES
+        return CACHEABLE_OUTCOMES
+
+    def lock(self, key, cancel=None):
+        """ Waits for any job already running ``key`` to finish, and takes
+            the key. Hold it from checking the cache until the results are
+            stored.
+
+        :param: cancel: An optional ``job_cancel.CancelToken`` that stops
+                        the wait.
+
+        :returns: The held lock, to pass to ``release``.
+        :raises: ``job_cancel.JobCancelled`` if the job is cancelled while
+                 waiting.
+        """
+        lock_dir = self.cache_dir / _LOCK_DIR_NAME
+        lock_dir.mkdir(parents=True, exist_ok=True)
+        lock_path = lock_dir / f"{key}.lock"
+        lock_fd = open(lock_path, "a")
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            rosiepi_logger.info(
+                "Waiting for a running job with the same results: %s", key
+            )
+            wait_start = time.monotonic()
+            try:
+                wait_for_lock(lock_fd, cancel)
+            except BaseException:
+                lock_fd.close()
+                raise
+            rosiepi_logger.info(
+                "Waited %.1f secs for %s",
+                time.monotonic() - wait_start,
+                key
+            )
+        # marks the lock as in use for ``prune``
+        os.utime(lock_path)
+        return lock_fd
+
+    @staticmethod
+    def release(lock_fd):
+        """ Frees a key taken with ``lock``. """
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        finally:
+            lock_fd.close()
+
+    def _expired(self, stored_at):
+        return time.time() - stored_at > self.ttl
+
+    def fetch(self, key):
+        """ The stored results for ``key``, if there are any younger than
+            ``ttl``.
+
+        :returns: The entry's dict, with ``log_path`` pointing at the
+                  compressed board log, or ``None``.
+        """
+        entry_dir = self.cache_dir / key
+        try:
+            entry = json.loads((entry_dir / "result.json").read_text())
+            stored_at = entry["stored_at"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+        if self._expired(stored_at):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+        if entry.get("outcome") not in self.outcomes:
+            return None
+
+        entry["log_path"] = entry_dir / "rosie_log.gz"
+        return entry
+
+    def store(self, key, board_results, check_run_id):
+        """ Stores a board's results under ``key``, replacing any older
+            entry. Results with an outcome outside ``outcomes`` aren't
+            stored.
+
+        :param: board_results: The board's results from ``run_rosie``,
+                               with the ``TestResultStream`` log.
+        :param: check_run_id: The check run the results came from.
+        """
+        if board_results["outcome"] not in self.outcomes:
+            return
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry_dir = self.cache_dir / key
+
+        # stage the entry, then rename it into place so a concurrent
+        # ``fetch`` never sees a partial entry.
+        staging_dir = pathlib.Path(
+            tempfile.mkdtemp(prefix=".staging_", dir=self.cache_dir)
+        )
+        try:
+            board_results["rosie_log"].save(staging_dir / "rosie_log.gz")
+            entry = {
+                "board_name": board_results["board_name"],
+                "outcome": board_results["outcome"],
+                "tests_passed": board_results["tests_passed"],
+                "tests_failed": board_results["tests_failed"],
+                "check_run_id": check_run_id,
+                "stored_at": time.time(),
+            }
+            (staging_dir / "result.json").write_text(json.dumps(entry))
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(staging_dir, entry_dir)
+        except OSError as store_err:
+            rosiepi_logger.warning("Failed to cache results: %s", store_err)
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            return
+
+        self.prune()
+
+    def prune(self):
+        """ Removes expired entries, and lock files unused for longer than
+            ``ttl``.
+        """
+        for entry_dir in self.cache_dir.iterdir():
+            if entry_dir.name.startswith("."):
+                continue
+            try:
+                stored_at = json.loads(
+                    (entry_dir / "result.json").read_text()
+                )["stored_at"]
+            except (OSError, ValueError, KeyError):
+                continue
+            if self._expired(stored_at):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+
+        lock_dir = self.cache_dir / _LOCK_DIR_NAME
+        for lock_path in lock_dir.glob("*.lock"):
+            try:
+                if self._expired(lock_path.stat().st_mtime):
+                    lock_path.unlink()
+            except OSError:
+                continue
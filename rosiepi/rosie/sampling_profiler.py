@@ -0,0 +1,200 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+# files written next to the job log by ``SamplingProfiler.save``
+COLLAPSED_FILE = "profile.collapsed"
+SUMMARY_FILE = "profile.txt"
+
+class SamplingProfiler():
+    """ Low overhead sampling profiler. A background thread takes the
+        stack of every other thread in the process each ``interval``
+        seconds, so the sampled code runs unmodified, including time
+        blocked on serial ports, ``sh`` subprocesses and pytest hooks.
+
+        Stacks are kept as counts, and written in the collapsed stack
+        format (one ``frame;frame;frame count`` line per stack) that
+        ``flamegraph.pl`` and speedscope read. Each stack starts with
+        the thread's name.
+
+        Only this process is sampled; board worker processes (the
+        ``process`` execution mode) are not.
+
+    :param: interval: Seconds between samples.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self.duration = 0.0
+        self._stacks = collections.Counter()
+        self._labels = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_time = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+    def start(self):
+        """ Starts sampling. """
+        self._stop.clear()
+        self._start_time = time.monotonic()
+        self._thread = threading.Thread(
+            target=self._run,
+            name="rosiepi-profiler",
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """ Stops sampling. Samples taken so far are kept. """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.duration += time.monotonic() - self._start_time
+
+    def _label(self, code):
+        """ The collapsed stack label for a code object, cached, since
+            the same few hundred functions make up nearly every sample.
+        """
+        label = self._labels.get(code)
+        if label is None:
+            label = (
+                f"{code.co_name} "
+                f"({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            ).replace(";", ":")
+            self._labels[code] = label
+        return label
+
+    def _run(self):
+        """ The sampling loop. """
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            thread_names = {
+                thread.ident: thread.name for thread in threading.enumerate()
+            }
+            for thread_id, frame in sys._current_frames().items(): # pylint: disable=protected-access
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                stack.reverse()
+                self._stacks[tuple(stack)] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """ The sampled stacks in the collapsed stack format. """
+        return "".join(
+            f"{';'.join(stack)} {count}\n"
+            for stack, count in self._stacks.most_common()
+        )
+
+    def summary(self, top=20):
+        """ The ``top`` functions by samples spent in the function itself
+            (``self``), and in it or anything it called (``total``).
+
+        :returns: A dict, ready for serializing as JSON.
+        """
+        self_counts = collections.Counter()
+        total_counts = collections.Counter()
+        stack_samples = 0
+        for stack, count in self._stacks.items():
+            stack_samples += count
+            self_counts[stack[-1]] += count
+            for frame in set(stack[1:]):
+                total_counts[frame] += count
+
+        def ranked(counts):
+            return [
+                {
+                    "frame": frame,
+                    "samples": count,
+                    "percent": round(100 * count / max(1, stack_samples), 1),
+                }
+                for frame, count in counts.most_common(top)
+            ]
+
+        return {
+            "samples": self.samples,
+            "interval": self.interval,
+            "seconds": round(self.duration, 2),
+            "self": ranked(self_counts),
+            "total": ranked(total_counts),
+        }
+
+    def format_summary(self, top=20):
+        """ The ``summary`` as text. """
+        summary = self.summary(top)
+        lines = [
+            f"{summary['samples']} samples every "
+            f"{summary['interval'] * 1000:.0f} ms over "
+            f"{summary['seconds']:.2f} secs",
+        ]
+        for kind in ("self", "total"):
+            lines.append("")
+            lines.append(f"Top {top} by {kind} samples:")
+            lines.extend(
+                f"{entry['percent']:6.1f}% {entry['samples']:>8}  "
+                f"{entry['frame']}"
+                for entry in summary[kind]
+            )
+        return "\n".join(lines) + "\n"
+
+    def save(self, output_dir, top=20):
+        """ Writes the collapsed stacks and the text summary into
+            ``output_dir``, as ``COLLAPSED_FILE`` and ``SUMMARY_FILE``.
+
+        :returns: The paths of the two files.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        collapsed_path = os.path.join(output_dir, COLLAPSED_FILE)
+        with open(collapsed_path, "w") as collapsed_file:
+            collapsed_file.write(self.collapsed())
+
+        summary_path = os.path.join(output_dir, SUMMARY_FILE)
+        with open(summary_path, "w") as summary_file:
+            summary_file.write(self.format_summary(top))
+
+        rosiepi_logger.info(
+            "Profile written: %s, %s", collapsed_path, summary_path
+        )
+        return collapsed_path, summary_path
@@ -0,0 +1,819 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+import argparse
+import builtins
+import collections
+import contextlib
+import hashlib
+import io
+import json
+import logging
+import os
+import pathlib
+import random
+import select
+import shutil
+import signal
+import struct
+import termios
+import threading
+import time
+import traceback
+import tty
+import types
+
+from .device_watch import DeviceWatcher
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+cli_parser = argparse.ArgumentParser(
+    description="Run simulated CircuitPython boards on pseudo-terminals"
+)
+cli_parser.add_argument(
+    "boards",
+    nargs="+",
+    help="Names of the boards to simulate."
+)
+cli_parser.add_argument(
+    "--root",
+    default="rosie_sim",
+    help="Directory for the boards' drives, state and fake sysfs."
+)
+
+# seconds each simulated delay takes by default. ``flash_bytes_per_sec``
+# is how fast the bootloader writes a UF2, and ``byte_time`` delays each
+# byte the REPL sends, to model a slow serial link.
+DEFAULT_LATENCY = {
+    "connect": 0.05,
+    "exec": 0.01,
+    "soft_reset": 0.05,
+    "reenumerate": 0.1,
+    "flash_bytes_per_sec": 2 * 1024 * 1024,
+    "byte_time": 0.0,
+}
+
+# the chance of each injected failure:
+#   exec_error:  a raw REPL command fails with an ``OSError``.
+#   exec_hang:   a raw REPL command never answers.
+#   flash_fail:  the bootloader rejects a UF2, and stays in the bootloader.
+#   slow_enumerate: the board takes ten times as long to come back.
+FAILURES = ("exec_error", "exec_hang", "flash_fail", "slow_enumerate")
+
+_RAW_PROMPT = b"raw REPL; CTRL-B to exit\r\n>"
+_SOFT_REBOOT = b"soft reboot\r\n"
+_CTRL_A, _CTRL_B, _CTRL_C, _CTRL_D = b"\x01", b"\x02", b"\x03", b"\x04"
+
+_UF2_MAGIC_START = (0x0A324655, 0x9E5D5157)
+_UF2_MAGIC_END = 0x0AB16F30
+_UF2_BLOCK_SIZE = 512
+
+# modules the simulated REPL imports from the host; anything else that
+# isn't simulated is a stub, so tests written for real hardware run.
+_HOST_MODULES = ("collections", "gc", "math", "random", "struct", "time")
+
+def check_uf2(data):
+    """ Checks that ``data`` is a well formed UF2 image. Data without the
+        UF2 magic is taken as a raw image, and accepted as-is.
+
+    :returns: ``None`` if the image is acceptable, or why it isn't.
+    """
+    if len(data) < _UF2_BLOCK_SIZE or struct.unpack_from(
+            "<II", data) != _UF2_MAGIC_START:
+        return None
+    if len(data) % _UF2_BLOCK_SIZE:
+        return "UF2 size isn't a whole number of blocks"
+
+    total_blocks = len(data) // _UF2_BLOCK_SIZE
+    for index in range(total_blocks):
+        offset = index * _UF2_BLOCK_SIZE
+        start = struct.unpack_from("<II", data, offset)
+        block_no, num_blocks = struct.unpack_from("<II", data, offset + 20)
+        end = struct.unpack_from("<I", data, offset + 508)[0]
+        if start != _UF2_MAGIC_START or end != _UF2_MAGIC_END:
+            return f"UF2 block {index} has a bad magic number"
+        if block_no != index or num_blocks != total_blocks:
+            return f"UF2 block {index} is out of sequence"
+    return None
+
+class _Reboot(Exception):
+    """ Raised by the simulated ``microcontroller.reset()``. """
+
+    def __init__(self, bootloader):
+        super().__init__("reset")
+        self.bootloader = bootloader
+
+class _StubModule(types.ModuleType):
+    """ A module whose every attribute is a stub, standing in for hardware
+        modules the simulation doesn't model.
+    """
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        stub = _StubModule(f"{self.__name__}.{name}")
+        setattr(self, name, stub)
+        return stub
+
+    def __call__(self, *args, **kwargs):
+        return _StubModule(f"{self.__name__}()")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
+
+class SimBoard():
+    """ A simulated CircuitPython board. Its REPL is a pseudo-terminal
+        that speaks the raw REPL protocol (``Ctrl-A`` to enter, code ended
+        with ``Ctrl-D``, answered with ``OK``, the output and the error,
+        each ended with ``Ctrl-D``), and its drive is a directory. Code is
+        run on the host, with ``os``, ``board`` and ``microcontroller``
+        simulated.
+
+        ``microcontroller.reset()`` after
+        ``microcontroller.on_next_reset(microcontroller.RunMode.BOOTLOADER)``
+        drops the REPL and brings the board back in bootloader mode, where
+        a UF2 copied onto the drive is flashed, and the board comes back
+        running it, on a new pseudo-terminal.
+
+        The board's current mode and terminal are kept in ``state.json``
+        in its directory, and its USB device in a fake sysfs tree, so
+        ``SimCPboard`` and ``DeviceWatcher`` work from any process.
+
+    :param: name: The board's name.
+    :param: index: The board's USB port number, unique in its farm.
+    :param: board_dir: Directory for the board's drive and state.
+    :param: sysfs_root: Root of the fake sysfs tree.
+    :param: latency: Simulated delays; see ``DEFAULT_LATENCY``.
+    :param: failures: The chance of each of ``FAILURES``.
+    :param: seed: Seed for the failure injection.
+    """
+
+    def __init__(self, name, index, board_dir, sysfs_root, latency=None, # pylint: disable=too-many-arguments
+                 failures=None, seed=0):
+        self.name = name
+        self.index = index
+        self.serial_number = f"SIM{index:05d}"
+        self.board_dir = pathlib.Path(board_dir)
+        self.drive_dir = self.board_dir / "drive"
+        self.sysfs_root = pathlib.Path(sysfs_root)
+        self.latency = dict(DEFAULT_LATENCY)
+        self.latency.update(latency or {})
+        self.failures = dict(failures or {})
+        self._random = random.Random(f"{seed}-{name}")
+
+        self.mode = "circuitpython"
+        self.version = "sim-unknown"
+        self.tty_path = None
+        self.stats = collections.Counter()
+
+        self._devnum = index
+        self._master = None
+        self._slave = None
+        self._raw = False
+        self._code = bytearray()
+        self._namespace = {}
+        self._next_reset = "normal"
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _fails(self, failure):
+        """ Whether the injected ``failure`` happens this time. """
+        chance = self.failures.get(failure, 0)
+        return chance > 0 and self._random.random() < chance
+
+    def start(self):
+        """ Brings the board up in CircuitPython mode. """
+        self.drive_dir.mkdir(parents=True, exist_ok=True)
+        self._enumerate("circuitpython")
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name=f"sim-{self.name}",
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """ Shuts the board down. """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._close_tty()
+
+    def _open_tty(self):
+        """ Opens a new pseudo-terminal for the REPL. The slave end is kept
+            open, so the master doesn't see a hangup between clients.
+        """
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.tty_path = os.ttyname(self._slave)
+        self._raw = False
+        self._code = bytearray()
+
+    def _close_tty(self):
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+        self.tty_path = None
+
+    def _save_state(self):
+        """ Writes the board's state for clients in other processes. """
+        state_file = self.board_dir / "state.json"
+        tmp_file = state_file.with_suffix(".tmp")
+        tmp_file.write_text(json.dumps({
+            "serial_number": self.serial_number,
+            "mode": self.mode,
+            "tty": self.tty_path,
+            "version": self.version,
+            "drive": str(self.drive_dir),
+            "connect_latency": self.latency["connect"],
+        }))
+        os.replace(tmp_file, state_file)
+
+    def _enumerate(self, mode):
+        """ Brings the board up in ``mode``, as a new USB device. """
+        self._close_tty()
+        self.mode = mode
+        self._devnum += 1
+
+        for path in self.drive_dir.iterdir():
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+        if mode == "bootloader":
+            (self.drive_dir / "INFO_UF2.TXT").write_text(
+                "UF2 Bootloader (simulated)\r\n"
+                f"Model: {self.name}\r\nBoard-ID: SIM-{self.name}\r\n"
+            )
+        else:
+            self._open_tty()
+            self._namespace = {}
+            (self.drive_dir / "boot_out.txt").write_text(
+                f"Adafruit CircuitPython {self.version}; {self.name}\n"
+            )
+
+        devices = self.sysfs_root / "sys" / "bus" / "usb" / "devices"
+        device = devices / f"1-{self.index}"
+        # built outside ``devices`` so it appears complete, in one step
+        staging = self.sysfs_root / f".staging-1-{self.index}"
+        self._unplug()
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        (staging / "serial").write_text(self.serial_number)
+        (staging / "busnum").write_text("1")
+        (staging / "devnum").write_text(str(self._devnum))
+        (staging / "product").write_text(self.name)
+        (staging / f"1-{self.index}:1.0" / "host0" / "target0:0:0"
+         / "0:0:0:0" / "block" / "sda").mkdir(parents=True)
+        if mode == "circuitpython":
+            (staging / f"1-{self.index}:1.1" / "tty"
+             / f"ttyACM{self.index}").mkdir(parents=True)
+        # the state is written first, so clients that see the device also
+        # see its new mode and terminal
+        self._save_state()
+        devices.mkdir(parents=True, exist_ok=True)
+        os.replace(staging, device)
+
+        self.stats[f"enumerate_{mode}"] += 1
+
+    def _unplug(self):
+        """ Removes the board's USB device from the fake sysfs, in one step
+            like the kernel does.
+        """
+        devices = self.sysfs_root / "sys" / "bus" / "usb" / "devices"
+        removed = self.sysfs_root / f".removed-1-{self.index}"
+        try:
+            os.replace(devices / f"1-{self.index}", removed)
+        except FileNotFoundError:
+            return
+        shutil.rmtree(removed, ignore_errors=True)
+
+    def _reenumerate(self, mode):
+        """ Drops off the bus for the re-enumeration time, then comes back
+            in ``mode``.
+        """
+        self._close_tty()
+        self._unplug()
+        self.mode = "offline"
+        self._save_state()
+
+        delay = self.latency["reenumerate"]
+        if self._fails("slow_enumerate"):
+            delay *= 10
+        self._stop.wait(delay)
+        self._enumerate(mode)
+
+    def _write(self, data):
+        """ Sends ``data`` to the REPL client. """
+        if self._master is None:
+            return
+        byte_time = self.latency["byte_time"]
+        try:
+            if byte_time:
+                for byte in data:
+                    os.write(self._master, bytes([byte]))
+                    time.sleep(byte_time)
+            else:
+                os.write(self._master, data)
+        except OSError:
+            pass
+
+    def _run(self):
+        """ Serves the REPL, and the drive in bootloader mode. """
+        while not self._stop.is_set():
+            if self.mode == "bootloader":
+                self._serve_drive()
+                self._stop.wait(0.02)
+                continue
+            if self._master is None:
+                self._stop.wait(0.02)
+                continue
+
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                continue
+            for byte in data:
+                self._handle(bytes([byte]))
+                if self._master is None:
+                    break
+
+    def _handle(self, char): # pylint: disable=too-many-branches
+        """ Handles one character from the REPL client. """
+        if not self._raw:
+            if char == _CTRL_A:
+                self._raw = True
+                self._code = bytearray()
+                self._write(_RAW_PROMPT)
+            elif char == _CTRL_C:
+                self._write(b"\r\n>>> ")
+            elif char == _CTRL_D:
+                self._soft_reset()
+                self._write(b"\r\n>>> ")
+            elif char == b"\r":
+                self._write(b"\r\n>>> ")
+            else:
+                self._write(char)
+            return
+
+        if char == _CTRL_A:
+            self._code = bytearray()
+            self._write(_RAW_PROMPT)
+        elif char == _CTRL_B:
+            self._raw = False
+            self._write(
+                f"\r\nAdafruit CircuitPython {self.version}; "
+                f"{self.name}\r\n>>> ".encode("utf-8")
+            )
+        elif char == _CTRL_C:
+            self._code = bytearray()
+        elif char == _CTRL_D:
+            if not self._code:
+                self._write(b"OK\r\n")
+                self._soft_reset()
+                self._write(_RAW_PROMPT)
+            else:
+                code = bytes(self._code)
+                self._code = bytearray()
+                self._exec_raw(code)
+        else:
+            self._code.extend(char)
+
+    def _soft_reset(self):
+        """ Clears the REPL's state, like a soft reboot. """
+        self._write(_SOFT_REBOOT)
+        self._stop.wait(self.latency["soft_reset"])
+        self._namespace = {}
+        self.stats["soft_reset"] += 1
+
+    def _exec_raw(self, code):
+        """ Runs ``code`` from the raw REPL, and answers with its output
+            and error.
+        """
+        self.stats["exec"] += 1
+        if self._fails("exec_hang"):
+            self.stats["exec_hang"] += 1
+            return
+
+        self._write(b"OK")
+        self._stop.wait(self.latency["exec"])
+
+        if self._fails("exec_error"):
+            self.stats["exec_error"] += 1
+            output, error = "", (
+                "Traceback (most recent call last):\r\n"
+                "OSError: [Errno 5] Input/output error\r\n"
+            )
+        else:
+            try:
+                output, error = self._exec(code.decode("utf-8", "replace"))
+            except _Reboot as reboot:
+                self._next_reset = "normal"
+                self._reenumerate(
+                    "bootloader" if reboot.bootloader else "circuitpython"
+                )
+                return
+
+        self._write(
+            output.encode("utf-8") + _CTRL_D + error.encode("utf-8") +
+            _CTRL_D + b">"
+        )
+
+    def _modules(self):
+        """ The simulated CircuitPython modules. """
+        board = self
+
+        def uname():
+            return types.SimpleNamespace(
+                sysname="sim",
+                nodename="sim",
+                release=board.version,
+                version=board.version,
+                machine=f"{board.name} (simulated)",
+            )
+
+        def on_next_reset(run_mode):
+            board._next_reset = run_mode # pylint: disable=protected-access
+
+        def reset():
+            raise _Reboot(board._next_reset == "bootloader") # pylint: disable=protected-access
+
+        sim_os = types.ModuleType("os")
+        sim_os.uname = uname
+        sim_os.listdir = lambda path="/": sorted(os.listdir(board.drive_dir))
+
+        microcontroller = types.ModuleType("microcontroller")
+        microcontroller.RunMode = types.SimpleNamespace(
+            NORMAL="normal", SAFE_MODE="safe_mode", BOOTLOADER="bootloader"
+        )
+        microcontroller.on_next_reset = on_next_reset
+        microcontroller.reset = reset
+        microcontroller.cpu = types.SimpleNamespace(
+            temperature=25.0, frequency=48000000, uid=b"\x00" * 16
+        )
+
+        sim_board = _StubModule("board")
+        sim_board.board_id = self.name
+
+        return {"os": sim_os, "microcontroller": microcontroller,
+                "board": sim_board}
+
+    def _exec(self, source):
+        """ Runs ``source`` in the board's namespace.
+
+        :returns: A tuple of the printed output and the traceback text.
+        """
+        output = io.StringIO()
+        modules = self._modules()
+
+        def sim_import(name, globals=None, locals=None, fromlist=(), level=0): # pylint: disable=redefined-builtin,too-many-arguments
+            top = name.split(".")[0]
+            if top in modules:
+                return modules[top]
+            if top in _HOST_MODULES:
+                return builtins.__import__(name, globals, locals, fromlist,
+                                           level)
+            module = _StubModule(name)
+            modules[top] = module
+            return module
+
+        def sim_print(*args, sep=" ", end="\n", file=None, flush=False): # pylint: disable=unused-argument,too-many-arguments
+            output.write(sep.join(str(arg) for arg in args) + end)
+
+        sim_builtins = dict(vars(builtins))
+        sim_builtins.update({"__import__": sim_import, "print": sim_print})
+        self._namespace["__builtins__"] = sim_builtins
+
+        error = ""
+        try:
+            exec(compile(source, "<stdin>", "exec"), self._namespace) # pylint: disable=exec-used
+        except _Reboot:
+            raise
+        except Exception: # pylint: disable=broad-except
+            error = traceback.format_exc(limit=-1)
+
+        return (output.getvalue().replace("\n", "\r\n"),
+                error.replace("\n", "\r\n"))
+
+    def _serve_drive(self):
+        """ Flashes the first complete UF2 copied onto the bootloader
+            drive.
+        """
+        uf2_files = sorted(self.drive_dir.glob("*.[uU][fF]2"))
+        for uf2_file in uf2_files:
+            if uf2_file.name == "CURRENT.UF2":
+                continue
+            data = uf2_file.read_bytes()
+            uf2_file.unlink()
+
+            problem = check_uf2(data)
+            if problem is None and self._fails("flash_fail"):
+                problem = "flash write failed (injected)"
+            if problem is not None:
+                rosiepi_logger.info("%s rejected UF2: %s", self.name, problem)
+                self.stats["flash_rejected"] += 1
+                return
+
+            self._stop.wait(len(data) / self.latency["flash_bytes_per_sec"])
+            self.version = f"sim-{hashlib.sha256(data).hexdigest()[:12]}"
+            self.stats["flash"] += 1
+            self._reenumerate("circuitpython")
+            return
+
+class SimBoardFarm():
+    """ A set of simulated boards, sharing a fake sysfs tree. Use as a
+        context manager to start and stop them.
+
+    :param: root: Directory for the boards' drives, state and fake sysfs.
+    :param: boards: Names of the boards.
+    :param: latency: Simulated delays for every board; see
+                     ``DEFAULT_LATENCY``.
+    :param: failures: The chance of each of ``FAILURES``, for every board.
+    :param: seed: Seed for the failure injection.
+    """
+
+    def __init__(self, root, boards, latency=None, failures=None, seed=0): # pylint: disable=too-many-arguments
+        self.root = pathlib.Path(root).resolve()
+        self.sysfs_root = self.root / "sysfs"
+        self.boards = {
+            name: SimBoard(
+                name,
+                index + 1,
+                self.root / "boards" / name,
+                self.sysfs_root,
+                latency=latency,
+                failures=failures,
+                seed=seed
+            )
+            for index, name in enumerate(boards)
+        }
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+    def start(self):
+        """ Brings every board up. """
+        for board in self.boards.values():
+            board.start()
+
+    def stop(self):
+        """ Shuts every board down. """
+        for board in self.boards.values():
+            board.stop()
+
+    def cpboard_class(self):
+        """ A ``CPboard`` class that connects to this farm's boards, to
+            use in place of ``tests.pyboard.CPboard``.
+        """
+        return type("FarmCPboard", (SimCPboard,), {"farm_root": self.root})
+
+    def device_watcher(self, poll_interval=0.01):
+        """ A ``DeviceWatcher`` on the farm's fake sysfs tree. """
+        return DeviceWatcher(sysfs_root=self.sysfs_root,
+                             poll_interval=poll_interval)
+
+    def stats(self):
+        """ Each board's counts of REPL commands, resets, flashes and
+            injected failures.
+        """
+        return {name: dict(board.stats) for name, board in self.boards.items()}
+
+class _SimRepl():
+    """ ``CPboard.repl`` for a ``SimCPboard``. """
+
+    def __init__(self, board):
+        self._board = board
+
+    def reset(self):
+        """ Soft resets the board, leaving it in the raw REPL. """
+        with self._board:
+            self._board.soft_reset()
+
+    def execute(self, command):
+        """ Runs ``command``, returning its output. """
+        return self._board.exec(command)
+
+class _SimFirmware():
+    """ ``CPboard.firmware`` for a ``SimCPboard`` in bootloader mode. """
+
+    def __init__(self, board):
+        self._board = board
+
+    @property
+    def info(self):
+        """ The bootloader's ``INFO_UF2.TXT``. """
+        info_file = pathlib.Path(self._board.disk.path, "INFO_UF2.TXT")
+        lines = info_file.read_text().splitlines()
+        return {"header": lines[0] if lines else ""}
+
+    def upload(self, fw_path):
+        """ Copies the firmware onto the bootloader drive. """
+        drive = pathlib.Path(self._board.disk.path)
+        staging = drive / ".upload.tmp"
+        shutil.copyfile(fw_path, staging)
+        os.replace(staging, drive / os.path.basename(fw_path))
+
+class SimCPboard():
+    """ Client for a ``SimBoard``, with the parts of circuitpython's
+        ``tests.pyboard.CPboard`` that RosiePi uses. Talks the raw REPL
+        protocol over the board's pseudo-terminal, and copies firmware
+        onto its drive. Get a class bound to a farm with
+        ``SimBoardFarm.cpboard_class``.
+
+    :param: name: The board's name.
+    :param: timeout: Seconds to wait for the REPL to answer.
+    """
+
+    farm_root = None
+
+    def __init__(self, name, timeout=10):
+        self.name = name
+        self.timeout = timeout
+        self.repl = _SimRepl(self)
+        self.firmware = _SimFirmware(self)
+        self.disk = types.SimpleNamespace(path=self._state()["drive"])
+        self.serial_number = self._state()["serial_number"]
+        self._fd = None
+        self._depth = 0
+
+    def _state(self):
+        state_file = pathlib.Path(self.farm_root, "boards", self.name,
+                                  "state.json")
+        try:
+            return json.loads(state_file.read_text())
+        except FileNotFoundError:
+            raise RuntimeError(f"No simulated board named {self.name}") from None
+
+    @classmethod
+    def _wait_for_mode(cls, name, mode, wait):
+        """ Waits up to ``wait`` seconds for the board to be up in
+            ``mode``.
+        """
+        board = cls(name)
+        deadline = time.monotonic() + wait
+        while board._state()["mode"] != mode: # pylint: disable=protected-access
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{name} didn't come up in {mode} mode")
+            time.sleep(0.01)
+        return board
+
+    @classmethod
+    def from_try_all(cls, name, wait=20, **kwargs): # pylint: disable=unused-argument
+        """ Connects to the board ``name`` running CircuitPython. """
+        board = cls._wait_for_mode(name, "circuitpython", wait)
+        time.sleep(board._state()["connect_latency"]) # pylint: disable=protected-access
+        return board
+
+    @classmethod
+    def from_build_name_bootloader(cls, name, wait=20):
+        """ Connects to the board ``name`` in bootloader mode. """
+        return cls._wait_for_mode(name, "bootloader", wait)
+
+    @property
+    def bootloader(self):
+        """ Whether the board is in bootloader mode. """
+        return self._state()["mode"] == "bootloader"
+
+    def __enter__(self):
+        if self._depth == 0 and not self.bootloader:
+            tty_path = self._state()["tty"]
+            if tty_path is None:
+                raise RuntimeError(f"{self.name} has no REPL")
+            self._fd = os.open(tty_path, os.O_RDWR | os.O_NOCTTY)
+            tty.setraw(self._fd)
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _send(self, data):
+        os.write(self._fd, data)
+
+    def _read_until(self, ending, timeout=None):
+        """ Reads from the REPL until ``ending``. """
+        deadline = time.monotonic() + (timeout or self.timeout)
+        data = bytearray()
+        while not data.endswith(ending):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError(
+                    f"{self.name}: timed out waiting for {ending!r}"
+                )
+            ready, _, _ = select.select([self._fd], [], [], remaining)
+            if ready:
+                try:
+                    chunk = os.read(self._fd, 1)
+                except OSError:
+                    raise RuntimeError(f"{self.name}: REPL went away") from None
+                if not chunk:
+                    raise RuntimeError(f"{self.name}: REPL went away")
+                data.extend(chunk)
+        return bytes(data)
+
+    def _enter_raw(self):
+        # drop anything left over from an earlier command
+        termios.tcflush(self._fd, termios.TCIFLUSH)
+        self._send(b"\r" + _CTRL_C + _CTRL_C + _CTRL_A)
+        self._read_until(_RAW_PROMPT)
+
+    def soft_reset(self):
+        """ Soft reboots the board, and leaves it in the raw REPL. """
+        self._enter_raw()
+        self._send(_CTRL_D)
+        self._read_until(_SOFT_REBOOT)
+        self._read_until(_RAW_PROMPT)
+
+    def exec(self, command, expect_reset=False):
+        """ Runs ``command`` in the raw REPL.
+
+        :param: expect_reset: The command resets the board, so there's no
+                              answer to wait for.
+
+        :returns: The command's output, as bytes.
+        :raises: ``RuntimeError`` with the board's traceback, if the
+                 command fails.
+        """
+        with self:
+            self._enter_raw()
+            self._send(command.encode("utf-8") + _CTRL_D)
+            if expect_reset:
+                return b""
+            self._read_until(b"OK")
+            output = self._read_until(_CTRL_D)[:-1]
+            error = self._read_until(_CTRL_D)[:-1]
+            self._read_until(b">")
+            self._send(b"\r" + _CTRL_B)
+
+        if error:
+            raise RuntimeError(str(error, encoding="utf-8", errors="replace"))
+        return output
+
+    def reset(self):
+        """ Soft resets the board. """
+        with self:
+            self.soft_reset()
+            self._send(b"\r" + _CTRL_B)
+
+    def reset_to_bootloader(self, repl=False): # pylint: disable=unused-argument
+        """ Resets the board into its bootloader. """
+        self.exec(
+            "import microcontroller\n"
+            "microcontroller.on_next_reset("
+            "microcontroller.RunMode.BOOTLOADER)\n"
+            "microcontroller.reset()",
+            expect_reset=True
+        )
+
+def main():
+    """ Runs simulated boards until interrupted, printing where each
+        board's REPL and drive are.
+    """
+    cli_args = cli_parser.parse_args()
+
+    with SimBoardFarm(cli_args.root, cli_args.boards) as farm:
+        for board in farm.boards.values():
+            print(f"{board.name}: REPL {board.tty_path}, drive {board.drive_dir}")
+        print(f"sysfs: {farm.sysfs_root}")
+        with contextlib.suppress(KeyboardInterrupt):
+            signal.pause()
+
+if __name__ == "__main__":
+    main()
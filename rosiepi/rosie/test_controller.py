@@ -23,22 +23,32 @@
 
 import argparse
 import atexit
+import codecs
 import datetime
-from io import StringIO
+import gzip
 import logging
 import os
-import pathlib
+import shutil
 import tempfile
-import sys
+import time
+import zlib
 
-import pytest
-
-from . import cirpy_actions
-
-from .pytest_rosie import RosieTestController
+from .. import configure_logging
+from .flash_record import FlashRecord
+from .job_cancel import CancelToken
+from .phase_timer import PhaseTimer
+from .sampling_profiler import SamplingProfiler
+from .test_history import TestHistory
 
 rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
 
+# compressed bytes a log may hold in memory before spooling to disk, and
+# the uncompressed head/tail kept for summaries.
+_SPOOL_MAX_MEMORY = 256 * 1024
+_HEAD_SIZE = 4 * 1024
+_TAIL_SIZE = 16 * 1024
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
 cli_parser = argparse.ArgumentParser(description="rosiepi Test Controller")
 cli_parser.add_argument(
     "board",
@@ -49,15 +59,73 @@ cli_parser.add_argument(
     default=None,
     help="Tag or commit to build CircuitPython from."
 )
+cli_parser.add_argument(
+    "--force-flash",
+    action="store_true",
+    help="Flash the firmware even if the board is already running it."
+)
+cli_parser.add_argument(
+    "--board-scope",
+    default="function",
+    help="pytest scope of the board fixture: function, module or session."
+)
+cli_parser.add_argument(
+    "--reset",
+    default="always",
+    help="When to reset the board between tests: always, module, failure "
+         "or none."
+)
+cli_parser.add_argument(
+    "--fail-fast",
+    action="store_true",
+    help="Stop at the first failing test."
+)
+cli_parser.add_argument(
+    "--profile",
+    action="store_true",
+    help="Sample the test run with the profiler, and write the profile "
+         "into the current directory."
+)
 
-class TestResultStream(StringIO):
+# pylint: disable=too-many-instance-attributes
+class TestResultStream():
     """ Container for handling test result output, sending to
         both the stdout (print) and retaining the stream for
         logging and database usage.
+
+        The retained stream is gzip compressed as it is written, and
+        spooled to a temporary file once the compressed data passes
+        ``max_memory`` bytes. The first ``head_size`` and last
+        ``tail_size`` characters are also kept uncompressed, for quick
+        summaries. The full text is read back lazily with ``iter_text``,
+        or saved as a ``.gz`` file with ``save``.
+
+    :param: max_memory: Compressed bytes to hold in memory before
+                        spooling to disk.
+    :param: head_size: Characters to keep from the start of the log.
+    :param: tail_size: Characters to keep from the end of the log.
+    :param: spool_dir: Directory for the spool file. Defaults to the
+                       system temp directory.
     """
+
+    def __init__(self, max_memory=_SPOOL_MAX_MEMORY, head_size=_HEAD_SIZE, # pylint: disable=too-many-arguments
+                 tail_size=_TAIL_SIZE, spool_dir=None):
+        self.head_size = head_size
+        self.tail_size = tail_size
+
+        self.length = 0
+        self._head = ""
+        self._tail = ""
+        self._compressor = zlib.compressobj(wbits=_GZIP_WBITS)
+        self._storage = tempfile.SpooledTemporaryFile(
+            max_size=max_memory,
+            dir=spool_dir
+        )
+        self._pending = False
+
     def write(self, data, quiet=True):
-        """ Override StringIO's write command so that we can also
-            print to stdout.
+        """ Writes ``data`` to the stream, adding a trailing newline if it
+            doesn't have one, and printing it to stdout unless ``quiet``.
         """
         if isinstance(data, bytes):
             data = str(data, encoding="utf-8")
@@ -67,7 +135,101 @@ class TestResultStream(StringIO):
 
         if data[-1:] != "\n":
             data = data + "\n"
-        super().write(data)
+        self._append(data)
+
+    def _append(self, text):
+        """ Adds ``text`` to the stored stream as is. """
+        if not text:
+            return
+
+        if len(self._head) < self.head_size:
+            self._head += text[:self.head_size - len(self._head)]
+        self._tail = (self._tail + text[-self.tail_size:])[-self.tail_size:]
+        self.length += len(text)
+
+        self._storage.write(self._compressor.compress(text.encode("utf-8")))
+        self._pending = True
+
+    def _sync(self):
+        """ Flushes the compressor, so everything written so far can be
+            decompressed from the storage.
+        """
+        if self._pending:
+            self._storage.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+            self._pending = False
+
+    @property
+    def head(self):
+        """ The start of the log, up to ``head_size`` characters. """
+        return self._head
+
+    @property
+    def tail(self):
+        """ The end of the log, up to ``tail_size`` characters. """
+        return self._tail
+
+    @property
+    def spooled(self):
+        """ Whether the stored stream has been moved to disk. """
+        return getattr(self._storage, "_rolled", False)
+
+    def iter_text(self, chunk_size=64 * 1024):
+        """ Yields the full log text in chunks, decompressing
+            ``chunk_size`` stored bytes at a time.
+        """
+        self._sync()
+        decompressor = zlib.decompressobj(wbits=_GZIP_WBITS)
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        position = 0
+        while True:
+            self._storage.seek(position)
+            chunk = self._storage.read(chunk_size)
+            position += len(chunk)
+            if not chunk:
+                break
+            text = decoder.decode(decompressor.decompress(chunk))
+            if text:
+                yield text
+
+        self._storage.seek(0, os.SEEK_END)
+        text = decoder.decode(decompressor.flush(), final=True)
+        if text:
+            yield text
+
+    def getvalue(self):
+        """ The full log text. Prefer ``iter_text`` or ``save`` for large
+            logs; this holds the whole log in memory.
+        """
+        return "".join(self.iter_text())
+
+    def save(self, path):
+        """ Writes the log to ``path`` as a complete gzip file, without
+            decompressing it. The stream can still be written to after.
+        """
+        self._sync()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as gz_file:
+            self._storage.seek(0)
+            shutil.copyfileobj(self._storage, gz_file)
+            gz_file.write(self._compressor.copy().flush(zlib.Z_FINISH))
+        self._storage.seek(0, os.SEEK_END)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """ A new stream holding the contents of a log saved with
+            ``save``, read in chunks so the log never has to fit in
+            memory.
+        """
+        log = cls(**kwargs)
+        with gzip.open(path, "rt", encoding="utf-8") as gz_file:
+            for chunk in iter(lambda: gz_file.read(64 * 1024), ""):
+                log._append(chunk) # pylint: disable=protected-access
+        return log
+
+    def close(self):
+        """ Discards the stored stream. """
+        self._storage.close()
 
 # pylint: disable=too-many-instance-attributes
 class TestController():
@@ -77,11 +239,52 @@ class TestController():
                    an available board in `circuitpython/tools/cpboard.py`.
     :param: build_ref: A reference to the tag/commit to test. This will
                        usually be generated by the GitHub Checks API.
+    :param: checkout: A ``cirpy_actions.CirpyCheckout`` of ``build_ref``
+                      shared by all boards in the job. If not supplied,
+                      a checkout is created for this instance alone.
+    :param: build_cache: An optional ``build_cache.BuildCache`` to reuse
+                         firmware builds from.
+    :param: compiler_cache: An optional ``compiler_cache.CompilerCache``
+                            to compile firmware through.
+    :param: build_scheduler: An optional ``build_scheduler.BuildScheduler``
+                             shared by the job's firmware builds.
+    :param: device_watcher: An optional ``device_watch.DeviceWatcher`` used
+                            to wait for the board during firmware updates.
+    :param: flash_record: An optional ``flash_record.FlashRecord`` used to
+                          skip flashing firmware the board already runs.
+    :param: force_flash: Flash the firmware even if ``flash_record`` says
+                         the board is already running it.
+    :param: log_dir: Optional directory for the job's log files, such as
+                     the full firmware build output.
+    :param: board_scope: The pytest scope of the ``board`` fixture; one of
+                         ``pytest_rosie.BOARD_SCOPES``.
+    :param: reset_policy: When the board is reset between tests; one of
+                          ``pytest_rosie.RESET_POLICIES``.
+    :param: impact: An optional ``test_impact.ImpactAnalyzer``, to run only
+                    the tests the commit can affect.
+    :param: history: An optional ``test_history.TestHistory`` to record
+                     the results in, and to run recently failing tests
+                     first.
+    :param: fail_fast: Stop the tests at the first failure.
+    :param: cpboard: The ``CPboard`` class to connect to the board with,
+                     e.g. ``sim_board.SimBoardFarm.cpboard_class()``.
+                     Defaults to ``tests.pyboard.CPboard`` from the
+                     checkout.
+    :param: cancel: An optional ``job_cancel.CancelToken``. Once it is
+                    cancelled, the build is killed, the tests stop after
+                    the current one, and the remaining stages are skipped.
+                    A firmware update that has started is finished, so the
+                    board isn't left in its bootloader.
 
     :returns: a `TestController` instance.
     """
 
-    def __init__(self, board, build_ref):
+    def __init__(self, board, build_ref, checkout=None, build_cache=None, # pylint: disable=too-many-arguments
+                 compiler_cache=None, build_scheduler=None,
+                 device_watcher=None, flash_record=None, force_flash=False,
+                 log_dir=None, board_scope="function", reset_policy="always",
+                 impact=None, history=None, fail_fast=False, cpboard=None,
+                 cancel=None):
         atexit.register(self.__cleanup)
 
         self.state = "init"
@@ -93,16 +296,40 @@ class TestController():
         self.build_ref = build_ref
         self.board_name = board
 
-        tmp_prefix = str(f".rosiepi_{build_ref[:5]}_")
-        self.clone_tmp_dir = tempfile.TemporaryDirectory(prefix=tmp_prefix)
-        self.clone_dir_path = pathlib.Path(self.clone_tmp_dir.name)
-        sys.path.append(str(self.clone_dir_path.resolve()))
-        rosiepi_logger.info("tmp dir: %s", self.clone_dir_path)
+        # ``cirpy_actions`` (and ``sh``) are imported only where they're
+        # used, like pytest below.
+        if checkout is None:
+            from . import cirpy_actions # pylint: disable=import-outside-toplevel
+            checkout = cirpy_actions.CirpyCheckout(build_ref, boards=[board])
+        self.checkout = checkout
+        self.clone_dir_path = checkout.path
+        self.build_cache = build_cache
+        self.compiler_cache = compiler_cache
+        self.build_scheduler = build_scheduler
+        self.device_watcher = device_watcher
+        self.flash_record = flash_record
+        self.force_flash = force_flash
+        self.log_dir = log_dir
+        self.board_scope = board_scope
+        self.reset_policy = reset_policy
+        self.impact = impact
+        self.history = history
+        self.fail_fast = fail_fast
+        self.cpboard = cpboard
+        self.cancel = cancel if cancel is not None else CancelToken()
+        self.build_stats = {}
+        self.reset_stats = {}
+        self.timer = PhaseTimer(board=board)
+        self.fw_path = None
+        self.log_path = None
 
         self.tests_collected = 0
         self.tests_passed = 0
         self.tests_failed = 0
-        self._result = pytest.ExitCode.NO_TESTS_COLLECTED
+        # pytest is imported only where it's used, so that importing this
+        # module (e.g. for ``TestResultStream``) stays cheap.
+        from pytest import ExitCode # pylint: disable=import-outside-toplevel
+        self._result = ExitCode.NO_TESTS_COLLECTED
 
         init_msg = [
             "Initiating rosiepi...",
@@ -114,15 +341,10 @@ class TestController():
         self.log = TestResultStream()
         self.log.write("\n".join(init_msg))
 
-        try:
-            cirpy_actions.clone_commit(
-                str(self.clone_dir_path.resolve()),
-                build_ref
-            )
-        except RuntimeError as clone_err:
+        if not self.checkout.prepare():
             err_msg = [
                 #f"  - Failed fetch commit: {self.build_ref}",
-                f"   - {clone_err.args[0]}",
+                f"   - {self.checkout.error}",
                 "-"*60,
                 "Closing RosiePi"
             ]
@@ -130,18 +352,43 @@ class TestController():
             self.state = "error"
             return
 
+        checkout_stats = self.checkout.stats
+        if checkout_stats:
+            checkout_mode = checkout_stats["mode"]
+            if checkout_stats["ports"]:
+                checkout_mode += f" ({', '.join(checkout_stats['ports'])})"
+            self.log.write(
+                f"   - Checkout: {checkout_mode}, "
+                f"{checkout_stats['git_bytes'] / 1024**2:.1f} MB git objects, "
+                f"{checkout_stats['worktree_bytes'] / 1024**2:.1f} MB files, "
+                f"in {checkout_stats['seconds']:.2f} secs"
+            )
+
         try:
-            from tests import pyboard # pylint: disable=import-outside-toplevel
+            if self.cpboard is None:
+                from tests import pyboard # pylint: disable=import-outside-toplevel
+                self.cpboard = pyboard.CPboard
             self.log.write(
                 " - Connecting to target board..."
             )
+            # ``wait`` is an upper bound; the connection is made as soon
+            # as the board's serial port opens. 20 seconds matches how long
+            # ``update_fw`` waits for a board to re-enumerate, so a board
+            # that is still coming back from a reset isn't given up on.
             kwargs = {
                 'wait': 20,
             }
-            self.board = pyboard.CPboard.from_try_all(board, **kwargs)
+            connect_start = time.monotonic()
+            with self.timer.span("board_connect"):
+                self.board = self.cpboard.from_try_all(board, **kwargs)
+            connect_secs = time.monotonic() - connect_start
+            rosiepi_logger.info(
+                "Connected to %s in %.2f secs", board, connect_secs
+            )
             board_connect_msg = [
                 f"   - Serial Number: {self.board.serial_number}",
                 f"   - Disk Drive: {self.board.disk.path}",
+                f"   - Connected in: {connect_secs:.2f} secs",
             ]
             self.log.write("\n".join(board_connect_msg))
             self.state = "board_connected"
@@ -166,53 +413,145 @@ class TestController():
         except Exception as err: # pylint: disable=broad-except
             rosiepi_logger.info("Board reset failed: %s", err)
 
+    def close(self):
+        """ Resets the board now, instead of when the process exits. Long
+            running processes call this once a board's results are in, so
+            finished controllers aren't kept alive until exit.
+        """
+        atexit.unregister(self.__cleanup)
+        self.__cleanup()
+
+    @property
+    def phase_timing(self):
+        """ The spans recorded for this board, from ``timer``. """
+        return self.timer.spans
+
     @property
     def result(self):
         """ The ``pytest.ExitCode`` result of the test instance.
         """
         return self._result
 
+    def save_log(self):
+        """ Saves the board's compressed log into ``log_dir``.
+
+        :returns: The path of the saved log.
+        """
+        self.log_path = os.path.join(self.log_dir, f"{self.board_name}.log.gz")
+        self.log.save(self.log_path)
+        return self.log_path
+
     def start_test(self):
         """ Starts the first step of a test event.
             1. Attempts to build the firmware.
             2. Uploads the built firmware onto the target board.
+
+            The steps are also available separately, as ``build_firmware``
+            and ``complete_test``, so that they can be pipelined across
+            boards.
         """
+        self.build_firmware()
+        self.complete_test()
+
+    def _stopped(self):
+        """ Whether the board's stages have stopped early, on an error or
+            because the job was cancelled. Puts the instance into the
+            cancelled state if the job was cancelled since the last check.
+        """
+        if self.state not in ("error", "cancelled") and self.cancel.cancelled:
+            err_msg = [
+                f"Job cancelled ({self.cancel.reason}) on: {self.board_name}",
+                "-"*60,
+                "Closing RosiePi"
+            ]
+            self.log.write("\n".join(err_msg), quiet=True)
+            self.state = "cancelled"
+        return self.state in ("error", "cancelled")
+
+    def _firmware_error(self, fw_err):
+        """ Logs a firmware build or update failure, and puts the
+            instance into the error state.
+        """
+        err_msg = [
+            f"Failed update firmware on: {self.board_name}",
+            fw_err.args[0],
+            "-"*60,
+            "Closing RosiePi"
+        ]
+        self.log.write("\n".join(err_msg), quiet=True)
+        self.state = "error"
+
+    def build_firmware(self):
+        """ Builds the firmware for the board. The path of the built
+            firmware is stored in ``fw_path``.
+        """
+        if self._stopped():
+            return
+
         self.state = "starting_fw_prep"
         self.log.write(
             f"Preparing Firmware..."
         )
 
-        try:
-            fw_build_dir = cirpy_actions.build_fw(
-                self.board_name,
-                self.log,
-                self.clone_dir_path.resolve()
-            )
+        from . import cirpy_actions # pylint: disable=import-outside-toplevel
 
-            self.log.write(f"Updating Firmware on: {self.board_name}")
-            cirpy_actions.update_fw(
-                self.board,
-                self.board_name,
-                os.path.join(fw_build_dir, "firmware.uf2"),
-                self.log
-            )
+        try:
+            with self.timer.span("build_fw"):
+                fw_build_dir = cirpy_actions.build_fw(
+                    self.board_name,
+                    self.log,
+                    self.clone_dir_path.resolve(),
+                    build_cache=self.build_cache,
+                    compiler_cache=self.compiler_cache,
+                    build_scheduler=self.build_scheduler,
+                    build_stats=self.build_stats,
+                    log_dir=self.log_dir,
+                    cancel=self.cancel
+                )
+            self.fw_path = os.path.join(fw_build_dir, "firmware.uf2")
 
         except RuntimeError as fw_err:
-            err_msg = [
-                f"Failed update firmware on: {self.board_name}",
-                fw_err.args[0],
-                "-"*60,
-                "Closing RosiePi"
-            ]
-            self.log.write("\n".join(err_msg), quiet=True)
-            self.state = "error"
+            if not self._stopped():
+                self._firmware_error(fw_err)
+
+    def complete_test(self):
+        """ Uploads the firmware built by ``build_firmware`` onto the
+            board, then runs the tests.
+        """
+        if not self._stopped():
+            from . import cirpy_actions # pylint: disable=import-outside-toplevel
+
+            try:
+                self.log.write(f"Updating Firmware on: {self.board_name}")
+                cirpy_actions.update_fw(
+                    self.board,
+                    self.board_name,
+                    self.fw_path,
+                    self.log,
+                    device_watcher=self.device_watcher,
+                    flash_record=self.flash_record,
+                    force_flash=self.force_flash,
+                    timer=self.timer,
+                    cpboard=self.cpboard
+                )
+
+            except RuntimeError as fw_err:
+                self._firmware_error(fw_err)
 
         self.log.write("-"*60)
 
-        if self.state != "error":
+        if not self._stopped():
             self.state = "running_tests"
             self.run_tests()
 
+        # a failure may be down to the board, so don't trust the flash
+        # record for it next time.
+        from pytest import ExitCode # pylint: disable=import-outside-toplevel
+        if (self.flash_record is not None and
+                self.result != ExitCode.OK and
+                getattr(self, "board", None) is not None):
+            self.flash_record.forget(self.board.serial_number)
+
     def run_tests(self):
         """ Runs the second step of a test event, by calling ``pytest`` to
             run the tests located in the circuitpython repository. Since
@@ -227,7 +566,29 @@ class TestController():
             / "rosie_tests"
         )
 
-        pytest.main([rosie_tests_dir], plugins=[RosieTestController(self)])
+        import pytest # pylint: disable=import-outside-toplevel
+        from . import cirpy_actions # pylint: disable=import-outside-toplevel
+        from .pytest_rosie import RosieTestController # pylint: disable=import-outside-toplevel
+
+        test_paths = [rosie_tests_dir]
+        if self.impact is not None:
+            selection = self.impact.select(
+                cirpy_actions.board_port(self.clone_dir_path, self.board_name)
+            )
+            self.log.write(f"Test selection: {selection.reason}")
+            if not selection.full:
+                test_paths = [
+                    os.path.join(rosie_tests_dir, test_file)
+                    for test_file in selection.test_files
+                ]
+
+        pytest_args = test_paths + [
+            "--rosie-board-scope", self.board_scope,
+            "--rosie-reset", self.reset_policy,
+        ]
+        if self.fail_fast:
+            pytest_args.append("--rosie-fail-fast")
+        pytest.main(pytest_args, plugins=[RosieTestController(self)])
 
 def main():
     """ The entrypoint to run a test instance, without involving the
@@ -235,12 +596,40 @@ def main():
         development purposes.
     """
     cli_args = cli_parser.parse_args()
+    configure_logging()
+
+    profiler = None
+    if cli_args.profile:
+        profiler = SamplingProfiler()
+        profiler.start()
+
+    from . import cirpy_actions # pylint: disable=import-outside-toplevel
+
+    with cirpy_actions.CirpyCheckout(cli_args.build_ref,
+                                     boards=[cli_args.board]) as checkout:
+        test_control = TestController(
+            cli_args.board,
+            cli_args.build_ref,
+            checkout=checkout,
+            flash_record=FlashRecord(),
+            force_flash=cli_args.force_flash,
+            board_scope=cli_args.board_scope,
+            reset_policy=cli_args.reset,
+            history=TestHistory(),
+            fail_fast=cli_args.fail_fast
+        )
+        if test_control.state != "error":
+            test_control.start_test()
 
-    test_control = TestController(cli_args.board, cli_args.build_ref)
-    if test_control.state != "error":
-        test_control.start_test()
+    if profiler is not None:
+        profiler.stop()
+        profiler.save(os.getcwd())
 
     #print()
     print("test log:")
     print(test_control.log.getvalue())
     print("exitstatus:", test_control.result, int(test_control.result))
+    if profiler is not None:
+        print()
+        print("profile:")
+        print(profiler.format_summary())
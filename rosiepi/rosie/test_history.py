@@ -0,0 +1,236 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+import collections
+import contextlib
+import datetime
+import logging
+import pathlib
+import sqlite3
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_HISTORY_FILE = pathlib.Path.home() / "rosie_pi" / "test_history.db"
+
+# bumped whenever the table layout changes; older databases are rebuilt.
+_SCHEMA_VERSION = 1
+
+# outcomes that count as a test failing
+FAILED_OUTCOMES = ("failed", "error")
+
+# a test's recent history on one board. ``last_failure`` is how many runs
+# ago the test last failed (``0`` is the latest run), or ``None`` if it
+# hasn't failed recently.
+TestStats = collections.namedtuple(
+    "TestStats",
+    ["runs", "failures", "last_failure", "mean_duration"]
+)
+
+class TestHistory():
+    """ Local SQLite record of each test's outcome and duration, per board,
+        used to run recently failing tests first. Safe to share between
+        jobs and board worker processes; each call opens its own
+        connection.
+
+    :param: db_file: The SQLite database file.
+    :param: keep: The most runs of each test, per board, to keep.
+    """
+
+    def __init__(self, db_file=DEFAULT_HISTORY_FILE, keep=20):
+        self.db_file = pathlib.Path(db_file)
+        self.keep = keep
+
+    @staticmethod
+    def _create_schema(conn):
+        """ (Re)creates the table, in one write transaction. The version is
+            checked again once the write lock is held, so connections that
+            find an old schema at the same time only rebuild it once.
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != _SCHEMA_VERSION:
+                conn.execute("DROP TABLE IF EXISTS results")
+                conn.execute(
+                    "CREATE TABLE results ("
+                    " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                    " board TEXT NOT NULL,"
+                    " nodeid TEXT NOT NULL,"
+                    " outcome TEXT NOT NULL,"
+                    " duration REAL NOT NULL,"
+                    " commit_sha TEXT,"
+                    " recorded_at TEXT NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE INDEX results_board_test"
+                    " ON results (board, nodeid, id)"
+                )
+                conn.execute(f"PRAGMA user_version={_SCHEMA_VERSION}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """ Context manager that yields a connection to the database,
+            creating the table if needed, and commits on exit.
+        """
+        self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.db_file), timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != _SCHEMA_VERSION:
+                self._create_schema(conn)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def record(self, board, commit, results):
+        """ Records a test run.
+
+        :param: board: The board the tests ran on.
+        :param: commit: The commit the tests ran against.
+        :param: results: A dict of each test's nodeid to its
+                         ``(outcome, duration)``.
+        """
+        if not results:
+            return
+
+        recorded_at = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        try:
+            with self._connect() as conn:
+                conn.executemany(
+                    "INSERT INTO results"
+                    " (board, nodeid, outcome, duration, commit_sha,"
+                    "  recorded_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (board, nodeid, outcome, duration, commit, recorded_at)
+                        for nodeid, (outcome, duration) in results.items()
+                    ]
+                )
+                conn.executemany(
+                    "DELETE FROM results WHERE board = ? AND nodeid = ?"
+                    " AND id NOT IN (SELECT id FROM results"
+                    "  WHERE board = ? AND nodeid = ?"
+                    "  ORDER BY id DESC LIMIT ?)",
+                    [
+                        (board, nodeid, board, nodeid, self.keep)
+                        for nodeid in results
+                    ]
+                )
+        except sqlite3.Error as db_err:
+            rosiepi_logger.warning("Couldn't record test history: %s", db_err)
+
+    def stats(self, board, window=5):
+        """ Each test's recent history on ``board``.
+
+        :param: window: How many of each test's latest runs to look for
+                        failures in.
+
+        :returns: A dict of each test's nodeid to its ``TestStats``.
+        """
+        rows = collections.defaultdict(list)
+        try:
+            with self._connect() as conn:
+                for nodeid, outcome, duration in conn.execute(
+                        "SELECT nodeid, outcome, duration FROM results"
+                        " WHERE board = ? ORDER BY id DESC", (board,)):
+                    rows[nodeid].append((outcome, duration))
+        except sqlite3.Error as db_err:
+            rosiepi_logger.warning("Couldn't read test history: %s", db_err)
+            return {}
+
+        stats = {}
+        for nodeid, runs in rows.items():
+            recent = [outcome for outcome, _ in runs[:window]]
+            last_failure = next(
+                (
+                    index for index, outcome in enumerate(recent)
+                    if outcome in FAILED_OUTCOMES
+                ),
+                None
+            )
+            durations = [
+                duration for outcome, duration in runs if outcome != "skipped"
+            ]
+            stats[nodeid] = TestStats(
+                runs=len(runs),
+                failures=sum(
+                    1 for outcome in recent if outcome in FAILED_OUTCOMES
+                ),
+                last_failure=last_failure,
+                mean_duration=(
+                    sum(durations) / len(durations) if durations else 0.0
+                ),
+            )
+
+        return stats
+
+def _test_key(stats):
+    """ Sort key for one test: recently failing tests first, most recent
+        failure first, then tests without any history, then the rest;
+        shorter tests before longer ones.
+    """
+    if stats is None:
+        return (1, 0, 0.0)
+    if stats.last_failure is not None:
+        return (0, stats.last_failure, stats.mean_duration)
+    return (2, 0, stats.mean_duration)
+
+def order_tests(nodeids, stats):
+    """ Orders ``nodeids`` so that recently failing tests run first.
+
+        Tests stay grouped by file, so module scoped fixtures and board
+        resets aren't repeated. Files holding a recent failure go first,
+        then files with new tests, then the rest with the quickest files
+        first. Within a file, the same order applies, leaving the long
+        tests to the end. Ties keep their collected order.
+
+    :param: nodeids: The collected tests' nodeids.
+    :param: stats: A dict of nodeids to ``TestStats``, from
+                   ``TestHistory.stats``.
+
+    :returns: The reordered list of nodeids.
+    """
+    modules = collections.OrderedDict()
+    for nodeid in nodeids:
+        modules.setdefault(nodeid.split("::")[0], []).append(nodeid)
+
+    def module_key(module):
+        keys = [_test_key(stats.get(nodeid)) for nodeid in modules[module]]
+        first = min(keys)
+        total = sum(key[2] for key in keys)
+        return (first[0], first[1], total)
+
+    def test_key(nodeid):
+        return _test_key(stats.get(nodeid))
+
+    ordered = []
+    for module in sorted(modules, key=module_key):
+        ordered.extend(sorted(modules[module], key=test_key))
+    return ordered
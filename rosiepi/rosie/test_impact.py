@@ -0,0 +1,262 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import ast
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import re
+
+import sh
+from sh.contrib import git
+
+rosiepi_logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+DEFAULT_CACHE_DIR = pathlib.Path.home() / "rosie_pi" / "impact_cache"
+
+ROSIE_TESTS_PATH = "tests/circuitpython/rosie_tests"
+
+# bump when the mapping changes, so old cached mappings aren't used
+_MAPPING_VERSION = "1"
+
+# paths that can't change the firmware or the tests
+_IGNORED_PREFIXES = ("docs/", ".github/", "locale/", "logo/")
+# prose, when it's at the top of the tree or in a ``docs`` directory.
+# Elsewhere these can be build inputs (e.g. a port's ``.txt`` lists).
+_DOCS_SUFFIXES = (".md", ".rst", ".txt")
+
+class TestSelection():
+    """ The rosie tests to run for a commit.
+
+    :param: test_files: Test file paths, relative to the rosie tests
+                        directory, or ``None`` to run every test.
+    :param: reason: Why this selection was made, for the test log.
+    """
+
+    def __init__(self, test_files, reason):
+        self.test_files = test_files
+        self.reason = reason
+
+    @property
+    def full(self):
+        """ Whether every test is run. """
+        return self.test_files is None
+
+def _is_docs(path):
+    """ Whether ``path`` is documentation outside ``_IGNORED_PREFIXES``. """
+    if not path.endswith(_DOCS_SUFFIXES):
+        return False
+    parts = pathlib.PurePosixPath(path).parts
+    return len(parts) == 1 or "docs" in parts[:-1]
+
+def _binding_modules(cirpy_git, commit):
+    """ The names of the modules in ``shared-bindings`` at ``commit``. """
+    names = str(cirpy_git(
+        "ls-tree", "--name-only", commit, "shared-bindings/"
+    )).split()
+    modules = set()
+    for name in names:
+        module = pathlib.PurePosixPath(name).name.split(".")[0]
+        if module and not module.startswith("__"):
+            modules.add(module)
+    return modules
+
+def _modules_used(source, modules):
+    """ The ``modules`` a test file exercises: those it imports, and
+        those it names anywhere else, such as in code sent to the board's
+        REPL as a string.
+    """
+    used = set()
+    try:
+        for node in ast.walk(ast.parse(source)):
+            if isinstance(node, ast.Import):
+                used.update(alias.name.split(".")[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module:
+                used.add(node.module.split(".")[0])
+    except SyntaxError:
+        pass
+
+    used.update(re.findall(r"[A-Za-z_][A-Za-z0-9_]*", source))
+    return used & modules
+
+class ImpactAnalyzer():
+    """ Works out which rosie tests a commit can affect, from the paths it
+        changed since its merge base with a baseline ref:
+
+        - ``shared-bindings/<module>``, ``shared-module/<module>`` and the
+          board's ``ports/<port>/common-hal/<module>`` select the tests
+          that use ``<module>``.
+        - Changed test files select themselves.
+        - Documentation (``docs`` directories, and ``.md``, ``.rst`` and
+          ``.txt`` files at the top of the tree), and other ports, select
+          nothing.
+        - Anything else (``py/``, ``supervisor/``, the board's port outside
+          ``common-hal``, submodules, test helpers, ...) is treated as a
+          core change, and every test is run.
+
+        Which modules each test file uses is cached per rosie tests tree
+        and ``shared-bindings`` tree, so it is only worked out again when
+        either changes.
+
+    :param: cirpy_dir: The circuitpython checkout.
+    :param: commit: The commit being tested.
+    :param: baseline: The ref to diff against, e.g. ``origin/main``.
+    :param: cache_dir: Directory for the cached test mappings. ``None``
+                       disables the cache.
+    """
+
+    def __init__(self, cirpy_dir, commit, baseline, cache_dir=DEFAULT_CACHE_DIR):
+        self.cirpy_dir = pathlib.Path(cirpy_dir)
+        self.commit = commit
+        self.baseline = baseline
+        self.cache_dir = pathlib.Path(cache_dir) if cache_dir else None
+
+        self._git = git.bake("-C", str(self.cirpy_dir))
+        self._changed_paths = None
+        self._mapping = None
+
+    def changed_paths(self):
+        """ The paths changed between the baseline's merge base and the
+            commit. Raises ``RuntimeError`` if the diff can't be made,
+            e.g. when the baseline isn't in the checkout's history.
+        """
+        if self._changed_paths is None:
+            try:
+                merge_base = str(
+                    self._git("merge-base", self.baseline, self.commit)
+                ).strip()
+                diff = self._git(
+                    "diff", "--name-only", "--no-renames",
+                    merge_base, self.commit
+                )
+            except sh.ErrorReturnCode as git_err:
+                raise RuntimeError(
+                    f"Can't diff against {self.baseline}: "
+                    f"{str(git_err.stderr, encoding='utf-8').strip()}"
+                ) from None
+            self._changed_paths = str(diff).split()
+        return self._changed_paths
+
+    def _mapping_key(self):
+        """ The cache key for the test mapping. """
+        trees = [
+            str(self._git("rev-parse", f"{self.commit}:{tree}")).strip()
+            for tree in (ROSIE_TESTS_PATH, "shared-bindings")
+        ]
+        return hashlib.sha256(
+            "\n".join([_MAPPING_VERSION] + trees).encode("utf-8")
+        ).hexdigest()
+
+    def test_mapping(self):
+        """ A dict of each test file, relative to the rosie tests directory,
+            to the ``shared-bindings`` modules it uses.
+        """
+        if self._mapping is not None:
+            return self._mapping
+
+        cache_file = None
+        if self.cache_dir is not None:
+            cache_file = self.cache_dir / f"{self._mapping_key()}.json"
+            try:
+                self._mapping = json.loads(cache_file.read_text())
+                return self._mapping
+            except (OSError, ValueError):
+                pass
+
+        modules = _binding_modules(self._git, self.commit)
+        tests_dir = self.cirpy_dir / ROSIE_TESTS_PATH
+        mapping = {}
+        for test_file in sorted(tests_dir.rglob("test_*.py")):
+            source = test_file.read_text(encoding="utf-8", errors="replace")
+            mapping[test_file.relative_to(tests_dir).as_posix()] = sorted(
+                _modules_used(source, modules)
+            )
+
+        if cache_file is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_file = cache_file.with_suffix(".tmp")
+            tmp_file.write_text(json.dumps(mapping, indent=2))
+            os.replace(tmp_file, cache_file)
+
+        self._mapping = mapping
+        return mapping
+
+    def select(self, port):
+        """ The ``TestSelection`` for a board in ``port``. """
+        try:
+            changed = self.changed_paths()
+        except RuntimeError as diff_err:
+            return TestSelection(None, str(diff_err))
+
+        mapping = self.test_mapping()
+        tests_prefix = ROSIE_TESTS_PATH + "/"
+        port_prefix = f"ports/{port}/"
+        common_hal_prefix = f"{port_prefix}common-hal/"
+
+        modules = set()
+        selected = set()
+        for path in changed:
+            if path.startswith(_IGNORED_PREFIXES) or _is_docs(path):
+                continue
+
+            if path.startswith(tests_prefix):
+                test_path = path[len(tests_prefix):]
+                if test_path in mapping:
+                    selected.add(test_path)
+                    continue
+                test_name = pathlib.PurePosixPath(test_path).name
+                if test_name.startswith("test_") and not (self.cirpy_dir / path).exists():
+                    # a removed test
+                    continue
+                return TestSelection(None, f"Test support changed: {path}")
+
+            if path.startswith(("shared-bindings/", "shared-module/")):
+                modules.add(path.split("/")[1].split(".")[0])
+                continue
+
+            if path.startswith(common_hal_prefix):
+                modules.add(path[len(common_hal_prefix):].split("/")[0].split(".")[0])
+                continue
+
+            if path.startswith("ports/") and not path.startswith(port_prefix):
+                continue
+
+            return TestSelection(None, f"Core change: {path}")
+
+        selected.update(
+            test_file for test_file, used in mapping.items()
+            if modules.intersection(used)
+        )
+
+        if not selected:
+            # nothing to show for the change; run everything rather than
+            # report an empty session.
+            return TestSelection(None, "No tests matched the change")
+
+        return TestSelection(
+            sorted(selected),
+            f"{len(selected)} of {len(mapping)} test file(s) affected by "
+            f"changes to: {', '.join(sorted(modules)) or 'tests only'}"
+        )
@@ -21,28 +21,31 @@
 # THE SOFTWARE.
 #
 
-import pathlib
-
-ACTIVATE_THIS = f'{pathlib.Path().home()}/rosie_pi/rosie_venv/bin/activate_this.py'
-with open(ACTIVATE_THIS) as file_:
-    exec(file_.read(), dict(__file__=ACTIVATE_THIS)) # pylint: disable=exec-used
-
-# pylint: disable=wrong-import-position
 import argparse
 import dataclasses
 import datetime
 import logging
 import json
-import traceback
+import pathlib
+import shutil
 
 from configparser import ConfigParser
 from socket import gethostname
 
-import requests
-
-from pytest import ExitCode
-
-from .rosie import test_controller
+# modules that pull in sh, pytest or requests (build_cache, cirpy_actions,
+# git_mirror, test_controller) are imported where they're used, so that
+# handing a job to the daemon doesn't pay for them.
+from . import configure_logging, daemon, reporting
+from .rosie import (
+    board_lock,
+    board_runner,
+    build_scheduler,
+    compiler_cache,
+    flash_record,
+    job_cancel,
+    phase_timer,
+    sampling_profiler
+)
 
 # pylint: disable=invalid-name
 rosiepi_logger = logging.getLogger(__name__)
@@ -56,13 +59,54 @@ cli_parser.add_argument(
     "check_run_id",
     help="ID of the check run that requested the test"
 )
+cli_parser.add_argument(
+    "--force-flash",
+    action="store_true",
+    help="Flash the firmware even if a board is already running it."
+)
+cli_parser.add_argument(
+    "--force-run",
+    action="store_true",
+    help="Build and test every board, even if results for this commit are "
+         "cached."
+)
+cli_parser.add_argument(
+    "--supersede",
+    metavar="CHECK_RUN_ID",
+    action="append",
+    default=[],
+    help="Cancel the daemon's job for an older check run, e.g. for an "
+         "earlier push to the same PR. May be given more than once."
+)
+cli_parser.add_argument(
+    "--no-daemon",
+    action="store_true",
+    help="Run the job in this process, even if the RosiePi daemon is running."
+)
+cli_parser.add_argument(
+    "--profile",
+    action="store_true",
+    help="Sample the job with the profiler, and write the profile next to "
+         "the job's logs."
+)
+
 
+ACTIVATE_THIS = f'{pathlib.Path().home()}/rosie_pi/rosie_venv/bin/activate_this.py'
+
+def activate_venv():
+    """ Activates the RosiePi virtualenv, so that its packages are used
+        when they're imported.
+    """
+    with open(ACTIVATE_THIS) as file_:
+        exec(file_.read(), dict(__file__=ACTIVATE_THIS)) # pylint: disable=exec-used
 
 # TODO: update to adafruit github
 GIT_URL_COMMIT = "https://github.com/sommersoft/circuitpython/commit/"
 
 _STATIC_CONFIG_FILE = pathlib.Path("/etc/opt/physaci_sub/conf.ini")
 
+_DEFAULT_LOG_DIR = pathlib.Path.home() / "rosie_pi" / "logs"
+
 class PhysaCIConfig():
     """ Container class for holding local configuration results. """
 
@@ -95,6 +139,380 @@ class PhysaCIConfig():
         board_list = [board.strip() for board in boards.split(",")]
         return board_list
 
+    @property
+    def git_mirror_dir(self):
+        """ Directory holding the node-local circuitpython git mirror. An
+            empty value disables the mirror.
+        """
+        from .rosie import git_mirror # pylint: disable=import-outside-toplevel
+
+        return self.config.get(
+            "rosie_pi",
+            "git_mirror_dir",
+            fallback=str(git_mirror.DEFAULT_MIRROR_DIR)
+        )
+
+    @property
+    def git_mirror_max_size(self):
+        """ Size cap for the git mirror, in bytes. Configured in MB. """
+        size_mb = self.config.getint(
+            "rosie_pi", "git_mirror_max_size_mb", fallback=4096
+        )
+        return size_mb * 1024 * 1024
+
+    @property
+    def git_mirror_gc_interval(self):
+        """ Seconds between git mirror gc runs. Configured in days. """
+        gc_days = self.config.getfloat(
+            "rosie_pi", "git_mirror_gc_days", fallback=7
+        )
+        return gc_days * 24 * 60 * 60
+
+    @property
+    def sparse_checkout(self):
+        """ Check out only the parts of circuitpython that the node's
+            boards need, instead of the whole tree and every submodule.
+        """
+        return self.config.getboolean("rosie_pi", "sparse_checkout",
+                                      fallback=True)
+
+    @property
+    def build_cache_dir(self):
+        """ Directory holding the firmware build cache. An empty value
+            disables the cache.
+        """
+        from .rosie import build_cache # pylint: disable=import-outside-toplevel
+
+        return self.config.get(
+            "rosie_pi",
+            "build_cache_dir",
+            fallback=str(build_cache.DEFAULT_CACHE_DIR)
+        )
+
+    @property
+    def build_slot_dir(self):
+        """ Directory of the lock files that share the node's firmware
+            build parallelism between processes (concurrent daemon jobs,
+            and board worker processes). An empty value only shares it
+            within each process.
+        """
+        return self.config.get(
+            "rosie_pi",
+            "build_slot_dir",
+            fallback=str(build_scheduler.DEFAULT_SLOT_DIR)
+        )
+
+    @property
+    def build_cache_max_size(self):
+        """ Size cap for the firmware build cache, in bytes. Configured
+            in MB.
+        """
+        size_mb = self.config.getint(
+            "rosie_pi", "build_cache_max_size_mb", fallback=2048
+        )
+        return size_mb * 1024 * 1024
+
+    @property
+    def ccache_dir(self):
+        """ Directory holding the compiler cache. An empty value disables
+            the compiler cache.
+        """
+        return self.config.get(
+            "rosie_pi",
+            "ccache_dir",
+            fallback=str(compiler_cache.DEFAULT_CCACHE_DIR)
+        )
+
+    @property
+    def ccache_max_size(self):
+        """ Size cap for the compiler cache, in bytes. Configured in MB. """
+        size_mb = self.config.getint(
+            "rosie_pi", "ccache_max_size_mb", fallback=5120
+        )
+        return size_mb * 1024 * 1024
+
+    @property
+    def execution_mode(self):
+        """ How the per-board stages are run: ``sequential`` (default),
+            ``pipeline``, which builds the next board's firmware while the
+            current board is flashed and tested, or ``process``, which runs
+            each board in its own worker process.
+        """
+        mode = self.config.get(
+            "rosie_pi", "execution", fallback="sequential"
+        ).strip().lower()
+        if mode not in board_runner.EXECUTION_MODES:
+            raise RuntimeError(f"Unknown RosiePi execution mode: {mode}")
+        return mode
+
+    @property
+    def board_fixture_scope(self):
+        """ The pytest scope of the ``board`` fixture: ``function``
+            (default), ``module`` or ``session``.
+        """
+        from .rosie import pytest_rosie # pylint: disable=import-outside-toplevel
+
+        scope = self.config.get(
+            "rosie_pi", "board_fixture_scope", fallback="function"
+        ).strip().lower()
+        if scope not in pytest_rosie.BOARD_SCOPES:
+            raise RuntimeError(f"Unknown board fixture scope: {scope}")
+        return scope
+
+    @property
+    def board_reset_policy(self):
+        """ When boards are reset between tests: ``always`` (default),
+            ``module``, ``failure`` or ``none``.
+        """
+        from .rosie import pytest_rosie # pylint: disable=import-outside-toplevel
+
+        policy = self.config.get(
+            "rosie_pi", "board_reset_policy", fallback="always"
+        ).strip().lower()
+        if policy not in pytest_rosie.RESET_POLICIES:
+            raise RuntimeError(f"Unknown board reset policy: {policy}")
+        return policy
+
+    @property
+    def impact_baseline(self):
+        """ The ref each commit is diffed against to pick the tests it can
+            affect. An empty value always runs every test. Only used with
+            the git mirror (``git_mirror_dir``): without it, the checkout
+            is a shallow clone that has no merge base with the baseline.
+        """
+        return self.config.get(
+            "rosie_pi",
+            "impact_baseline",
+            fallback="origin/main"
+        )
+
+    @property
+    def impact_cache_dir(self):
+        """ Directory to cache test impact mappings in. An empty value
+            disables the cache.
+        """
+        from .rosie import test_impact # pylint: disable=import-outside-toplevel
+
+        return self.config.get(
+            "rosie_pi",
+            "impact_cache_dir",
+            fallback=str(test_impact.DEFAULT_CACHE_DIR)
+        )
+
+    @property
+    def result_cache_dir(self):
+        """ Directory to cache each board's results in, to answer a commit
+            that is sent again without testing it. An empty value disables
+            the cache.
+        """
+        from .rosie import result_cache # pylint: disable=import-outside-toplevel
+
+        return self.config.get(
+            "rosie_pi",
+            "result_cache_dir",
+            fallback=str(result_cache.DEFAULT_CACHE_DIR)
+        )
+
+    @property
+    def result_cache_ttl(self):
+        """ Seconds cached results are reused for. Configured in hours. """
+        ttl_hours = self.config.getfloat(
+            "rosie_pi", "result_cache_ttl_hours", fallback=24
+        )
+        return ttl_hours * 60 * 60
+
+    @property
+    def result_cache_failures(self):
+        """ Also reuse cached failures. Off by default, so re-running a
+            check tests a failed board again.
+        """
+        return self.config.getboolean(
+            "rosie_pi", "result_cache_failures", fallback=False
+        )
+
+    @property
+    def pipeline_depth(self):
+        """ The most built boards that may wait to be flashed in
+            ``pipeline`` mode.
+        """
+        return self.config.getint("rosie_pi", "pipeline_depth", fallback=1)
+
+    @property
+    def board_workers(self):
+        """ The most boards run at once in ``process`` mode. Defaults to
+            one worker per board.
+        """
+        return self.config.getint("rosie_pi", "board_workers", fallback=None)
+
+    @property
+    def flash_record_file(self):
+        """ File recording the firmware last flashed onto each board. An
+            empty value disables skipping the flash.
+        """
+        return self.config.get(
+            "rosie_pi",
+            "flash_record_file",
+            fallback=str(flash_record.DEFAULT_RECORD_FILE)
+        )
+
+    @property
+    def test_history_file(self):
+        """ SQLite file recording each board's test results, used to run
+            recently failing tests first. An empty value disables it.
+        """
+        from .rosie import test_history # pylint: disable=import-outside-toplevel
+
+        return self.config.get(
+            "rosie_pi",
+            "test_history_file",
+            fallback=str(test_history.DEFAULT_HISTORY_FILE)
+        )
+
+    @property
+    def fail_fast(self):
+        """ Whether each board's tests stop at the first failure, to
+            report a regression quickly. Defaults to ``False``.
+        """
+        return self.config.getboolean(
+            "rosie_pi", "fail_fast", fallback=False
+        )
+
+    @property
+    def profile_in_results(self):
+        """ Whether a profiled job's summary is sent to physaCI with its
+            results. Defaults to ``False``.
+        """
+        return self.config.getboolean(
+            "rosie_pi", "profile_in_results", fallback=False
+        )
+
+    @property
+    def metrics_file(self):
+        """ OpenMetrics textfile the latest job's phase timings are written
+            to, e.g. for the node_exporter textfile collector. An empty
+            value disables it.
+        """
+        return self.config.get(
+            "rosie_pi",
+            "metrics_file",
+            fallback=str(phase_timer.DEFAULT_METRICS_FILE)
+        )
+
+    @property
+    def log_dir(self):
+        """ Directory to keep job log files in, one subdirectory per check
+            run. An empty value disables keeping job logs.
+        """
+        return self.config.get(
+            "rosie_pi",
+            "log_dir",
+            fallback=str(_DEFAULT_LOG_DIR)
+        )
+
+    @property
+    def log_retention(self):
+        """ The number of most recent job log directories to keep. """
+        return self.config.getint("rosie_pi", "log_retention", fallback=50)
+
+    @property
+    def incremental_results(self):
+        """ Report each board's results to physaCI as soon as the board
+            finishes, instead of in one payload at the end of the job.
+        """
+        return self.config.getboolean(
+            "rosie_pi",
+            "incremental_results",
+            fallback=False
+        )
+
+    @property
+    def compress_results(self):
+        """ Gzip the bodies of requests to physaCI. Only for physaCI
+            servers that accept ``Content-Encoding: gzip``.
+        """
+        return self.config.getboolean(
+            "rosie_pi",
+            "compress_results",
+            fallback=False
+        )
+
+    @property
+    def outbox_dir(self):
+        """ Directory to queue results that couldn't be sent to physaCI,
+            for sending at the start of the next job. An empty value
+            disables the outbox.
+        """
+        return self.config.get(
+            "rosie_pi",
+            "outbox_dir",
+            fallback=str(reporting.DEFAULT_OUTBOX_DIR)
+        )
+
+    @property
+    def http_connect_timeout(self):
+        """ Seconds to wait for a connection to physaCI. """
+        return self.config.getfloat("rosie_pi", "http_connect_timeout",
+                                    fallback=5)
+
+    @property
+    def http_read_timeout(self):
+        """ Seconds to wait for physaCI to answer a request. """
+        return self.config.getfloat("rosie_pi", "http_read_timeout",
+                                    fallback=30)
+
+    @property
+    def board_timeout(self):
+        """ Seconds a board may take to build, flash and test, after which
+            it is reported as an error. Configured in minutes; ``0``
+            disables the limit. Hung boards are stopped by killing their
+            worker process, so in ``sequential`` mode each board runs in a
+            worker process of its own while this is set; the limit isn't
+            enforced in ``pipeline`` mode.
+        """
+        timeout_mins = self.config.getfloat(
+            "rosie_pi", "board_timeout_mins", fallback=60
+        )
+        return timeout_mins * 60 if timeout_mins > 0 else None
+
+    @property
+    def http_retries(self):
+        """ Retries for requests to physaCI that fail transiently. """
+        return self.config.getint("rosie_pi", "http_retries", fallback=4)
+
+    @property
+    def board_lock_dir(self):
+        """ Directory for the per-board lock files that keep concurrent
+            jobs off the same board. An empty value disables board locks.
+        """
+        return self.config.get(
+            "rosie_pi",
+            "board_lock_dir",
+            fallback=str(board_lock.DEFAULT_LOCK_DIR)
+        )
+
+    @property
+    def daemon_socket(self):
+        """ Unix socket the RosiePi daemon listens on for jobs. An empty
+            value always runs jobs in the ``run_rosie`` process.
+        """
+        return self.config.get(
+            "rosie_pi",
+            "daemon_socket",
+            fallback=str(daemon.DEFAULT_SOCKET)
+        )
+
+    @property
+    def daemon_concurrency(self):
+        """ The most jobs the RosiePi daemon runs at once. """
+        return self.config.getint("rosie_pi", "daemon_concurrency", fallback=1)
+
+    @property
+    def force_flash(self):
+        """ Always flash the firmware, even if a board is already running
+            it.
+        """
+        return self.config.getboolean("rosie_pi", "force_flash", fallback=False)
+
 @dataclasses.dataclass
 class GitHubData():
     """ Dataclass to contain data formatted to update the GitHub
@@ -109,6 +527,16 @@ class GitHubData():
 class NodeTestData():
     """ Dataclass to contain test data stored by physaCI. """
     board_tests: list = dataclasses.field(default_factory=list)
+    phase_timing: list = dataclasses.field(default_factory=list)
+    profile: dict = dataclasses.field(default_factory=dict)
+
+def _log_text(value):
+    """ JSON encoder fallback, for ``TestResultStream`` board logs. """
+    from .rosie import test_controller # pylint: disable=import-outside-toplevel
+
+    if isinstance(value, test_controller.TestResultStream):
+        return value.getvalue()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
 
 class TestResultPayload():
     """ Container to hold the test result payload """
@@ -120,12 +548,25 @@ class TestResultPayload():
     @property
     def payload_json(self):
         """ Format the contents into a JSON string. """
+        # board logs are ``TestResultStream`` instances, kept compressed
+        # until now. The string holds every board's log at once, so a job
+        # needs memory for all of its logs to send the full payload; only
+        # incremental reporting sends them a board at a time.
         payload_dict = {
             "github_data": dataclasses.asdict(self.github_data),
-            "node_test_data": dataclasses.asdict(self.node_test_data)
+            "node_test_data": {
+                "board_tests": [
+                    dict(board) for board in self.node_test_data.board_tests
+                ],
+                "phase_timing": self.node_test_data.phase_timing,
+            },
         }
+        if self.node_test_data.profile:
+            payload_dict["node_test_data"]["profile"] = (
+                self.node_test_data.profile
+            )
 
-        return json.dumps(payload_dict)
+        return json.dumps(payload_dict, default=_log_text)
 
 def markdownify_results(results, results_url):
     """ Puts test results into a Markdown table for use with
@@ -140,10 +581,13 @@ def markdownify_results(results, results_url):
     ]
 
     for board in results:
+        outcome = board["outcome"]
+        if board.get("cached"):
+            outcome = f"{outcome} (cached)"
         board_mdown = [
             "",
             board["board_name"],
-            board["outcome"],
+            outcome,
             board["tests_passed"],
             board["tests_failed"],
             "",
@@ -158,7 +602,25 @@ def markdownify_results(results, results_url):
     return "\n".join(mdown)
 
 
-def run_rosie(commit, check_run_id, boards, payload):
+def _until_cancelled(board_runs):
+    """ Yields the finished boards from ``board_runs``, stopping quietly if
+        the job is cancelled while a board waits for its lock.
+    """
+    try:
+        yield from board_runs
+    except job_cancel.JobCancelled as cancel_err:
+        rosiepi_logger.info("%s while waiting for a board.", cancel_err)
+
+def run_rosie(commit, check_run_id, boards, payload, mirror=None, # pylint: disable=too-many-arguments,too-many-locals
+              fw_cache=None, cc_cache=None, execution="sequential",
+              pipeline_depth=1, board_workers=None, fw_record=None,
+              force_flash=False, log_dir=None, on_board_result=None,
+              board_locks=None, fw_scheduler=None, sparse_checkout=False,
+              board_scope="function", reset_policy="always",
+              impact_baseline=None, impact_cache_dir=None, history=None,
+              fail_fast=False, device_watcher=None, cpboard=None,
+              result_cache=None, force_run=False, cancel=None,
+              board_timeout=None):
     """ Runs rosiepi for each board.
         Returns results as a JSON for sending to GitHub.
 
@@ -168,53 +630,350 @@ def run_rosie(commit, check_run_id, boards, payload):
                         on. Supplied by the node's config file.
         :param: payload: The ``TestResultPayload`` container to hold
                          incremental result data.
+        :param: mirror: An optional ``git_mirror.GitMirror`` to check out
+                        the commit from.
+        :param: fw_cache: An optional ``build_cache.BuildCache`` to reuse
+                          firmware builds from.
+        :param: cc_cache: An optional ``compiler_cache.CompilerCache`` to
+                          compile firmware through.
+        :param: execution: How to run the per-board stages; one of
+                           ``board_runner.EXECUTION_MODES``.
+        :param: pipeline_depth: The most boards that may wait, built, to be
+                                flashed in ``pipeline`` mode.
+        :param: board_workers: The most boards run at once, each in its own
+                               worker process, in ``process`` mode.
+                               Defaults to one worker per board.
+        :param: fw_record: An optional ``flash_record.FlashRecord`` used to
+                           skip flashing firmware a board already runs.
+        :param: force_flash: Flash the firmware even if ``fw_record`` says
+                             a board is already running it.
+        :param: log_dir: Optional directory for the job's log files.
+        :param: on_board_result: Optional callable, called with each
+                                 board's results as soon as the board
+                                 finishes.
+        :param: board_locks: An optional ``board_lock.BoardLocks``. Each
+                             board is held from connecting until its
+                             results are in, so that concurrent jobs take
+                             turns with it.
+        :param: fw_scheduler: An optional ``build_scheduler.BuildScheduler``
+                              shared with other jobs. By default, the job
+                              gets its own.
+        :param: sparse_checkout: Check out only the ports, shared sources
+                                 and submodules that ``boards`` need.
+        :param: board_scope: The pytest scope of the ``board`` fixture.
+        :param: reset_policy: When boards are reset between tests.
+        :param: impact_baseline: An optional ref to diff the commit
+                                 against, to run only the tests the change
+                                 can affect. Ignored without a ``mirror``,
+                                 since a shallow clone has no merge base.
+        :param: impact_cache_dir: Directory to cache test impact mappings
+                                  in. ``None`` disables the cache.
+        :param: history: An optional ``test_history.TestHistory`` to record
+                         results in, and to order each board's tests by.
+        :param: fail_fast: Stop each board's tests at the first failure.
+        :param: device_watcher: An optional ``device_watch.DeviceWatcher``
+                                used to wait for boards during firmware
+                                updates. Defaults to watching the system's
+                                sysfs.
+        :param: cpboard: The ``CPboard`` class to connect to boards with.
+                         Defaults to ``tests.pyboard.CPboard`` from the
+                         checkout.
+        :param: result_cache: An optional ``result_cache.ResultCache``.
+                              Boards with cached results for this commit
+                              are reported from the cache instead of being
+                              tested, and a job already testing the same
+                              commit on a board is waited for.
+        :param: force_run: Test every board, even if ``result_cache`` has
+                           results for it. The new results replace the
+                           cached ones.
+        :param: cancel: An optional ``job_cancel.CancelToken``. Cancelling
+                        it stops the job within a few seconds: builds are
+                        killed, test sessions stop after the current test,
+                        and boards that haven't finished are reported as
+                        ``Cancelled``, with a ``cancelled`` conclusion.
+        :param: board_timeout: Seconds a board may take, after which its
+                               worker process is stopped and it is
+                               reported as an ``Error``. ``None`` for no
+                               limit. In ``sequential`` mode, a timeout
+                               runs each board in a worker process; it
+                               isn't enforced in ``pipeline`` mode.
     """
 
-    app_conclusion = ""
+    # pylint: disable=import-outside-toplevel
+    import sh
+    from pytest import ExitCode
+    from .rosie import cirpy_actions, test_controller, test_impact
+    from .rosie.result_cache import result_key
+
+    if fw_scheduler is None:
+        concurrent_builds = 1
+        if execution == "process":
+            concurrent_builds = board_workers or len(boards)
+        fw_scheduler = build_scheduler.BuildScheduler(
+            max_concurrent=concurrent_builds
+        )
+
+    held_boards = {}
+    held_results = {}
 
     rosiepi_logger.info("Starting tests...")
 
-    for board in boards:
-        board_results = {
-            "board_name": board,
-            "outcome": None,
-            "tests_passed": 0,
-            "tests_failed": 0,
-            "rosie_log": "",
-        }
+    if impact_baseline and mirror is None:
+        rosiepi_logger.info(
+            "Test impact analysis needs the git mirror; running every test."
+        )
+        impact_baseline = None
+
+    checkout_boards = boards if sparse_checkout else None
+    with cirpy_actions.CirpyCheckout(commit, mirror=mirror,
+                                     boards=checkout_boards) as checkout:
+        payload.node_test_data.phase_timing.extend(checkout.timer.spans)
+
+        impact = None
+        if impact_baseline:
+            impact = test_impact.ImpactAnalyzer(
+                checkout.path,
+                commit,
+                impact_baseline,
+                cache_dir=impact_cache_dir
+            )
+
+        cached_boards = {}
+        test_boards = list(boards)
+        if result_cache is not None:
+            for board in boards:
+                test_files = None
+                if impact is not None:
+                    test_files = impact.select(
+                        cirpy_actions.board_port(checkout.path, board)
+                    ).test_files
+                try:
+                    key = result_key(
+                        checkout.path,
+                        commit,
+                        board,
+                        test_files=test_files,
+                        fail_fast=fail_fast
+                    )
+                except sh.ErrorReturnCode as git_err:
+                    rosiepi_logger.warning(
+                        "Failed to compute result cache key: %s", git_err.stderr
+                    )
+                    key = None
+                if key is None:
+                    continue
+
+                try:
+                    lock_fd = result_cache.lock(key, cancel=cancel)
+                except job_cancel.JobCancelled:
+                    break
+                entry = None if force_run else result_cache.fetch(key)
+                if entry is None:
+                    held_results[board] = (key, lock_fd)
+                else:
+                    result_cache.release(lock_fd)
+                    cached_boards[board] = entry
+                    test_boards.remove(board)
+
+        def new_controller(board):
+            if board_locks is not None:
+                held_boards[board] = board_locks.acquire(board, cancel=cancel)
+            return test_controller.TestController(
+                board,
+                commit,
+                checkout=checkout,
+                build_cache=fw_cache,
+                compiler_cache=cc_cache,
+                build_scheduler=fw_scheduler,
+                device_watcher=device_watcher,
+                flash_record=fw_record,
+                force_flash=force_flash,
+                log_dir=log_dir,
+                board_scope=board_scope,
+                reset_policy=reset_policy,
+                impact=impact,
+                history=history,
+                fail_fast=fail_fast,
+                cpboard=cpboard,
+                cancel=cancel
+            )
+
+        # a hung board can only be stopped from outside its process, so
+        # with a timeout, sequential boards run in a worker process each,
+        # one at a time.
+        timed_sequential = (
+            execution == "sequential" and board_timeout is not None
+        )
+
+        if not test_boards:
+            board_runs = []
+        elif execution == "pipeline":
+            if board_timeout is not None:
+                rosiepi_logger.warning(
+                    "The board timeout isn't enforced in pipeline mode."
+                )
+            board_runs = board_runner.run_pipelined(
+                test_boards,
+                new_controller,
+                depth=pipeline_depth,
+                cancel=cancel
+            )
+        elif execution == "process" or timed_sequential:
+            board_runs = board_runner.run_processes(
+                test_boards,
+                new_controller,
+                workers=1 if timed_sequential else board_workers,
+                cancel=cancel,
+                timeout=board_timeout
+            )
+        else:
+            board_runs = board_runner.run_sequential(
+                test_boards,
+                new_controller,
+                cancel=cancel
+            )
 
         try:
-            rosie_test = test_controller.TestController(board, commit)
+            for board, entry in cached_boards.items():
+                rosiepi_logger.info(
+                    "Using cached results for %s from check run %s",
+                    board,
+                    entry["check_run_id"]
+                )
+                stored_at = datetime.datetime.utcfromtimestamp(
+                    entry["stored_at"]
+                ).strftime("%Y-%m-%dT%H:%M:%SZ")
+                rosie_log = test_controller.TestResultStream.load(
+                    entry["log_path"]
+                )
+                rosie_log.write(
+                    "\nCached result from check run "
+                    f"{entry['check_run_id']}, stored at {stored_at}."
+                )
+                if log_dir is not None:
+                    rosie_log.save(log_dir / f"{board}.log.gz")
 
-            # check if connection to board was successful
-            if rosie_test.state != "error":
-                rosie_test.start_test()
-            else:
-                board_results["outcome"] = "Error"
-                #print(rosie_test.log.getvalue())
-                app_conclusion = "failure"
+                board_results = {
+                    "board_name": board,
+                    "outcome": entry["outcome"],
+                    "tests_passed": entry["tests_passed"],
+                    "tests_failed": entry["tests_failed"],
+                    "rosie_log": rosie_log,
+                    "build_stats": {},
+                    "phase_timing": [],
+                    "cached": True,
+                }
+                payload.node_test_data.board_tests.append(board_results)
 
-        except Exception: # pylint: disable=broad-except
-            rosie_test.log.write(traceback.format_exc())
-            break
+                if on_board_result is not None:
+                    on_board_result(board_results)
 
-        finally:
-            # now check the result of each board test
-            if rosie_test.result == ExitCode.OK: # everything passed!
-                board_results["outcome"] = "Passed"
-                if app_conclusion != "failure":
-                    app_conclusion = "success"
-            else:
-                if rosie_test.state != "error":
+            for rosie_test in _until_cancelled(board_runs):
+                board_results = {
+                    "board_name": rosie_test.board_name,
+                    "outcome": None,
+                    "tests_passed": 0,
+                    "tests_failed": 0,
+                    "rosie_log": "",
+                    "build_stats": {},
+                    "phase_timing": [],
+                    "cached": False,
+                }
+
+                # now check the result of each board test
+                if rosie_test.result == ExitCode.OK: # everything passed!
+                    board_results["outcome"] = "Passed"
+                elif rosie_test.state == "cancelled":
+                    board_results["outcome"] = job_cancel.CANCELLED_OUTCOME
+                elif rosie_test.state != "error":
                     board_results["outcome"] = "Failed"
                 else:
                     board_results["outcome"] = "Error"
-                app_conclusion = "failure"
 
-            board_results["tests_passed"] = str(rosie_test.tests_passed)
-            board_results["tests_failed"] = str(rosie_test.tests_failed)
-            board_results["rosie_log"] = rosie_test.log.getvalue()
-            payload.node_test_data.board_tests.append(board_results)
+                board_results["tests_passed"] = str(rosie_test.tests_passed)
+                board_results["tests_failed"] = str(rosie_test.tests_failed)
+                # the log stays compressed until the payload is serialized
+                board_results["rosie_log"] = rosie_test.log
+                if log_dir is not None and rosie_test.log_path is None:
+                    rosie_test.log_path = log_dir / f"{rosie_test.board_name}.log.gz"
+                    rosie_test.log.save(rosie_test.log_path)
+                board_results["build_stats"] = rosie_test.build_stats
+                board_results["phase_timing"] = rosie_test.phase_timing
+                payload.node_test_data.board_tests.append(board_results)
+
+                if rosie_test.board_name in held_results:
+                    key, lock_fd = held_results.pop(rosie_test.board_name)
+                    result_cache.store(key, board_results, check_run_id)
+                    result_cache.release(lock_fd)
+
+                if on_board_result is not None:
+                    on_board_result(board_results)
+
+                rosie_test.close()
+                if rosie_test.board_name in held_boards:
+                    board_locks.release(held_boards.pop(rosie_test.board_name))
+
+            if cancel is not None and cancel.cancelled:
+                reported = {
+                    board["board_name"]
+                    for board in payload.node_test_data.board_tests
+                }
+                for board in test_boards:
+                    if board in reported:
+                        continue
+                    rosie_log = test_controller.TestResultStream()
+                    rosie_log.write(
+                        f"Job cancelled ({cancel.reason}) before {board} "
+                        "was tested."
+                    )
+                    board_results = {
+                        "board_name": board,
+                        "outcome": job_cancel.CANCELLED_OUTCOME,
+                        "tests_passed": "0",
+                        "tests_failed": "0",
+                        "rosie_log": rosie_log,
+                        "build_stats": {},
+                        "phase_timing": [],
+                        "cached": False,
+                    }
+                    payload.node_test_data.board_tests.append(board_results)
+
+                    if on_board_result is not None:
+                        on_board_result(board_results)
+
+        finally:
+            for lock_fd in held_boards.values():
+                board_locks.release(lock_fd)
+            for _, lock_fd in held_results.values():
+                result_cache.release(lock_fd)
+
+    app_conclusion = ""
+    outcomes = [board["outcome"] for board in payload.node_test_data.board_tests]
+    if job_cancel.CANCELLED_OUTCOME in outcomes:
+        app_conclusion = job_cancel.CANCELLED_CONCLUSION
+    elif outcomes:
+        if all(outcome == "Passed" for outcome in outcomes):
+            app_conclusion = "success"
+        else:
+            app_conclusion = "failure"
+
+    # board workers keep their own build records, so the job summary is
+    # taken from each board's build stats.
+    build_stats = []
+    for board in payload.node_test_data.board_tests:
+        rosiepi_logger.info(
+            "Firmware build (%s): %s",
+            board["board_name"],
+            board["build_stats"]
+        )
+        build_stats.append(board["build_stats"])
+
+    if fw_cache is not None:
+        rosiepi_logger.info(
+            "Firmware build cache: %s hit(s), %s miss(es)",
+            sum(stats.get("build_cache") == "hit" for stats in build_stats),
+            sum(stats.get("build_cache") == "miss" for stats in build_stats)
+        )
 
     app_output_summary = [
         f"RosiePi Node: {gethostname()}",
@@ -244,52 +1003,360 @@ def run_rosie(commit, check_run_id, boards, payload):
 
     rosiepi_logger.info("Tests completed...")
 
-def send_results(check_run_id, physaci_config, results_payload):
+def job_log_dir(physaci_config, check_run_id):
+    """ Creates the log directory for a job, and removes the oldest job
+        log directories past the configured retention.
+
+        :param: physaci_config: A ``PhysaCIConfig()`` instance
+        :param: check_run_id: The check run ID of the job.
+
+        :returns: The job's log directory, or ``None`` if job logs are
+                  disabled.
+    """
+    if not physaci_config.log_dir:
+        return None
+
+    log_root = pathlib.Path(physaci_config.log_dir)
+    log_dir = log_root / str(check_run_id)
+
+    # pruned first, and without this job's directory, so a re-run job
+    # (whose directory may be the oldest) never has its logs removed.
+    if log_root.exists():
+        job_dirs = sorted(
+            (
+                path for path in log_root.iterdir()
+                if path.is_dir() and path.name != log_dir.name
+            ),
+            key=lambda path: path.stat().st_mtime,
+            reverse=True
+        )
+        keep = max(1, physaci_config.log_retention) - 1
+        for old_dir in job_dirs[keep:]:
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+    log_dir.mkdir(parents=True, exist_ok=True)
+    # a re-run job's directory counts as the newest
+    log_dir.touch()
+
+    return log_dir
+
+def write_metrics(metrics_file, payload, extra_spans=()):
+    """ Writes a job's phase timings to an OpenMetrics textfile. Failing
+        to write it doesn't fail the job.
+
+        :param: metrics_file: The file to write.
+        :param: payload: The job's ``TestResultPayload``.
+        :param: extra_spans: Spans that aren't in the payload.
+    """
+    spans = list(payload.node_test_data.phase_timing)
+    for board in payload.node_test_data.board_tests:
+        spans.extend(board["phase_timing"])
+    spans.extend(extra_spans)
+
+    try:
+        phase_timer.write_openmetrics(metrics_file, spans, node=gethostname())
+    except OSError as metrics_err:
+        rosiepi_logger.warning(
+            "Couldn't write the metrics file: %s", metrics_err
+        )
+
+def send_results(check_run_id, client, results_payload):
     """ Send the results to physaCI.
 
         :param: check_run_id: The check run ID of the initiating check.
-        :param: physaci_config: A ``PhysaCIConfig()`` instance
+        :param: client: The ``reporting.PhysaCIClient`` to send with.
         :param: results_payload: A JSON string with the test results.
     """
 
     rosiepi_logger.info("Sending test results to physaCI.")
 
-    physaci_url = physaci_config.physaci_url + "/testresult/update"
-    header = {"x-functions-key": physaci_config.physaci_api_key}
     payload = json.loads(results_payload)
     payload["node_name"] = gethostname()
     payload["check_run_id"] = check_run_id
 
-    response = requests.post(physaci_url, headers=header, json=payload)
-    if not response.ok:
-        rosiepi_logger.warning(
-            "Failed to send results to physaCI.\n"
-            "Response code: %s\n"
-            "Response: %s",
-            response.status_code,
-            response.text
-        )
+    try:
+        client.send("/testresult/update", payload)
+    except RuntimeError as send_err:
+        rosiepi_logger.warning("Failed to send results to physaCI.\n%s", send_err)
         raise RuntimeError(
             f"RosiePi failed to send results. Results payload: {results_payload}"
-        )
+        ) from send_err
 
     rosiepi_logger.info("Test results sent successfully.")
 
-def main():
-    """ Run RosiePi tests. """
-    cli_arg = cli_parser.parse_args()
+def report_cancelled(check_run_id, client, reason="cancelled"):
+    """ Reports a job that was cancelled before it ran, so that its check
+        run is concluded as ``cancelled`` instead of being left pending.
+
+        :param: check_run_id: The check run ID of the cancelled job.
+        :param: client: The ``reporting.PhysaCIClient`` to send with.
+        :param: reason: Why the job was cancelled, for the check run
+                        summary.
+    """
+    payload = TestResultPayload()
+    payload.github_data.output.update(
+        {
+            "title": "RosiePi Test Results",
+            "summary": "\n\n".join([
+                f"RosiePi Node: {gethostname()}",
+                "Overall Outcome: "
+                f"{job_cancel.CANCELLED_CONCLUSION.title()} ({reason})",
+            ]),
+            "text": "",
+        }
+    )
+    payload.github_data.conclusion = job_cancel.CANCELLED_CONCLUSION
+    payload.github_data.completed_at = (
+        datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    )
+
+    send_results(check_run_id, client, payload.payload_json)
+
+class NodeResources():
+    """ The mirror, caches and physaCI client a node uses for its jobs.
+        Built once per process, so a long running process (see
+        ``rosiepi.daemon``) keeps them warm between jobs.
+
+        :param: config: A ``PhysaCIConfig()`` instance
+        :param: fw_scheduler: An optional ``build_scheduler.BuildScheduler``
+                              shared by every job using these resources.
+                              Defaults to one sized for a single job, using
+                              the configured ``build_slot_dir``.
+    """
+
+    def __init__(self, config, fw_scheduler=None):
+        # pylint: disable=import-outside-toplevel
+        from .rosie import (
+            build_cache,
+            cirpy_actions,
+            git_mirror,
+            result_cache,
+            test_history
+        )
+
+        self.config = config
+
+        if fw_scheduler is None:
+            concurrent_builds = 1
+            if config.execution_mode == "process":
+                concurrent_builds = (
+                    config.board_workers or len(config.supported_boards)
+                )
+            fw_scheduler = build_scheduler.BuildScheduler(
+                max_concurrent=concurrent_builds,
+                slot_dir=config.build_slot_dir or None
+            )
+        self.fw_scheduler = fw_scheduler
+
+        self.mirror = None
+        if config.git_mirror_dir:
+            self.mirror = git_mirror.GitMirror(
+                cirpy_actions.CIRPY_GIT_URL,
+                mirror_dir=config.git_mirror_dir,
+                max_size=config.git_mirror_max_size,
+                gc_interval=config.git_mirror_gc_interval,
+            )
+
+        self.fw_cache = None
+        if config.build_cache_dir:
+            self.fw_cache = build_cache.BuildCache(
+                cache_dir=config.build_cache_dir,
+                max_size=config.build_cache_max_size,
+            )
 
-    commit = cli_arg.commit
-    check_run_id = cli_arg.check_run_id
+        self.cc_cache = None
+        if config.ccache_dir:
+            self.cc_cache = compiler_cache.CompilerCache(
+                cache_dir=config.ccache_dir,
+                max_size=config.ccache_max_size,
+            )
 
+        self.fw_record = None
+        if config.flash_record_file:
+            self.fw_record = flash_record.FlashRecord(config.flash_record_file)
+
+        self.result_cache = None
+        if config.result_cache_dir:
+            self.result_cache = result_cache.ResultCache(
+                cache_dir=config.result_cache_dir,
+                ttl=config.result_cache_ttl,
+                cache_failures=config.result_cache_failures,
+            )
+
+        self.history = None
+        if config.test_history_file:
+            self.history = test_history.TestHistory(config.test_history_file)
+
+        self.board_locks = None
+        if config.board_lock_dir:
+            self.board_locks = board_lock.BoardLocks(config.board_lock_dir)
+
+        self.client = reporting.PhysaCIClient(
+            config.physaci_url,
+            config.physaci_api_key,
+            timeout=(config.http_connect_timeout, config.http_read_timeout),
+            retries=config.http_retries,
+            outbox_dir=config.outbox_dir or None,
+            compress=config.compress_results,
+        )
+
+    def close(self):
+        """ Releases the physaCI client's connections. """
+        self.client.close()
+
+def run_job(commit, check_run_id, resources, force_flash=False, # pylint: disable=too-many-arguments
+            profile=False, force_run=False):
+    """ Runs a job's tests and reports the results to physaCI.
+
+        :param: commit: The commit of circuitpython to test.
+        :param: check_run_id: The ID of the GitHub Check Run
+        :param: resources: The node's ``NodeResources``.
+        :param: force_flash: Flash the firmware even if a board is already
+                             running it.
+        :param: profile: Sample the job with the profiler, writing the
+                         profile into the job's log directory (or the
+                         current directory, if job logs are disabled).
+        :param: force_run: Test every board, even if its results for this
+                           commit are cached.
+
+        :returns: The job's check run conclusion.
+    """
     rosiepi_logger.info("Initiating RosiePi test(s).")
     rosiepi_logger.info("Testing commit: %s", commit)
     rosiepi_logger.info("Check run id: %s", check_run_id)
 
+    config = resources.config
+    payload = TestResultPayload()
+
+    # results a previous job couldn't deliver go first
+    resources.client.replay_outbox()
+
+    reporter = None
+    if config.incremental_results:
+        reporter = reporting.IncrementalReporter(resources.client, check_run_id)
+
+    log_dir = job_log_dir(config, check_run_id)
+
+    profiler = None
+    if profile:
+        if (config.execution_mode == "process" or
+                (config.execution_mode == "sequential" and
+                 config.board_timeout is not None)):
+            rosiepi_logger.warning(
+                "Profiling samples this process only; board worker "
+                "processes won't be in the profile."
+            )
+        profiler = sampling_profiler.SamplingProfiler()
+        profiler.start()
+
+    # SIGTERM (e.g. from the daemon, when the job is cancelled or
+    # superseded) or Ctrl-C stops the job cleanly, and it still reports.
+    cancel = job_cancel.CancelToken()
+    try:
+        with job_cancel.cancel_on_signals(cancel):
+            run_rosie(
+                commit,
+                check_run_id,
+                config.supported_boards,
+                payload,
+                mirror=resources.mirror,
+                fw_cache=resources.fw_cache,
+                cc_cache=resources.cc_cache,
+                execution=config.execution_mode,
+                pipeline_depth=config.pipeline_depth,
+                board_workers=config.board_workers,
+                fw_record=resources.fw_record,
+                force_flash=force_flash or config.force_flash,
+                log_dir=log_dir,
+                on_board_result=reporter.report_board if reporter else None,
+                board_locks=resources.board_locks,
+                fw_scheduler=resources.fw_scheduler,
+                sparse_checkout=config.sparse_checkout,
+                board_scope=config.board_fixture_scope,
+                reset_policy=config.board_reset_policy,
+                impact_baseline=config.impact_baseline,
+                impact_cache_dir=config.impact_cache_dir or None,
+                history=resources.history,
+                fail_fast=config.fail_fast,
+                result_cache=resources.result_cache,
+                force_run=force_run,
+                cancel=cancel,
+                board_timeout=config.board_timeout
+            )
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            try:
+                profiler.save(log_dir or pathlib.Path.cwd())
+            except OSError as profile_err:
+                rosiepi_logger.warning(
+                    "Couldn't write the profile: %s", profile_err
+                )
+            if config.profile_in_results:
+                payload.node_test_data.profile = profiler.summary()
+
+    # sending is timed for the metrics file only, since the payload has
+    # already gone by the time the span ends.
+    send_timer = phase_timer.PhaseTimer()
+    try:
+        with send_timer.span("send_results"):
+            if reporter is not None and not reporter.failed_boards:
+                reporter.finalize(dataclasses.asdict(payload.github_data))
+            else:
+                # boards that didn't make it incrementally are covered by
+                # sending the whole payload, which physaCI treats as the
+                # full result set.
+                send_results(
+                    check_run_id, resources.client, payload.payload_json
+                )
+    finally:
+        if config.metrics_file:
+            write_metrics(config.metrics_file, payload, send_timer.spans)
+        # upkeep happens whether or not the results got out
+        if resources.mirror is not None:
+            resources.mirror.maintain()
+
+    return payload.github_data.conclusion
+
+def main():
+    """ Run RosiePi tests. Jobs are handed to the RosiePi daemon if it is
+        running, and run in this process otherwise.
+    """
+    cli_arg = cli_parser.parse_args()
+    configure_logging()
+
     config = PhysaCIConfig()
 
-    payload = TestResultPayload()
+    if not cli_arg.no_daemon and config.daemon_socket:
+        conclusion = daemon.submit_job(
+            config.daemon_socket,
+            cli_arg.commit,
+            cli_arg.check_run_id,
+            force_flash=cli_arg.force_flash,
+            profile=cli_arg.profile,
+            force_run=cli_arg.force_run,
+            supersedes=cli_arg.supersede
+        )
+        if conclusion is not None:
+            return
 
-    run_rosie(commit, check_run_id, config.supported_boards, payload)
+    if cli_arg.supersede:
+        rosiepi_logger.warning(
+            "Not cancelling check run(s) %s; only the RosiePi daemon can "
+            "cancel other jobs.",
+            ", ".join(cli_arg.supersede)
+        )
 
-    send_results(check_run_id, config, payload.payload_json)
+    activate_venv()
+    resources = NodeResources(config)
+    try:
+        run_job(
+            cli_arg.commit,
+            cli_arg.check_run_id,
+            resources,
+            force_flash=cli_arg.force_flash,
+            profile=cli_arg.profile,
+            force_run=cli_arg.force_run
+        )
+    finally:
+        resources.close()
@@ -34,7 +34,10 @@ setup(
     entry_points={
         "console_scripts": [
             "rosiepi = rosiepi.rosie.test_controller:main",
-            "run_rosie = rosiepi.run_rosiepi:main"
+            "run_rosie = rosiepi.run_rosiepi:main",
+            "rosied = rosiepi.daemon:main",
+            "physaci_stub = rosiepi.physaci_stub:main",
+            "rosiepi_sim = rosiepi.rosie.sim_board:main"
         ]
     }
 )
@@ -0,0 +1,53 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import pytest
+
+from rosiepi.rosie.compiler_cache import CompilerCache
+
+def test_read_stats(tmp_path):
+    stats_log = tmp_path / "ccache.log"
+    stats_log.write_text(
+        "# main.c\ndirect_cache_hit\n"
+        "# board.c\npreprocessed_cache_hit\n"
+        "# version.c\ncache_miss\n"
+        "# firmware.elf\ncalled_for_link\n"
+    )
+
+    assert CompilerCache.read_stats(stats_log) == {
+        "hits": 2,
+        "misses": 1,
+        "hit_rate": 0.667,
+    }
+
+@pytest.mark.parametrize("content", ["", "\n", "# main.c\n"])
+def test_read_stats_without_stats(tmp_path, content):
+    # the log is created before the build; a ccache that ignores
+    # CCACHE_STATSLOG leaves it empty
+    stats_log = tmp_path / "ccache.log"
+    stats_log.write_text(content)
+
+    assert CompilerCache.read_stats(stats_log) is None
+
+def test_read_stats_missing_log(tmp_path):
+    assert CompilerCache.read_stats(tmp_path / "ccache.log") is None
@@ -0,0 +1,179 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import io
+import os
+import shutil
+import threading
+
+import pytest
+
+from rosiepi.rosie import cirpy_actions
+from rosiepi.rosie.device_watch import DeviceWatcher
+from rosiepi.rosie.sim_board import SimBoardFarm
+
+SERIAL = "ROSIE0001"
+
+def _devices_dir(sysfs_root):
+    return sysfs_root / "sys" / "bus" / "usb" / "devices"
+
+def _plug(sysfs_root, devnum, mode, serial=SERIAL):
+    """ Adds a USB device to the fake sysfs in one step, with the
+        interfaces that ``mode`` binds.
+    """
+    staging = sysfs_root / f".staging-{devnum}"
+    staging.mkdir(parents=True)
+    (staging / "serial").write_text(serial + "\n")
+    (staging / "busnum").write_text("1\n")
+    (staging / "devnum").write_text(f"{devnum}\n")
+    (staging / "product").write_text("Rosie Board\n")
+    (staging / "1-1:1.0" / "host0" / "target0:0:0" / "0:0:0:0" / "block"
+     / "sda").mkdir(parents=True)
+    if mode == "circuitpython":
+        (staging / "1-1:1.1" / "tty" / "ttyACM0").mkdir(parents=True)
+
+    _devices_dir(sysfs_root).mkdir(parents=True, exist_ok=True)
+    os.replace(staging, _devices_dir(sysfs_root) / "1-1")
+
+def _unplug(sysfs_root):
+    shutil.rmtree(_devices_dir(sysfs_root) / "1-1", ignore_errors=True)
+
+def _later(delay, func, *args):
+    timer = threading.Timer(delay, func, args)
+    timer.start()
+    return timer
+
+@pytest.fixture
+def watcher(tmp_path):
+    return DeviceWatcher(sysfs_root=tmp_path, poll_interval=0.01)
+
+def test_find(tmp_path, watcher):
+    assert watcher.find(SERIAL) is None
+
+    _plug(tmp_path, 4, "circuitpython")
+    _plug(tmp_path / "other", 5, "circuitpython", serial="OTHER")
+    device = watcher.find(SERIAL)
+
+    assert device.serial_number == SERIAL
+    assert (device.busnum, device.devnum) == ("1", "4")
+    assert device.product == "Rosie Board"
+    assert device.sysfs_path == (_devices_dir(tmp_path) / "1-1").resolve()
+    assert watcher.find("OTHER") is None
+
+@pytest.mark.parametrize("mode, ready", [
+    ("bootloader", {"bootloader": True, "circuitpython": False}),
+    ("circuitpython", {"bootloader": True, "circuitpython": True}),
+])
+def test_is_ready(tmp_path, watcher, mode, ready):
+    _plug(tmp_path, 4, mode)
+    device = watcher.find(SERIAL)
+
+    for check_mode, expected in ready.items():
+        assert watcher.is_ready(device, check_mode) == expected
+
+def test_detects_new_enumeration(tmp_path, watcher):
+    _plug(tmp_path, 4, "circuitpython")
+    previous = watcher.find(SERIAL)
+    _unplug(tmp_path)
+
+    timer = _later(0.2, _plug, tmp_path, 5, "circuitpython")
+    try:
+        latency = watcher.wait_for_reenumeration(
+            SERIAL, previous, "circuitpython", timeout=5
+        )
+    finally:
+        timer.cancel()
+
+    assert latency is not None
+    assert 0.2 <= latency < 5
+
+def test_times_out_when_board_stays_away(tmp_path, watcher):
+    _plug(tmp_path, 4, "circuitpython")
+    previous = watcher.find(SERIAL)
+    _unplug(tmp_path)
+
+    assert watcher.wait_for_reenumeration(
+        SERIAL, previous, "circuitpython", timeout=0.2
+    ) is None
+
+def test_same_enumeration_isnt_a_return(tmp_path, watcher):
+    # a board that hasn't dropped off the bus yet is still the old device
+    _plug(tmp_path, 4, "circuitpython")
+    previous = watcher.find(SERIAL)
+
+    assert watcher.wait_for_reenumeration(
+        SERIAL, previous, "circuitpython", timeout=0.2
+    ) is None
+
+def test_bootloader_to_circuitpython_handoff(tmp_path, watcher):
+    _plug(tmp_path, 4, "bootloader")
+    previous = watcher.find(SERIAL)
+    assert watcher.is_ready(previous, "bootloader")
+
+    def come_back():
+        _unplug(tmp_path)
+        # the drive binds before the serial REPL
+        _plug(tmp_path, 5, "bootloader")
+        _later(0.2, bind_tty).join()
+
+    def bind_tty():
+        device_dir = _devices_dir(tmp_path) / "1-1"
+        (device_dir / "1-1:1.1" / "tty" / "ttyACM0").mkdir(parents=True)
+
+    timer = _later(0.1, come_back)
+    try:
+        latency = watcher.wait_for_reenumeration(
+            SERIAL, previous, "circuitpython", timeout=5
+        )
+    finally:
+        timer.join()
+
+    assert latency is not None
+    assert latency >= 0.3
+    device = watcher.find(SERIAL)
+    assert device.devnum == "5"
+    assert watcher.is_ready(device, "circuitpython")
+
+def test_update_fw_waits_for_each_mode(tmp_path):
+    fw_path = tmp_path / "firmware.uf2"
+    fw_path.write_bytes(b"\0" * 1024)
+    test_log = io.StringIO()
+
+    with SimBoardFarm(tmp_path / "sim", ["sim_board"]) as farm:
+        cpboard = farm.cpboard_class()
+        board = cpboard.from_try_all("sim_board")
+        cirpy_actions.update_fw(
+            board,
+            "sim_board",
+            str(fw_path),
+            test_log,
+            device_watcher=farm.device_watcher(),
+            cpboard=cpboard
+        )
+        stats = farm.stats()["sim_board"]
+
+    log = test_log.getvalue()
+    assert log.count("Board re-enumerated in") == 2
+    assert "Timed out" not in log
+    assert stats["enumerate_bootloader"] == 1
+    assert stats["enumerate_circuitpython"] == 2
@@ -0,0 +1,166 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import shutil
+
+import pytest
+from sh.contrib import git
+
+from rosiepi.rosie.git_mirror import GitMirror
+
+@pytest.fixture
+def mirror(tmp_path, fake_cirpy):
+    return GitMirror(fake_cirpy.url, mirror_dir=tmp_path / "mirror")
+
+def _checkout(mirror, checkout_dir, commit, include=None):
+    with mirror.in_use():
+        mirror.clone(str(checkout_dir), commit)
+        git("-C", str(checkout_dir), "checkout", "--quiet", commit)
+        mirror.checkout_submodules(str(checkout_dir), include=include)
+
+def _head(checkout_dir):
+    return str(git("-C", str(checkout_dir), "rev-parse", "HEAD")).strip()
+
+def test_clone_borrows_from_mirror(tmp_path, fake_cirpy, mirror):
+    checkout_dir = tmp_path / "checkout"
+    _checkout(mirror, checkout_dir, fake_cirpy.head())
+
+    assert _head(checkout_dir) == fake_cirpy.head()
+    assert (checkout_dir / "py" / "version.c").exists()
+
+    alternates = checkout_dir / ".git" / "objects" / "info" / "alternates"
+    assert str(mirror.repo_path) in alternates.read_text()
+
+    origin = git("-C", str(checkout_dir), "remote", "get-url", "origin")
+    assert str(origin).strip() == fake_cirpy.url
+
+def test_checkout_submodules(tmp_path, fake_cirpy, mirror):
+    checkout_dir = tmp_path / "checkout"
+    _checkout(mirror, checkout_dir, fake_cirpy.head())
+
+    assert (checkout_dir / "lib" / "tinyusb" / "src" / "tusb.c").exists()
+    assert (
+        checkout_dir / "frozen" / "Adafruit_CircuitPython_Sim" / "sim.py"
+    ).exists()
+    assert sorted(path.name for path in mirror.modules_dir.iterdir()) == [
+        "frozen_Adafruit_CircuitPython_Sim.git",
+        "lib_tinyusb.git",
+    ]
+
+def test_checkout_submodules_include(tmp_path, fake_cirpy, mirror):
+    checkout_dir = tmp_path / "checkout"
+    _checkout(
+        mirror,
+        checkout_dir,
+        fake_cirpy.head(),
+        include=lambda path: path == "lib/tinyusb"
+    )
+
+    assert (checkout_dir / "lib" / "tinyusb" / "src" / "tusb.c").exists()
+    assert not (
+        checkout_dir / "frozen" / "Adafruit_CircuitPython_Sim" / "sim.py"
+    ).exists()
+
+def test_clone_fetches_new_commits(tmp_path, fake_cirpy, mirror):
+    _checkout(mirror, tmp_path / "first", fake_cirpy.head())
+
+    commit = fake_cirpy.new_commit(1)
+    _checkout(mirror, tmp_path / "second", commit)
+
+    assert _head(tmp_path / "second") == commit
+    assert "version = 1" in (tmp_path / "second" / "py" / "version.c").read_text()
+
+def test_missing_mirror_is_recreated(tmp_path, fake_cirpy, mirror):
+    _checkout(mirror, tmp_path / "first", fake_cirpy.head())
+    shutil.rmtree(mirror.mirror_dir)
+
+    _checkout(mirror, tmp_path / "second", fake_cirpy.head())
+
+    assert _head(tmp_path / "second") == fake_cirpy.head()
+    assert (tmp_path / "second" / "lib" / "tinyusb" / "src" / "tusb.c").exists()
+
+@pytest.mark.parametrize("corrupt", ["empty", "no_head", "not_a_dir"])
+def test_corrupt_mirror_is_recreated(tmp_path, fake_cirpy, mirror, corrupt):
+    if corrupt == "empty":
+        mirror.repo_path.mkdir(parents=True)
+    else:
+        mirror.update()
+        if corrupt == "no_head":
+            (mirror.repo_path / "HEAD").unlink()
+        else:
+            shutil.rmtree(mirror.repo_path)
+            mirror.repo_path.write_text("junk")
+
+    checkout_dir = tmp_path / "checkout"
+    _checkout(mirror, checkout_dir, fake_cirpy.head())
+
+    assert _head(checkout_dir) == fake_cirpy.head()
+
+def test_maintain_runs_gc_when_due(tmp_path, fake_cirpy, mirror):
+    _checkout(mirror, tmp_path / "checkout", fake_cirpy.head())
+
+    mirror.maintain()
+    assert mirror._gc_stamp.exists() # pylint: disable=protected-access
+
+    last_gc = mirror._gc_stamp.stat().st_mtime # pylint: disable=protected-access
+    mirror.maintain()
+    assert mirror._gc_stamp.stat().st_mtime == last_gc # pylint: disable=protected-access
+
+def test_maintain_drops_pins(tmp_path, fake_cirpy, mirror):
+    mirror.update()
+    commit = fake_cirpy.new_commit(1)
+    # fetched outside of the mirror's refspecs, so it has to be pinned
+    git("-C", str(fake_cirpy.remote), "update-ref", "refs/pull/1/head", commit)
+    git("-C", str(fake_cirpy.remote), "update-ref", "-d", "refs/heads/master",
+        _ok_code=[0, 1])
+    git("-C", str(fake_cirpy.remote), "update-ref", "-d", "refs/heads/main",
+        _ok_code=[0, 1])
+
+    mirror.update(commit)
+    pins = git("-C", str(mirror.repo_path), "for-each-ref", "refs/rosiepi")
+    assert commit in str(pins)
+
+    mirror.gc_interval = 0
+    mirror.maintain()
+    pins = git("-C", str(mirror.repo_path), "for-each-ref", "refs/rosiepi")
+    assert not str(pins).strip()
+
+def test_maintain_evicts_submodule_mirrors_over_cap(tmp_path, fake_cirpy,
+                                                    mirror):
+    _checkout(mirror, tmp_path / "checkout", fake_cirpy.head())
+
+    mirror.max_size = 1
+    mirror.maintain()
+
+    assert mirror.repo_path.exists()
+    assert not list(mirror.modules_dir.iterdir())
+
+def test_maintain_skipped_while_in_use(tmp_path, fake_cirpy, mirror):
+    _checkout(mirror, tmp_path / "checkout", fake_cirpy.head())
+    mirror.max_size = 1
+
+    with mirror.in_use():
+        mirror.maintain()
+
+    assert not mirror._gc_stamp.exists() # pylint: disable=protected-access
+    assert len(list(mirror.modules_dir.iterdir())) == 2
@@ -0,0 +1,70 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import multiprocessing
+import sqlite3
+
+from rosiepi.rosie import test_history
+
+def _record(db_file, board, start):
+    start.wait()
+    history = test_history.TestHistory(db_file)
+    history.record(board, "abc123", {"test_a": ("passed", 1.0)})
+
+def test_new_database_built_once(tmp_path):
+    db_file = tmp_path / "history.db"
+    boards = [f"board_{index}" for index in range(8)]
+
+    context = multiprocessing.get_context("fork")
+    start = context.Event()
+    workers = [
+        context.Process(target=_record, args=(db_file, board, start))
+        for board in boards
+    ]
+    for worker in workers:
+        worker.start()
+    start.set()
+    for worker in workers:
+        worker.join(30)
+        assert worker.exitcode == 0
+
+    # a rebuild after another process had recorded would have lost its row
+    history = test_history.TestHistory(db_file)
+    for board in boards:
+        assert history.stats(board)["test_a"].runs == 1
+
+def test_old_schema_rebuilt(tmp_path):
+    db_file = tmp_path / "history.db"
+    conn = sqlite3.connect(str(db_file))
+    conn.execute("CREATE TABLE results (board TEXT, nodeid TEXT)")
+    conn.execute("INSERT INTO results VALUES ('board_0', 'test_old')")
+    conn.commit()
+    conn.close()
+
+    history = test_history.TestHistory(db_file)
+    history.record("board_0", "abc123", {"test_a": ("failed", 2.0)})
+
+    stats = history.stats("board_0")
+    assert list(stats) == ["test_a"]
+    assert stats["test_a"].failures == 1
+    assert stats["test_a"].last_failure == 0
@@ -0,0 +1,99 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import pytest
+from sh.contrib import git
+
+from rosiepi.rosie.git_mirror import GitMirror
+from rosiepi.rosie.test_impact import ImpactAnalyzer
+
+@pytest.fixture
+def checkout(tmp_path, fake_cirpy):
+    """ A mirror checkout of a commit on top of the fake repo's first. """
+    commit = fake_cirpy.new_commit(1)
+    mirror = GitMirror(fake_cirpy.url, mirror_dir=tmp_path / "mirror")
+    checkout_dir = tmp_path / "checkout"
+    with mirror.in_use():
+        mirror.checkout(str(checkout_dir), commit)
+    return checkout_dir, commit
+
+def _branch(fake_cirpy):
+    return str(
+        git("-C", str(fake_cirpy.remote), "symbolic-ref", "--short", "HEAD")
+    ).strip()
+
+def _analyzer(checkout, changed):
+    checkout_dir, commit = checkout
+    analyzer = ImpactAnalyzer(checkout_dir, commit, "HEAD~1", cache_dir=None)
+    analyzer._changed_paths = changed # pylint: disable=protected-access
+    return analyzer
+
+def test_mirror_checkout_has_merge_base(fake_cirpy, checkout):
+    checkout_dir, commit = checkout
+    analyzer = ImpactAnalyzer(
+        checkout_dir, commit, f"origin/{_branch(fake_cirpy)}~1", cache_dir=None
+    )
+
+    assert analyzer.changed_paths() == ["py/version.c"]
+
+def test_shallow_clone_has_no_merge_base(tmp_path, fake_cirpy):
+    commit = fake_cirpy.new_commit(1)
+    checkout_dir = tmp_path / "shallow"
+    git.clone("--quiet", "--depth", "1", fake_cirpy.url, str(checkout_dir))
+    analyzer = ImpactAnalyzer(
+        checkout_dir, commit, f"origin/{_branch(fake_cirpy)}~1", cache_dir=None
+    )
+
+    selection = analyzer.select("atmel-samd")
+    assert selection.full
+    assert selection.reason.startswith("Can't diff against")
+
+def test_binding_change_selects_its_tests(checkout):
+    selection = _analyzer(
+        checkout, ["shared-bindings/board/__init__.c"]
+    ).select("atmel-samd")
+
+    assert selection.test_files == ["test_sim_0.py"]
+
+@pytest.mark.parametrize("path", [
+    "docs/design.rst",
+    "README.md",
+    "requirements-doc.txt",
+    "shared-bindings/docs/notes.md",
+])
+def test_docs_are_ignored(checkout, path):
+    selection = _analyzer(checkout, [path]).select("atmel-samd")
+
+    assert selection.full
+    assert selection.reason == "No tests matched the change"
+
+@pytest.mark.parametrize("path", [
+    "py/makeqstrdata.txt",
+    "ports/atmel-samd/boards/sim_board/pins.txt",
+    "ports/atmel-samd/README.md",
+])
+def test_text_files_outside_docs_are_core(checkout, path):
+    selection = _analyzer(checkout, [path]).select("atmel-samd")
+
+    assert selection.full
+    assert selection.reason == f"Core change: {path}"
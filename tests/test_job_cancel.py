@@ -0,0 +1,67 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import os
+import signal
+
+from rosiepi.rosie import job_cancel
+
+def _kill_self(signum):
+    os.kill(os.getpid(), signum)
+
+def test_cancel_on_signal():
+    cancel = job_cancel.CancelToken()
+    with job_cancel.cancel_on_signals(cancel, signals=(signal.SIGUSR2,)):
+        _kill_self(signal.SIGUSR2)
+        assert cancel.wait(5)
+
+    assert cancel.reason == "signal SIGUSR2"
+
+def test_other_signals_dont_cancel():
+    cancel = job_cancel.CancelToken()
+    received = []
+    previous = signal.signal(
+        signal.SIGUSR1,
+        lambda signum, _: received.append(signum)
+    )
+    try:
+        with job_cancel.cancel_on_signals(cancel, signals=(signal.SIGUSR2,)):
+            # handled by its own handler, but still written to the wakeup
+            # pipe
+            _kill_self(signal.SIGUSR1)
+            assert not cancel.wait(0.5)
+            assert received == [signal.SIGUSR1]
+
+            _kill_self(signal.SIGUSR2)
+            assert cancel.wait(5)
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+
+    assert cancel.reason == "signal SIGUSR2"
+
+def test_handlers_restored():
+    previous = signal.getsignal(signal.SIGTERM)
+    with job_cancel.cancel_on_signals(job_cancel.CancelToken()):
+        assert signal.getsignal(signal.SIGTERM) is not previous
+
+    assert signal.getsignal(signal.SIGTERM) is previous
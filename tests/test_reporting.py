@@ -0,0 +1,187 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Michael Schroeder
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import json
+import socket
+
+import pytest
+
+from rosiepi.physaci_stub import PhysaCIStub
+from rosiepi.reporting import PhysaCIClient
+
+@pytest.fixture
+def stub():
+    with PhysaCIStub() as physaci:
+        yield physaci
+
+@pytest.fixture
+def dead_url():
+    """ A URL that refuses connections. """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}"
+
+def _client(url, **kwargs):
+    kwargs.setdefault("backoff", 0)
+    return PhysaCIClient(url, "key", timeout=(1, 5), **kwargs)
+
+def _queued(outbox_dir):
+    return [
+        json.loads(path.read_text())
+        for path in sorted(outbox_dir.glob("[0-9]*.json"))
+    ]
+
+@pytest.mark.parametrize("status", [500, 502, 503, 504])
+def test_post_retries_5xx(stub, status):
+    stub.fail_next(2, status)
+    with _client(stub.url) as client:
+        client.post("/testresult/update", {"run": 1})
+
+    assert stub.requests == [("/testresult/update", {"run": 1})]
+
+def test_post_gives_up_after_retries(stub):
+    stub.fail_next(3, 503)
+    with _client(stub.url, retries=2) as client:
+        with pytest.raises(RuntimeError, match="after 3 attempt"):
+            client.post("/testresult/update", {"run": 1})
+
+    assert not stub.requests
+
+def test_post_doesnt_retry_4xx(stub):
+    stub.fail_next(1, 400)
+    with _client(stub.url) as client:
+        with pytest.raises(RuntimeError, match="after 1 attempt"):
+            client.post("/testresult/update", {"run": 1})
+
+    assert not stub.requests
+
+def test_connection_error_goes_to_outbox(tmp_path, dead_url):
+    outbox_dir = tmp_path / "outbox"
+    with _client(dead_url, retries=1, outbox_dir=outbox_dir) as client:
+        with pytest.raises(RuntimeError, match="after 2 attempt"):
+            client.send("/testresult/update", {"run": 1})
+
+    assert _queued(outbox_dir) == [
+        {"endpoint": "/testresult/update", "payload": {"run": 1}}
+    ]
+
+def test_no_outbox_without_outbox_dir(tmp_path, dead_url):
+    with _client(dead_url, retries=0) as client:
+        with pytest.raises(RuntimeError):
+            client.send("/testresult/update", {"run": 1})
+
+    assert not list(tmp_path.iterdir())
+
+def _fill_outbox(outbox_dir, dead_url, endpoints):
+    with _client(dead_url, retries=0, outbox_dir=outbox_dir) as client:
+        for run, endpoint in enumerate(endpoints):
+            with pytest.raises(RuntimeError):
+                client.send(endpoint, {"run": run})
+
+def test_replay_outbox_in_order(tmp_path, stub, dead_url):
+    outbox_dir = tmp_path / "outbox"
+    _fill_outbox(outbox_dir, dead_url, ["/testresult/update"] * 3)
+
+    with _client(stub.url, outbox_dir=outbox_dir) as client:
+        assert client.replay_outbox() == 3
+
+    assert stub.requests == [
+        ("/testresult/update", {"run": run}) for run in range(3)
+    ]
+    assert not _queued(outbox_dir)
+
+def test_replay_outbox_stops_at_first_failure(tmp_path, stub, dead_url):
+    outbox_dir = tmp_path / "outbox"
+    # physaCI answers the unknown endpoint with a 404, which isn't retried
+    _fill_outbox(
+        outbox_dir,
+        dead_url,
+        ["/testresult/update", "/testresult/unknown", "/testresult/update"]
+    )
+
+    with _client(stub.url, outbox_dir=outbox_dir) as client:
+        assert client.replay_outbox() == 1
+
+    assert stub.requests == [("/testresult/update", {"run": 0})]
+    assert _queued(outbox_dir) == [
+        {"endpoint": "/testresult/unknown", "payload": {"run": 1}},
+        {"endpoint": "/testresult/update", "payload": {"run": 2}},
+    ]
+
+def test_replay_outbox_discards_unreadable_entries(tmp_path, stub, dead_url):
+    outbox_dir = tmp_path / "outbox"
+    _fill_outbox(outbox_dir, dead_url, ["/testresult/update"])
+    (outbox_dir / "0-corrupt.json").write_text("{not json")
+
+    with _client(stub.url, outbox_dir=outbox_dir) as client:
+        assert client.replay_outbox() == 1
+
+    assert stub.requests == [("/testresult/update", {"run": 0})]
+    assert not list(outbox_dir.glob("*.json"))
+
+def test_replay_outbox_skipped_while_locked(tmp_path, stub, dead_url):
+    outbox_dir = tmp_path / "outbox"
+    _fill_outbox(outbox_dir, dead_url, ["/testresult/update"])
+
+    with _client(stub.url, outbox_dir=outbox_dir) as client:
+        with client._outbox_lock() as locked: # pylint: disable=protected-access
+            assert locked
+            with _client(stub.url, outbox_dir=outbox_dir) as other:
+                assert other.replay_outbox() == 0
+
+    assert not stub.requests
+    assert len(_queued(outbox_dir)) == 1
+
+def test_compressed_body_accepted(stub):
+    payload = {"log": "x" * 4096}
+    with _client(stub.url, compress=True) as client:
+        client.post("/testresult/update", payload)
+        assert client.compress
+
+    assert stub.requests == [("/testresult/update", payload)]
+    assert stub.bytes_received < 1024
+
+@pytest.mark.parametrize("status", [None, 415, 400, 503])
+def test_compression_downgraded(stub, status):
+    if status is None:
+        stub.accept_gzip = False
+    else:
+        stub.fail_next(1, status)
+
+    payload = {"log": "x" * 4096}
+    with _client(stub.url, compress=True, retries=0) as client:
+        client.post("/testresult/update", payload)
+        assert not client.compress
+
+        client.post("/testresult/update", payload)
+
+    assert stub.requests == [("/testresult/update", payload)] * 2
+
+def test_small_bodies_not_compressed(stub):
+    stub.accept_gzip = False
+    with _client(stub.url, compress=True, retries=0) as client:
+        client.post("/testresult/update", {"run": 1})
+        assert client.compress
+
+    assert stub.requests == [("/testresult/update", {"run": 1})]